@@ -2,28 +2,40 @@
 Create and add items to your dkr config.
 """
 import os
-import ast
 import sys
 import stat
 import argparse
 
-from main import DKRConfig
+from main import DKRConfig, resolve_image_digests
+from hosts import get_client
+from protocol import load_records, ENTRYPOINT_KEY, VERSIONS_KEY
 
 
-def main(config):
+def main(records):
     """
-    Add the specified entries in config to the dkr config.
+    Add the entrypoints and versions in the specified records to the dkr config,
+    pinning each new version to the digest of the image it refers to.
     """
     current_config = DKRConfig()
+    added = []
 
-    for key, value in config.items():
+    for record in records:
+        key, versions = record[ENTRYPOINT_KEY], record[VERSIONS_KEY]
+        added.extend((key, version) for version in versions)
 
         if key in current_config.config:
-            for version in value['versions']:
+            for version in versions:
                 current_config.add_entrypoint_version(key, version)
             continue
 
-        current_config.add_entrypoint(key, value['versions'])
+        current_config.add_entrypoint(key, versions)
+
+    added = [(e, v) for e, v in added if not current_config.get_version_digest(e, v)]
+    digests = resolve_image_digests(get_client(), [v for _, v in added],
+                                    mirrors=current_config.get_settings().get('mirrors'))
+
+    for (entrypoint, version), digest in zip(added, digests):
+        current_config.set_version_digest(entrypoint, version, digest)
 
     current_config.write(create=True)
 
@@ -58,16 +70,9 @@ def parse_arguments(argv):
         parser.print_help()
         sys.exit(0)
 
-    config = {args.entrypoint: {'versions': [image for image in args.image]}}
-
-    return config
-
-
-def parse_stdin():
-    raw = sys.stdin.read()
-    config = ast.literal_eval(raw)
+    records = [{ENTRYPOINT_KEY: args.entrypoint, VERSIONS_KEY: [image for image in args.image]}]
 
-    return config
+    return records
 
 
 def run_main(args=sys.argv[1:]):
@@ -78,11 +83,10 @@ def run_main(args=sys.argv[1:]):
         sys.exit(1)
 
     if args:
-        config = parse_arguments(args)
-        return main(config)
+        records = parse_arguments(args)
+        return main(records)
 
-    config = parse_stdin()
-    return main(config)
+    return main(load_records())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,347 @@
+"""
+Admission control for dkr containers, limiting how many are being created and how many are
+running at once on a docker host, across every dkr process, e.g. those of a 'make -j64'.
+
+Limits are set in the settings of the config, e.g.
+
+_settings:
+  admission:
+    creating: 8
+    running: 32
+
+Each limit is a gate with as many slots, which are files held with flock, so that the slot of
+a process which dies is freed with it, and no daemon is needed. Callers queue for a gate with
+a ticket, also a locked file, and are admitted in the order they arrived. The gates live in
+~/.dkr.d/admission, shared by every dkr of the user; 'path' sets another directory, e.g. one
+writable by every user of the host.
+
+How long callers waited for each gate is kept alongside it, see 'dkr-admission'.
+"""
+import os
+import sys
+import time
+import fcntl
+import errno
+import socket
+import logging
+import argparse
+import itertools
+import threading
+
+from contextlib import contextmanager
+
+from state import StateFile, makedirs
+from launch import STATE_DIR
+
+logger = logging.getLogger()
+
+ADMISSION_DIR = os.path.join(STATE_DIR, 'admission')
+CREATING = 'creating'
+RUNNING = 'running'
+GATES = [CREATING, RUNNING]
+ADMISSION_KEYS = GATES + ['path']
+LOCAL_HOST = 'local'
+QUEUE_DIR = 'queue'
+METRICS_FILE = 'metrics.json'
+SLOT_PREFIX = 'slot-'
+POLL_INTERVAL = 0.01
+MAX_POLL_INTERVAL = 0.25
+SLOW_ADMISSION = 1.0
+
+# Tells apart the tickets of the threads of one process which queue at the same time
+TICKET_COUNTER = itertools.count()
+
+
+def validate_admission(admission):
+    """
+    Checks that each limit of the admission settings is a positive number of slots.
+    """
+    if not isinstance(admission or {}, dict):
+        raise KeyError('Admission must map %s to limits' % ' and '.join(GATES))
+
+    unknown = set(admission or {}) - set(ADMISSION_KEYS)
+    if unknown:
+        raise KeyError('Admission has unknown options %s, expected %s' % (
+            ', '.join(sorted(unknown)), ', '.join(ADMISSION_KEYS)))
+
+    for gate in GATES:
+        limit = (admission or {}).get(gate)
+        if limit is not None and (not isinstance(limit, int) or limit < 1):
+            raise KeyError('Admission limit %s must be a positive number of containers' % gate)
+
+
+def get_gate_dir(admission, gate, host=LOCAL_HOST):
+    """
+    :return: The directory holding the slots and queue of a gate for the docker host
+    """
+    root = os.path.expanduser((admission or {}).get('path') or ADMISSION_DIR)
+    return os.path.join(root, ''.join(c if c.isalnum() or c in '.-' else '_' for c in host), gate)
+
+
+def is_held(path):
+    """
+    Tells whether another process holds the lock of a file, without waiting for it.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return False
+
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        return False
+    except IOError as e:
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            return True
+        raise
+    finally:
+        os.close(fd)
+
+
+def try_lock(path):
+    """
+    Takes the lock of a file, creating it if need be, without waiting for it.
+
+    :return: The descriptor holding the lock, or None if it is held already
+    """
+    fd = os.open(path, os.O_RDONLY | os.O_CREAT, 0o644)
+
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        return fd
+    except IOError as e:
+        os.close(fd)
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            return None
+        raise
+
+
+def get_queue(queue_dir):
+    """
+    Lists the tickets of the callers waiting in a queue, first come first, removing
+    those whose callers have gone.
+    """
+    tickets = []
+
+    for name in sorted(os.listdir(queue_dir)):
+        if name.startswith('.'):
+            continue
+
+        path = os.path.join(queue_dir, name)
+        if is_held(path):
+            tickets.append(name)
+            continue
+
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    return tickets
+
+
+def take_ticket(queue_dir):
+    """
+    Joins the end of a queue.
+
+    :return: tuple of the name of the ticket and the descriptor holding it
+    """
+    name = '%017.6f-%s-%d-%d-%d' % (time.time(), socket.gethostname(), os.getpid(),
+                                    threading.current_thread().ident, next(TICKET_COUNTER))
+    path = os.path.join(queue_dir, '.' + name)
+
+    # The ticket is locked before it is visible, so that it is never taken for an abandoned one
+    fd = try_lock(path)
+    os.rename(path, os.path.join(queue_dir, name))
+
+    return name, fd
+
+
+class Slot:
+    """
+    A slot of a gate, held until it is released or the process exits.
+    """
+
+    def __init__(self, fd, gate, waited):
+        self.fd = fd
+        self.gate = gate
+        self.waited = waited
+        self._lock = threading.Lock()
+
+    def release(self):
+        # A run may be cancelled from another thread while it releases its slots itself
+        with self._lock:
+            fd, self.fd = self.fd, None
+
+        if fd is not None:
+            os.close(fd)
+
+
+def admit(admission, gate, host=LOCAL_HOST, cancelled=None):
+    """
+    Waits for a free slot of the gate, after every caller which queued for it earlier.
+
+    :param admission: Dict of the admission settings, see validate_admission
+    :param gate: CREATING or RUNNING
+    :param host: Name of the docker host the container is for
+    :param cancelled: Optional function telling whether to give up waiting
+    :return: The Slot, or None if the gate has no limit or the wait was cancelled
+    """
+    limit = (admission or {}).get(gate)
+    if not limit:
+        return None
+
+    gate_dir = get_gate_dir(admission, gate, host)
+    queue_dir = os.path.join(gate_dir, QUEUE_DIR)
+    makedirs(queue_dir)
+
+    started = time.time()
+    ticket, ticket_fd = take_ticket(queue_dir)
+    fd = None
+
+    try:
+        while fd is None:
+            if cancelled and cancelled():
+                return None
+
+            queue = get_queue(queue_dir)
+            position = queue.index(ticket) if ticket in queue else 0
+
+            # Only the first in the queue may take a slot, so that nobody jumps it
+            if position == 0:
+                for index in range(limit):
+                    fd = try_lock(os.path.join(gate_dir, '%s%d' % (SLOT_PREFIX, index)))
+                    if fd is not None:
+                        break
+                else:
+                    time.sleep(POLL_INTERVAL)
+            else:
+                time.sleep(min(POLL_INTERVAL * (position + 1), MAX_POLL_INTERVAL))
+    finally:
+        os.close(ticket_fd)
+        try:
+            os.remove(os.path.join(queue_dir, ticket))
+        except OSError:
+            pass
+
+    slot = Slot(fd, gate, time.time() - started)
+    record_wait(gate_dir, slot.waited)
+
+    return slot
+
+
+@contextmanager
+def admitted(admission, gate, host=LOCAL_HOST):
+    """
+    Context manager holding a slot of the gate for the duration of the block, see admit.
+    """
+    slot = admit(admission, gate, host)
+
+    try:
+        yield slot
+    finally:
+        if slot:
+            slot.release()
+
+
+def record_wait(gate_dir, waited):
+    """
+    Adds how long a caller waited to the metrics of a gate.
+    Failing to do so is never fatal.
+    """
+    if waited > SLOW_ADMISSION:
+        logger.info('Waited %.1fs for admission to %s' % (waited, gate_dir))
+
+    try:
+        with StateFile(os.path.join(gate_dir, METRICS_FILE)).update() as metrics:
+            metrics['admitted'] = metrics.get('admitted', 0) + 1
+            metrics['total_wait'] = metrics.get('total_wait', 0.0) + waited
+            metrics['max_wait'] = max(metrics.get('max_wait', 0.0), waited)
+            metrics['last_wait'] = waited
+    except (IOError, OSError) as e:
+        logger.debug('Could not record admission to %s: %s' % (gate_dir, e))
+
+
+def get_gate_status(admission, gate, host=LOCAL_HOST):
+    """
+    :return: Dict of the 'limit' of a gate, how many slots are 'held', how many callers are
+             'waiting' and the metrics of how long they waited, see record_wait
+    """
+    gate_dir = get_gate_dir(admission, gate, host)
+    limit = (admission or {}).get(gate)
+    names = os.listdir(gate_dir) if os.path.isdir(gate_dir) else []
+    queue_dir = os.path.join(gate_dir, QUEUE_DIR)
+
+    return dict(StateFile(os.path.join(gate_dir, METRICS_FILE)).load(), limit=limit,
+                held=sum(is_held(os.path.join(gate_dir, name)) for name in names
+                         if name.startswith(SLOT_PREFIX)),
+                waiting=len(get_queue(queue_dir)) if os.path.isdir(queue_dir) else 0)
+
+
+def main(args):
+    """
+    dkr-admission Main function.
+    """
+    # Imported here as main itself builds on this module
+    from main import DKRConfig, print_tabulate
+    from hosts import load_hosts
+
+    settings = DKRConfig().get_settings()
+    admission = settings.get('admission') or {}
+    hosts = [LOCAL_HOST] + [host.name for host in load_hosts(settings)]
+
+    if args.reset:
+        for host in hosts:
+            for gate in GATES:
+                try:
+                    os.remove(os.path.join(get_gate_dir(admission, gate, host), METRICS_FILE))
+                except OSError:
+                    pass
+        return 0
+
+    def format_wait(wait):
+        return '-' if wait is None else '%.2fs' % wait
+
+    rows = []
+    for host in hosts:
+        for gate in GATES:
+            status = get_gate_status(admission, gate, host)
+            admitted = status.get('admitted', 0)
+            rows.append([host, gate, status['limit'] or '-', status['held'], status['waiting'],
+                         admitted,
+                         format_wait(status['total_wait'] / admitted if admitted else None),
+                         format_wait(status.get('max_wait')),
+                         format_wait(status.get('last_wait'))])
+
+    print_tabulate(['Host', 'Gate', 'Limit', 'Held', 'Waiting', 'Admitted', 'Mean wait',
+                    'Max wait', 'Last wait'], rows, print_total_rows=False)
+    return 0
+
+
+def parse_arguments(argv):
+    """
+    Parse command-line arguments
+
+    :param argv: command line arguments
+    :return: parsed command-line arguments (argparse)
+    """
+    description = ('Show the admission limits of dkr containers, how many slots are held, '
+                   'how many callers are waiting and how long they have waited.')
+
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--reset', action='store_true', help='Clear the wait time metrics')
+
+    args = parser.parse_args(argv)
+
+    return args
+
+
+def run_main(args=sys.argv[1:]):
+    args = parse_arguments(args)
+
+    return main(args)
+
+
+if __name__ == '__main__':
+    sys.exit(run_main())
@@ -0,0 +1,307 @@
+"""
+A resident dkr agent, which serves calls of the dkr client without the cost of
+starting python, importing docker and yaml, and loading the config for each call.
+
+The agent listens on a unix socket in ~/.dkr.d which only its user may connect to.
+For each call it forks a child, which already has everything imported and the config
+parsed, takes on the caller's working directory and stdio, and runs dkr as usual.
+
+The stdio of the caller is opened through /proc/<pid>/fd, since python 2 can't pass
+file descriptors over the socket. This covers terminals, pipes, FIFOs and files. Calls
+whose stdio is a socket are left to the client to run itself. Calls run with the
+environment of the agent rather than that of the caller.
+
+Only the imports and the config are kept warm. Each child opens its own docker connection,
+since an HTTP connection can't be shared between processes, and looks up images as dkr does,
+since they are pulled and removed outside of the agent.
+"""
+import os
+import sys
+import json
+import errno
+import fcntl
+import socket
+import struct
+import signal
+import logging
+import argparse
+
+from docker.errors import APIError
+
+import main as dkr_main
+
+from main import DKRConfig, CONFIG_FILE, execute, logger, errprint
+from client import AGENT_SOCKET, STDIO_FDS
+from state import makedirs
+
+# Linux values, which python 2 doesn't define
+SO_PEERCRED = getattr(socket, 'SO_PEERCRED', 17)
+O_ACCMODE = getattr(os, 'O_ACCMODE', 3)
+ACCEPT_TIMEOUT = 1.0
+
+
+def get_peer_credentials(conn):
+    """
+    Gets the pid, uid and gid of the process at the other end of a unix socket.
+    """
+    credentials = conn.getsockopt(socket.SOL_SOCKET, SO_PEERCRED, struct.calcsize('3i'))
+    return struct.unpack('3i', credentials)
+
+
+def open_process_stdio(pid):
+    """
+    Opens the stdio of another process of the same user, with the same access mode and
+    flags, and for regular files at the same offset.
+
+    Descriptors of the process which share a file, e.g. stdout and stderr with 2>&1,
+    share the opened file descriptor too, so that they write one after the other rather
+    than over each other.
+
+    :return: Dict mapping each stdio file descriptor number to the opened file descriptor
+    :raises OSError, IOError: If any of them can't be opened, e.g. because it is a socket
+    """
+    fds = {}
+    descriptions = {}
+
+    try:
+        for fd in STDIO_FDS:
+            info = {}
+            with open('/proc/%d/fdinfo/%d' % (pid, fd)) as fdinfo:
+                for line in fdinfo:
+                    key, _, value = line.partition(':')
+                    info[key] = value.strip()
+
+            target = os.stat('/proc/%d/fd/%d' % (pid, fd))
+            description = (target.st_dev, target.st_ino, info['pos'], info['flags'])
+            if description in descriptions:
+                fds[fd] = os.dup(fds[descriptions[description]])
+                continue
+            descriptions[description] = fd
+
+            flags = int(info['flags'], 8)
+            opened = os.open('/proc/%d/fd/%d' % (pid, fd),
+                             (flags & O_ACCMODE) | (flags & os.O_APPEND) | os.O_NOCTTY)
+            fds[fd] = opened
+
+            if os.path.isfile('/proc/self/fd/%d' % opened) and not flags & os.O_APPEND:
+                os.lseek(opened, int(info['pos']), os.SEEK_SET)
+    except (OSError, IOError, KeyError, ValueError):
+        for opened in fds.values():
+            os.close(opened)
+        raise
+
+    return fds
+
+
+def serve(conn, config):
+    """
+    Serves a call of the client in the current process, which has been forked for it.
+
+    Replies with the pid of the process, so that the client can interrupt it, and then
+    with the return code of the command and the offsets of any stdio files.
+    """
+    stream = conn.makefile('rwb', 0)
+
+    def reply(message):
+        stream.write(json.dumps(message).encode('utf-8') + b'\n')
+
+    pid, uid, _ = get_peer_credentials(conn)
+    if uid != os.getuid():
+        reply({'error': 'The agent only serves its own user'})
+        return
+
+    request = json.loads(stream.readline() or '{}')
+
+    try:
+        fds = open_process_stdio(pid)
+        os.chdir(request['cwd'])
+    except (OSError, IOError, KeyError, ValueError) as e:
+        reply({'error': str(e)})
+        return
+
+    for fd, opened in fds.items():
+        os.dup2(opened, fd)
+        os.close(opened)
+
+    # The client forwards its signals as SIGUSR1, leaving SIGTERM to stop the run as in dkr
+    def interrupt(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGUSR1, interrupt)
+    reply({'pid': os.getpid()})
+
+    container, rt = None, 1
+    try:
+        args = dkr_main.parse_arguments([str(arg) for arg in request.get('argv', [])])
+        container, rt = execute(args['base'], args['invocation'], profile=args['profile'],
+                                cache=args['cache'], config=config,
+                                outputs=[output for output in args['outputs'] if output],
+                                expand_globs=args['expand_globs'],
+                                resolution=args['resolution'],
+                                stdout_only=args['stdout_only'])
+    except SystemExit as e:
+        rt = e.code if isinstance(e.code, int) else 1
+    except KeyboardInterrupt:
+        container, rt = dkr_main.ACTIVE_CONTAINER, 130
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+    offsets = {}
+    for fd in STDIO_FDS:
+        if os.path.isfile('/proc/self/fd/%d' % fd):
+            offsets[fd] = os.lseek(fd, 0, os.SEEK_CUR)
+
+    reply({'exit_code': rt, 'offsets': offsets})
+
+    if container:
+        try:
+            container.stop()
+            container.remove()
+        except APIError:
+            pass
+
+
+class ConfigCache:
+    """
+    Keeps the parsed config, reloading it whenever the config file changes.
+    """
+
+    def __init__(self, path=CONFIG_FILE):
+        self.path = path
+        self.mtime = None
+        self.config = None
+
+    def get(self):
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            mtime = None
+
+        if self.config is None or mtime != self.mtime:
+            self.config = DKRConfig(path=self.path)
+            self.mtime = mtime
+
+        return self.config
+
+
+def listen(path=AGENT_SOCKET):
+    """
+    Creates the listening socket of the agent at path, which only its user may use.
+    """
+    makedirs(os.path.dirname(path))
+
+    try:
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    fcntl.fcntl(sock.fileno(), fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+
+    umask = os.umask(0o177)
+    try:
+        sock.bind(path)
+    finally:
+        os.umask(umask)
+
+    sock.listen(128)
+    sock.settimeout(ACCEPT_TIMEOUT)
+
+    return sock
+
+
+def main(path=AGENT_SOCKET):
+    """
+    dkr-agent Main function.
+
+    Accepts calls until interrupted, forking a child to serve each of them.
+    """
+    logger.setLevel(logging.ERROR)
+
+    configs = ConfigCache()
+    configs.get()
+    sock = listen(path)
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, stop)
+
+    try:
+        while True:
+            # Reap the children which have finished serving their calls
+            try:
+                while os.waitpid(-1, os.WNOHANG)[0]:
+                    pass
+            except OSError as e:
+                if e.errno != errno.ECHILD:
+                    raise
+
+            try:
+                conn, _ = sock.accept()
+            except socket.timeout:
+                continue
+            except socket.error as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+
+            config = configs.get()
+
+            if os.fork():
+                conn.close()
+                continue
+
+            # Child
+            sock.close()
+            conn.settimeout(None)
+            try:
+                serve(conn, config)
+            except Exception as e:
+                errprint('dkr-agent: Could not serve call: %s' % e)
+            finally:
+                os._exit(0)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sock.close()
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    return 0
+
+
+def parse_arguments(argv):
+    """
+    Parse command-line arguments
+
+    :param argv: command line arguments
+    :return: parsed command-line arguments (argparse)
+    """
+    description = ('Keep dkr resident, so that calls of dkr are handed over to it '
+                   'rather than paying for starting up each time.')
+
+    parser = argparse.ArgumentParser(description=description)
+
+    parser.add_argument('-s',
+                        '--socket',
+                        default=AGENT_SOCKET,
+                        help='Path of the socket to listen on, %s by default' % AGENT_SOCKET)
+
+    args = parser.parse_args(argv)
+
+    return args
+
+
+def run_main(args=sys.argv[1:]):
+    args = parse_arguments(args)
+
+    return main(path=args.socket)
+
+
+if __name__ == '__main__':
+    sys.exit(run_main())
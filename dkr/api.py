@@ -0,0 +1,232 @@
+"""
+Python API for running dkr commands concurrently from one process, e.g.
+
+    from dkr.api import Session, PIPE
+
+    with Session() as session:
+        run = session.start('minimap2', ['-a', 'ref.idx', 'reads.fastq'], stdout=PIPE)
+        for line in run.stdout:
+            ...
+        run.wait()
+
+Each run executes in its own thread through the same resolution and launch path as dkr,
+sharing the session's config and the pooled docker client, and can be cancelled, which
+stops its container. stdin, stdout and stderr may each be a file, PIPE to get a stream
+on the run, or None to use /dev/null for stdin and the process's own stdout and stderr.
+"""
+import os
+import fcntl
+import threading
+
+from main import (DKRConfig, DKRContainer, record_image_use, resolve_local_version,
+                  validate_resolution)
+from profiles import get_profile
+
+PIPE = -1
+
+
+def _make_pipe():
+    """
+    Makes a pipe whose ends are not inherited by the docker processes of other runs,
+    which would otherwise hold a stream open until they finished.
+    """
+    read_fd, write_fd = os.pipe()
+
+    for fd in (read_fd, write_fd):
+        fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+    return os.fdopen(read_fd, 'rb'), os.fdopen(write_fd, 'wb')
+
+
+class Run:
+    """
+    A dkr command started by a Session.
+
+    stdin, stdout and stderr are streams to write to and read from the command
+    when PIPE was given for them, otherwise None.
+    """
+
+    def __init__(self, base, args, stdin=None, stdout=None, stderr=None):
+        self.base = base
+        self.args = list(args)
+        self.stdin = self.stdout = self.stderr = None
+        self.returncode = None
+        self.error = None
+        self.cancelled = False
+        self.container = None
+
+        self._finished = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._close = []
+
+        # The ends of the pipes which the command uses, as opposed to the caller
+        self._stdio = {}
+        for name, given, mode in [('stdin', stdin, 'rb'), ('stdout', stdout, 'wb'),
+                                  ('stderr', stderr, 'wb')]:
+            if given == PIPE:
+                read, write = _make_pipe()
+                ours, theirs = (write, read) if name == 'stdin' else (read, write)
+                setattr(self, name, ours)
+                self._close.append(theirs)
+                given = theirs
+            elif given is None and name == 'stdin':
+                given = open(os.devnull, mode)
+                self._close.append(given)
+
+            self._stdio[name] = given
+
+    def done(self):
+        """
+        Checks whether the command has finished.
+        """
+        return self._finished.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Waits for the command to finish.
+
+        :param timeout: Seconds to wait for, forever if None
+        :return: The exit code of the command, or None if it is still running after timeout
+        """
+        self._finished.wait(timeout)
+
+        if self.error is not None:
+            raise self.error
+
+        return self.returncode
+
+    def cancel(self):
+        """
+        Cancels the command, stopping its container if it has been started.
+        """
+        with self._lock:
+            self.cancelled = True
+            container = self.container
+
+        if container:
+            container.remove_container()
+
+    def add_done_callback(self, callback):
+        """
+        Calls callback with the run once the command has finished,
+        straight away if it already has.
+        """
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(callback)
+                return
+
+        callback(self)
+
+    def _execute(self, image, invocation, settings, entrypoint=None):
+        try:
+            container = DKRContainer(image, invocation, flags=None, settings=settings,
+                                     stdin=self._stdio['stdin'], stdout=self._stdio['stdout'],
+                                     stderr=self._stdio['stderr'], entrypoint=entrypoint)
+
+            with self._lock:
+                if not self.cancelled:
+                    self.container = container
+
+            # Waiting for admission may take a while, so cancel() is not held up by it
+            if self.container:
+                container.wait_for_admission(cancelled=lambda: self.cancelled)
+
+            with self._lock:
+                if self.cancelled:
+                    self.container = None
+                    container.release_admission()
+                else:
+                    container.launch_container()
+
+            if self.container:
+                try:
+                    self.returncode = container.execute_command()
+                finally:
+                    container.remove_container()
+                record_image_use(image)
+
+        except (Exception, SystemExit) as e:
+            self.error = e
+
+        finally:
+            for stream in self._close:
+                stream.close()
+
+            with self._lock:
+                self._finished.set()
+                callbacks, self._callbacks = self._callbacks, []
+
+            for callback in callbacks:
+                callback(self)
+
+
+class Session:
+    """
+    Starts dkr commands, which share the session's config and docker client.
+
+    Used as a context manager, any commands still running when the block exits are cancelled.
+    """
+
+    def __init__(self, config=None):
+        self.config = config or DKRConfig()
+        self.runs = []
+
+    def start(self, base, args=None, stdin=None, stdout=None, stderr=None, profile=None,
+              settings=None):
+        """
+        Starts a command in the background.
+
+        :param base: Entrypoint in config or otherwise docker image reference
+        :param args: Arguments of the entrypoint
+        :param stdin: File to read stdin from, PIPE, or None for /dev/null
+        :param stdout: File to write stdout to, PIPE, or None for sys.stdout
+        :param stderr: File to write stderr to, PIPE, or None for sys.stderr
+        :param profile: Name of a run profile to use instead of the entrypoint's profile
+        :param settings: Dict of settings to use instead of those of the same name in the config
+        :return: Run
+        """
+        entrypoint, image = self.config.resolve(base)
+        invocation = ([entrypoint] if entrypoint else []) + list(args or [])
+
+        settings = dict(self.config.get_settings(entrypoint), **(settings or {}))
+        if profile:
+            settings['profile'] = profile
+
+        # Fail in the caller for a bad profile, rather than later in the run's thread
+        get_profile(settings.get('profile'), settings.get('profiles'))
+        validate_resolution(settings.get('resolution'))
+        image = resolve_local_version(self.config, base, entrypoint, image, settings)
+
+        run = Run(base, args or [], stdin=stdin, stdout=stdout, stderr=stderr)
+        self.runs = [r for r in self.runs if not r.done()] + [run]
+
+        thread = threading.Thread(target=run._execute, args=(image, invocation, settings, entrypoint))
+        thread.daemon = True
+        thread.start()
+
+        return run
+
+    def run(self, base, args=None, stdin=None, stdout=None, stderr=None, profile=None):
+        """
+        Runs a command and waits for it to finish, see start.
+
+        :return: The exit code of the command
+        """
+        return self.start(base, args, stdin=stdin, stdout=stdout, stderr=stderr,
+                          profile=profile).wait()
+
+    def cancel(self):
+        """
+        Cancels every command of the session which is still running.
+        """
+        for run in self.runs:
+            if not run.done():
+                run.cancel()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.cancel()
@@ -0,0 +1,288 @@
+"""
+Offline bundles of the images in your dkr config, for air-gapped and freshly provisioned nodes.
+
+    dkr-list 1 3 | dkr-bundle export --compress tools.tar.gz
+    dkr-bundle import /shared/tools.tar.gz
+
+A bundle is an archive in the format of 'docker save', holding each layer once however many
+of the images share it, prefixed by an index of the layers. Export bundles the images of the
+piped dkr-list records, or every image in the config when nothing is piped in.
+
+Export stages the output of 'docker save' next to the bundle, or in the working directory
+when the bundle is written to stdout, as the index has to be written before the layers.
+
+Import streams the bundle into 'docker load', reading it once from start to end, so that it
+can be read straight from shared storage or a pipe. Using the index, the layers which are
+already present locally are left out of what is loaded. Docker daemons which keep images in
+the containerd image store load an archive only if it has every layer of its images, so
+every layer is loaded into these.
+"""
+import io
+import os
+import sys
+import json
+import stat
+import gzip
+import shutil
+import tarfile
+import tempfile
+import argparse
+import subprocess
+
+from multiprocessing.pool import ThreadPool
+from docker.errors import APIError
+from requests.exceptions import RequestException
+
+from main import (DKRConfig, LOCAL_STATUS_THREADS, errprint, format_size, docker_command,
+                  canonical_image_reference, get_local_image_index)
+from hosts import get_client
+from protocol import load_records, VERSIONS_KEY
+
+BUNDLE_INDEX = 'dkr-bundle.json'
+MANIFEST_FILE = 'manifest.json'
+
+# A low compression level keeps exporting close to the speed of the disk
+GZIP_LEVEL = 3
+
+
+def get_versions():
+    """
+    Gets the images of the records piped in, or of every entrypoint in the config.
+    """
+    mode = os.fstat(0).st_mode
+
+    if stat.S_ISFIFO(mode) or stat.S_ISREG(mode):
+        records = load_records()
+    else:
+        config = DKRConfig()
+        records = [config.get_entrypoint(e) for e in config.get_entrypoints()]
+
+    versions = []
+    for record in records:
+        versions.extend(v for v in record[VERSIONS_KEY] if v not in versions)
+
+    return versions
+
+
+def index_layers(saved):
+    """
+    Maps each layer in an archive written by 'docker save' to the chains of layers it ends,
+    i.e. the diff ids of the layers up to and including it in each image that uses it.
+
+    :param saved: The archive, as a seekable TarFile
+    :return: Dict mapping the path of each layer in the archive to a list of chains
+    """
+    layers = {}
+
+    for image in json.load(saved.extractfile(MANIFEST_FILE)):
+        diff_ids = json.load(saved.extractfile(image['Config']))['rootfs']['diff_ids']
+
+        for i, layer in enumerate(image['Layers']):
+            layers.setdefault(layer, []).append(diff_ids[:i + 1])
+
+    return layers
+
+
+def get_local_chains(client, threads=LOCAL_STATUS_THREADS):
+    """
+    Gets the chains of layers of every local image, each as a tuple of diff ids.
+    """
+    def get_layers(image_id):
+        try:
+            return client.api.inspect_image(image_id)['RootFS'].get('Layers') or []
+        except (APIError, RequestException, KeyError):
+            return []
+
+    image_ids = [image['Id'] for image in client.api.images()]
+    if not image_ids:
+        return set()
+
+    pool = ThreadPool(min(threads, len(image_ids)))
+    try:
+        layers = pool.map(get_layers, image_ids)
+    finally:
+        pool.terminate()
+
+    return set(tuple(diff_ids[:i + 1]) for diff_ids in layers for i in range(len(diff_ids)))
+
+
+def uses_containerd_store(client):
+    """
+    Tells whether the docker daemon keeps its images in the containerd image store.
+    """
+    driver_status = dict((key, value) for key, value in client.info().get('DriverStatus') or [])
+    return 'containerd' in driver_status.get('driver-type', '')
+
+
+def export_bundle(path, versions, compress=False):
+    """
+    Writes the local images among versions to a bundle at path, or to stdout if path is '-'.
+
+    :return: List of the versions which are not available locally, and so were left out
+    """
+    client = get_client()
+    index = get_local_image_index(client, versions)
+    missing = [version for version in versions if version not in index]
+    references = [canonical_image_reference(v) for v in versions if v in index]
+
+    if not references:
+        return missing
+
+    directory = tempfile.mkdtemp(
+        dir=os.path.dirname(os.path.abspath(path)) if path != '-' else os.getcwd(), prefix='.dkr-')
+
+    try:
+        saved_path = os.path.join(directory, 'saved.tar')
+        if subprocess.call(docker_command() + ['save', '-o', saved_path] + references):
+            raise IOError('docker save failed')
+
+        bundle_path = os.path.join(directory, 'bundle')
+        out = os.fdopen(os.dup(1), 'wb') if path == '-' else open(bundle_path, 'wb')
+
+        with tarfile.open(saved_path) as saved, out:
+            layers = index_layers(saved)
+            stream = gzip.GzipFile(fileobj=out, mode='wb', compresslevel=GZIP_LEVEL) \
+                if compress else out
+
+            with tarfile.open(fileobj=stream, mode='w|') as bundle:
+                data = json.dumps({'images': references, 'layers': layers}).encode('utf-8')
+                info = tarfile.TarInfo(BUNDLE_INDEX)
+                info.size = len(data)
+                bundle.addfile(info, io.BytesIO(data))
+
+                # Everything but the layers comes first, so that import knows what each layer is
+                for member in sorted(saved.getmembers(), key=lambda m: m.name in layers):
+                    bundle.addfile(member, saved.extractfile(member) if member.isfile() else None)
+
+            if compress:
+                stream.close()
+
+        if path != '-':
+            os.rename(bundle_path, path)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return missing
+
+
+def import_bundle(path):
+    """
+    Loads the images in the bundle at path, or read from stdin if path is '-', leaving out
+    the layers already present locally, unless the daemon uses the containerd image store.
+
+    :return: tuple of the exit code of docker load, the number of layers and sizes of
+             the layers loaded and skipped
+    """
+    client = get_client()
+    present = set() if uses_containerd_store(client) else get_local_chains(client)
+
+    source = os.fdopen(os.dup(0), 'rb') if path == '-' else open(path, 'rb')
+
+    with source:
+        bundle = tarfile.open(fileobj=source, mode='r|*')
+
+        first = bundle.next()
+        if first is None or first.name != BUNDLE_INDEX:
+            raise ValueError('%s is not a dkr bundle' % path)
+
+        layers = json.loads(bundle.extractfile(first).read().decode('utf-8'))['layers']
+        skipped = set(layer for layer, chains in layers.items()
+                      if all(tuple(chain) in present for chain in chains))
+        sizes = {'loaded': 0, 'skipped': 0}
+
+        load = subprocess.Popen(docker_command() + ['load'], stdin=subprocess.PIPE,
+                                stdout=sys.stderr)
+
+        try:
+            with tarfile.open(fileobj=load.stdin, mode='w|') as out:
+                for member in bundle:
+                    if member.name == BUNDLE_INDEX:
+                        continue
+
+                    if member.name in layers and member.isfile():
+                        if member.name in skipped:
+                            sizes['skipped'] += member.size
+                            continue
+                        sizes['loaded'] += member.size
+
+                    out.addfile(member, bundle.extractfile(member) if member.isfile() else None)
+        finally:
+            load.stdin.close()
+            rt = load.wait()
+
+    return rt, len(layers) - len(skipped), sizes['loaded'], len(skipped), sizes['skipped']
+
+
+def main(args):
+    """
+    dkr-bundle Main function.
+    """
+    if args.command == 'export':
+        versions = get_versions()
+        if not versions:
+            errprint('dkr-bundle: Nothing to export.')
+            return 1
+
+        try:
+            missing = export_bundle(args.PATH, versions, compress=args.compress)
+        except (IOError, OSError, ValueError, KeyError) as e:
+            errprint('dkr-bundle: Could not export: %s' % e)
+            return 1
+
+        for version in missing:
+            errprint('dkr-bundle: %s is not available locally, pull it with dkr-pull first.'
+                     % version)
+
+        if len(missing) == len(versions):
+            return 1
+
+        errprint('dkr-bundle: Exported %d images' % (len(versions) - len(missing)))
+        return 1 if missing else 0
+
+    elif args.command == 'import':
+        try:
+            rt, loaded, loaded_size, skipped, skipped_size = import_bundle(args.PATH)
+        except (IOError, OSError, ValueError, KeyError, tarfile.TarError) as e:
+            errprint('dkr-bundle: Could not import: %s' % e)
+            return 1
+
+        errprint('dkr-bundle: Loaded %d layers (%s), skipped %d already present (%s)' % (
+            loaded, format_size(loaded_size), skipped, format_size(skipped_size)))
+        return rt
+
+
+def parse_arguments(argv):
+    """
+    Parse command-line arguments
+
+    :param argv: command line arguments
+    :return: parsed command-line arguments (argparse)
+    """
+    description = ('Export images in your dkr config to a single archive storing each layer '
+                   'once, and import them from it without a registry.')
+
+    parser = argparse.ArgumentParser(description=description)
+    subparsers = parser.add_subparsers(dest='command')
+
+    export_parser = subparsers.add_parser(
+        'export', help='Export the images of the piped dkr-list records, or of the whole config')
+    export_parser.add_argument('PATH', help="Path of the bundle to write, or '-' for stdout")
+    export_parser.add_argument('-z', '--compress', action='store_true', help='Compress with gzip')
+
+    import_parser = subparsers.add_parser(
+        'import', help='Load the images of a bundle, skipping layers already present')
+    import_parser.add_argument('PATH', help="Path of the bundle to read, or '-' for stdin")
+
+    args = parser.parse_args(argv)
+
+    return args
+
+
+def run_main(args=sys.argv[1:]):
+    args = parse_arguments(args)
+
+    return main(args)
+
+
+if __name__ == '__main__':
+    sys.exit(run_main())
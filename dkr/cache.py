@@ -0,0 +1,392 @@
+"""
+An opt-in cache of the results of deterministic dkr runs.
+
+A run is cached by declaring the files it writes with 'dkr -o PATH ...', or with
+'dkr --stdout-only ...' when its only product is stdout. Runs which declare neither are
+never cached, since a hit would leave any files they write unwritten. The cache is used
+for every such run of an entrypoint by enabling it in the config:
+
+_settings:
+  cache:
+    enabled: true
+    path: /scratch/dkr-cache
+    size: 200G
+    fingerprint: content
+
+Runs are keyed on the digest of the image, the working directory, the invocation with
+its paths made absolute, and fingerprints of the input files in the invocation and of
+stdin when it is a file. Arguments are taken to be paths as dkr mounts them, see
+launch.find_closest_path, and runs with a directory as an argument are not cached, as
+hashing it could mean walking all of it. Inputs are fingerprinted by the hash of their
+content by default, which is remembered for as long as their size and modification time
+don't change, or with 'fingerprint: mtime' by their size and modification time alone.
+
+Successful runs store their stdout, stderr and declared outputs in the cache directory,
+and the least recently used results are evicted once the cache grows beyond its size, as
+are the least recently used remembered hashes beyond HASHES_LIMIT. When the same run is
+made again its outputs, stdout and stderr are restored without starting a container.
+"""
+import os
+import sys
+import json
+import stat
+import time
+import fcntl
+import shutil
+import hashlib
+import tempfile
+import threading
+
+from contextlib import contextmanager
+from docker.errors import APIError
+from requests.exceptions import RequestException
+
+from main import (STATE_DIR, logger, parse_size, canonical_image_reference,
+                  resolve_image_digest)
+from launch import find_closest_path
+from state import StateFile, makedirs
+
+DEFAULT_CACHE_DIR = os.path.join(STATE_DIR, 'cache')
+DEFAULT_CACHE_SIZE = '20G'
+FINGERPRINTS = ['content', 'mtime']
+INDEX_FILE = 'index.json'
+HASHES_FILE = 'hashes.json'
+STDOUT_FILE = 'stdout'
+STDERR_FILE = 'stderr'
+HASHES_LIMIT = 100000
+OUTPUTS_DIR = 'outputs'
+CHUNK_SIZE = 1024 * 1024
+
+
+def get_image_digest(client, image, settings):
+    """
+    Gets the digest identifying the image a run will use: the digest it is pinned to in
+    the config, or the digest of the local image, or of the image in its registry.
+
+    :return: The digest, or None if it could not be found
+    """
+    digest = (settings.get('digests') or {}).get(image)
+    if digest:
+        return digest
+
+    try:
+        local = client.api.inspect_image(canonical_image_reference(image))
+    except (APIError, RequestException):
+        local = None
+
+    # Images built locally have no digest, so use their id
+    if local and not local.get('RepoDigests'):
+        return local['Id']
+
+    return resolve_image_digest(client, image, mirrors=settings.get('mirrors'))
+
+
+def hash_file(path):
+    """
+    Hashes the content of the file at path
+    """
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as stream:
+        for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def get_tree_size(path):
+    """
+    Gets the total size of the files at or under path
+    """
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, names in os.walk(path) for name in names)
+
+
+def copy_path(source, destination):
+    """
+    Copies the file or directory at source to destination, replacing
+    destination only once the copy is complete.
+    """
+    directory = os.path.dirname(os.path.abspath(destination))
+    tmp_path = tempfile.mkdtemp(dir=directory, prefix='.dkr-')
+    copy = os.path.join(tmp_path, 'copy')
+
+    try:
+        if os.path.isdir(source):
+            shutil.copytree(source, copy, symlinks=True)
+            if os.path.isdir(destination):
+                shutil.rmtree(destination)
+        else:
+            shutil.copy2(source, copy)
+        os.rename(copy, destination)
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+class ResultCache:
+    """
+    The cache directory, holding an entry per cached run and an index
+    of the size and time of last use of each entry.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_DIR, size=DEFAULT_CACHE_SIZE, fingerprint='content'):
+        if fingerprint not in FINGERPRINTS:
+            raise KeyError('Unknown cache fingerprint %s, expected one of %s' % (
+                fingerprint, ', '.join(FINGERPRINTS)))
+
+        self.path = os.path.expanduser(path)
+        self.size = parse_size(str(size))
+        self.fingerprint = fingerprint
+        self.index = StateFile(os.path.join(self.path, INDEX_FILE))
+        self.hashes = StateFile(os.path.join(self.path, HASHES_FILE))
+
+    @classmethod
+    def from_settings(cls, settings):
+        """
+        Creates the cache described by the 'cache' settings
+        """
+        cache = settings.get('cache') or {}
+
+        return cls(path=cache.get('path', DEFAULT_CACHE_DIR),
+                   size=cache.get('size', DEFAULT_CACHE_SIZE),
+                   fingerprint=cache.get('fingerprint', 'content'))
+
+    def get_entry_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def make_key(self, digest, invocation, outputs):
+        """
+        Makes the key of a run.
+
+        :param digest: Digest of the image, see get_image_digest
+        :param invocation: The invocation, including the entrypoint
+        :param outputs: Paths of the declared outputs, which are not treated as inputs
+        :return: The key, or None if the run can't be cached because stdin is streamed
+                 or a directory is one of its inputs
+        """
+        stdin = os.fstat(0)
+        if stat.S_ISFIFO(stdin.st_mode) or stat.S_ISSOCK(stdin.st_mode):
+            logger.warning('Not caching, stdin is streamed rather than read from a file')
+            return None
+
+        outputs = [os.path.abspath(output) for output in outputs]
+        normalised = []
+        inputs = []
+
+        for item in invocation:
+            # Only arguments which are paths in their entirety are inputs, as dkr mounts them
+            path = os.path.expanduser(item)
+            if path and find_closest_path(path) == path:
+                item = os.path.abspath(path)
+                if not any(os.path.join(item, '').startswith(os.path.join(output, ''))
+                           for output in outputs):
+                    if os.path.isdir(item):
+                        logger.warning('Not caching, %s is a directory' % item)
+                        return None
+                    inputs.append(item)
+            normalised.append(item)
+
+        paths = list(inputs)
+        if stat.S_ISREG(stdin.st_mode):
+            paths.append(os.readlink('/proc/self/fd/0'))
+
+        fingerprints = self._fingerprint_paths(paths)
+
+        run = {
+            'image': digest,
+            'cwd': os.getcwd(),
+            'invocation': normalised,
+            'inputs': fingerprints[:len(inputs)],
+            'stdin': fingerprints[len(inputs):],
+            'outputs': outputs
+        }
+
+        return hashlib.sha256(json.dumps(run, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _fingerprint_paths(self, paths):
+        """
+        Fingerprints the file at each of the paths, reusing the remembered
+        content hashes of files which have not changed.
+        """
+        remembered = self.hashes.load()
+        hashes = dict(remembered)
+        fingerprints = [self._fingerprint_path(path, hashes) for path in paths]
+        now = time.time()
+
+        # Hashing can take a while, so only hold the lock to store the new hashes
+        with self.hashes.update() as stored:
+            for path in set(paths) & set(hashes):
+                stored[path] = dict(hashes[path], last_used=now)
+
+            for evicted in sorted(stored, key=lambda p: stored[p].get('last_used', 0))[
+                    :max(len(stored) - HASHES_LIMIT, 0)]:
+                del stored[evicted]
+
+        return fingerprints
+
+    def _fingerprint_path(self, path, hashes):
+        path_stat = os.stat(path)
+        identity = [path_stat.st_dev, path_stat.st_ino, path_stat.st_size, path_stat.st_mtime]
+
+        if self.fingerprint == 'mtime':
+            return identity[2:]
+
+        remembered = hashes.get(path)
+        if not remembered or remembered['identity'] != identity:
+            remembered = hashes[path] = {'identity': identity, 'sha256': hash_file(path)}
+
+        return remembered['sha256']
+
+    def restore(self, key, outputs):
+        """
+        Restores the outputs, stdout and stderr of a cached run.
+
+        :return: True if the run was cached and has been restored, otherwise False
+        """
+        entry = self.get_entry_path(key)
+
+        if key not in self.index.load() or not os.path.isdir(entry):
+            return False
+
+        try:
+            for index, output in enumerate(outputs):
+                copy_path(os.path.join(entry, OUTPUTS_DIR, str(index)), output)
+
+            for stream, name in [(sys.stdout, STDOUT_FILE), (sys.stderr, STDERR_FILE)]:
+                stream.flush()
+                with open(os.path.join(entry, name), 'rb') as source:
+                    with os.fdopen(os.dup(stream.fileno()), 'wb') as destination:
+                        shutil.copyfileobj(source, destination)
+        except (IOError, OSError) as e:
+            logger.warning('Could not restore cached result %s: %s' % (key, e))
+            return False
+
+        with self.index.update() as index:
+            if key in index:
+                index[key]['last_used'] = time.time()
+
+        return True
+
+    @contextmanager
+    def record(self, key, outputs):
+        """
+        Context manager recording the stdout and stderr of the run made in its block, which
+        stores the result if the run sets the yielded dict's 'exit_code' to 0.
+        """
+        makedirs(self.path)
+        staging = tempfile.mkdtemp(dir=self.path, prefix='.staging-')
+        result = {'exit_code': None}
+
+        # When both go to the same file, e.g. with 2>&1, stderr is recorded with stdout
+        stdout, stderr = os.fstat(1), os.fstat(2)
+        shared = stat.S_ISREG(stdout.st_mode) and \
+            (stdout.st_dev, stdout.st_ino) == (stderr.st_dev, stderr.st_ino)
+
+        try:
+            if shared:
+                open(os.path.join(staging, STDERR_FILE), 'wb').close()
+
+            with record_output(sys.stdout, os.path.join(staging, STDOUT_FILE)):
+                if shared:
+                    yield result
+                else:
+                    with record_output(sys.stderr, os.path.join(staging, STDERR_FILE)):
+                        yield result
+
+            if result['exit_code'] == 0:
+                self._store(key, outputs, staging)
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+    def _store(self, key, outputs, staging):
+        """
+        Moves the recorded stdout and stderr and copies of the outputs into the entry for key,
+        then evicts the least recently used entries until the cache is within its size.
+        """
+        missing = [output for output in outputs if not os.path.exists(output)]
+        if missing:
+            logger.warning('Not caching, outputs %s were not written' % ', '.join(missing))
+            return
+
+        try:
+            makedirs(os.path.join(staging, OUTPUTS_DIR))
+            for index, output in enumerate(outputs):
+                copy_path(output, os.path.join(staging, OUTPUTS_DIR, str(index)))
+        except (IOError, OSError) as e:
+            logger.warning('Not caching, could not copy outputs: %s' % e)
+            return
+
+        size = get_tree_size(staging)
+        if size > self.size:
+            logger.warning('Not caching, the result is larger than the cache')
+            return
+
+        entry = self.get_entry_path(key)
+        makedirs(os.path.dirname(entry))
+
+        with self.index.update() as index:
+            if os.path.isdir(entry):
+                shutil.rmtree(entry)
+            os.rename(staging, entry)
+            index[key] = {'size': size, 'last_used': time.time()}
+
+            total = sum(e['size'] for e in index.values())
+            for evicted in sorted(index, key=lambda k: index[k]['last_used']):
+                if total <= self.size:
+                    break
+                total -= index.pop(evicted)['size']
+                shutil.rmtree(self.get_entry_path(evicted), ignore_errors=True)
+
+
+@contextmanager
+def record_output(stream, path):
+    """
+    Context manager copying everything written to stdout or stderr in its block to the file
+    at path.
+
+    When the stream is a regular file, the part of it written in the block is copied afterwards,
+    so that it can still be written to directly. Otherwise it is replaced by a pipe, which
+    is read by a thread that passes its data on to the original stream as it arrives.
+    """
+    fd = stream.fileno()
+    stream.flush()
+
+    if stat.S_ISREG(os.fstat(fd).st_mode):
+        start = os.lseek(fd, 0, os.SEEK_CUR)
+        if fcntl.fcntl(fd, fcntl.F_GETFL) & os.O_APPEND:
+            start = os.fstat(fd).st_size
+
+        yield
+
+        stream.flush()
+        with open('/proc/self/fd/%d' % fd, 'rb') as source, open(path, 'wb') as destination:
+            source.seek(start)
+            shutil.copyfileobj(source, destination)
+        return
+
+    read_fd, write_fd = os.pipe()
+    original = os.dup(fd)
+    os.dup2(write_fd, fd)
+    os.close(write_fd)
+
+    def tee():
+        with open(path, 'wb') as destination:
+            for chunk in iter(lambda: os.read(read_fd, CHUNK_SIZE), b''):
+                destination.write(chunk)
+                while chunk:
+                    chunk = chunk[os.write(original, chunk):]
+        os.close(read_fd)
+
+    thread = threading.Thread(target=tee)
+    thread.start()
+
+    try:
+        yield
+    finally:
+        stream.flush()
+        os.dup2(original, fd)
+        thread.join()
+        os.close(original)
@@ -0,0 +1,104 @@
+"""
+Thin dkr client, which hands the call over to a running dkr-agent, see agent.py.
+
+Only the standard library is imported here, so that a call which the agent serves
+doesn't pay for importing docker and yaml. When no agent is listening, or it can't
+serve the call, dkr runs in this process as usual.
+"""
+import os
+import sys
+import json
+import errno
+import signal
+import socket
+
+from launch import STATE_DIR
+
+AGENT_SOCKET = os.path.join(STATE_DIR, 'agent.sock')
+STDIO_FDS = [0, 1, 2]
+
+
+def connect(path=AGENT_SOCKET):
+    """
+    Connects to the agent listening at path.
+
+    :return: The connected socket, or None if no agent is listening
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        sock.connect(path)
+    except socket.error:
+        sock.close()
+        return None
+
+    return sock
+
+
+def run_with_agent(sock, args):
+    """
+    Asks the agent to run dkr with the given arguments in the current directory,
+    using the stdio of this process, and waits for it to finish.
+
+    Interrupting the client interrupts the run in the agent.
+
+    :return: The return code of the command, 1 if the agent went away without one,
+             or None if the agent couldn't serve the call
+    """
+    stream = sock.makefile('rwb', 0)
+
+    stream.write(json.dumps({'argv': args, 'cwd': os.getcwd()}).encode('utf-8') + b'\n')
+
+    reply = json.loads(stream.readline() or '{}')
+    if 'pid' not in reply:
+        return None
+
+    def forward(signum, frame):
+        try:
+            os.kill(reply['pid'], signal.SIGUSR1)
+        except OSError:
+            pass
+
+    for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+        signal.signal(signum, forward)
+
+    while True:
+        try:
+            line = stream.readline()
+            break
+        except (IOError, socket.error) as e:
+            # Interrupted by a forwarded signal
+            if e.errno != errno.EINTR:
+                raise
+
+    result = json.loads(line or '{}')
+
+    # The agent wrote to files through descriptors of its own, so catch up with where it stopped
+    for fd, offset in result.get('offsets', {}).items():
+        try:
+            os.lseek(int(fd), offset, os.SEEK_SET)
+        except OSError:
+            pass
+
+    return result.get('exit_code', 1)
+
+
+def run_main(args=sys.argv[1:]):
+    sock = connect()
+
+    if sock:
+        try:
+            rt = run_with_agent(sock, args)
+        finally:
+            sock.close()
+
+        if rt is not None:
+            return rt
+
+    from main import run_main as run_in_process
+
+    return run_in_process(args)
+
+
+if __name__ == '__main__':
+    sys.exit(run_main())
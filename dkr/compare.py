@@ -0,0 +1,210 @@
+"""
+Run one invocation on every version of an entrypoint at once, to compare their speed and output.
+
+    dkr-compare minimap2 -a ref.fa reads.fastq -o {outdir}/aln.sam
+
+or equivalently 'dkr minimap2::* ...'. Each version runs concurrently in its own container,
+with {outdir} in the invocation replaced by a directory of its own under the comparison
+directory, which also receives its stdout and stderr. The wall time, CPU time, peak memory and
+exit code of each version are then reported, and with --reorder the versions of the entrypoint
+are reordered by wall time, making the fastest which succeeded the default.
+
+Runs are accounted as with the history enabled, so they are also recorded in the history.
+"""
+import os
+import re
+import sys
+import argparse
+import threading
+
+from main import DKRConfig, COMPARE_SELECTOR, print_tabulate, errprint, format_size, logger
+from api import Session
+from history import format_duration
+from state import makedirs
+
+OUTDIR_PLACEHOLDER = '{outdir}'
+DEFAULT_DIRECTORY = 'dkr-compare'
+
+
+def get_version_directory(directory, version):
+    """
+    Gets the output directory of a version, named after its image reference.
+    """
+    return os.path.join(os.path.abspath(directory), re.sub(r'[^\w.-]+', '_', version))
+
+
+def compare_versions(config, entrypoint, versions, invocation, directory=DEFAULT_DIRECTORY,
+                     jobs=None, profile=None):
+    """
+    Runs the invocation on each version of the entrypoint, at most jobs at once.
+
+    :return: List of dicts of the 'version', its output 'directory', the 'run', the 'usage' of the
+             run, see RunAccounting.finish, and the 'error' which stopped it from running, if any
+    """
+    settings = config.get_settings(entrypoint)
+    overrides = {'history': dict(settings.get('history') or {}, enabled=True)}
+
+    slots = threading.Semaphore(jobs or len(versions))
+    results = []
+    streams = []
+
+    try:
+        with Session(config) as session:
+            for version in versions:
+                outdir = get_version_directory(directory, version)
+                makedirs(outdir)
+
+                args = [arg.replace(OUTDIR_PLACEHOLDER, outdir) for arg in invocation]
+                stdout = open(os.path.join(outdir, 'stdout'), 'wb')
+                stderr = open(os.path.join(outdir, 'stderr'), 'wb')
+                streams.extend([stdout, stderr])
+
+                slots.acquire()
+                run = session.start(config.join_entrypoint(entrypoint, version), args,
+                                    stdout=stdout, stderr=stderr, profile=profile,
+                                    settings=overrides)
+                run.add_done_callback(lambda run: slots.release())
+
+                results.append({'version': version, 'directory': outdir, 'run': run,
+                                'error': None})
+
+            for result in results:
+                try:
+                    result['run'].wait()
+                except (Exception, SystemExit) as e:
+                    result['error'] = e
+    finally:
+        for stream in streams:
+            stream.close()
+
+    for result in results:
+        container = result['run'].container
+        result['usage'] = (container and container.usage) or {}
+
+    return results
+
+
+def succeeded(result):
+    return result['error'] is None and result['run'].returncode == 0
+
+
+def rank_results(results):
+    """
+    Orders the results by the wall time of their runs, those which failed last in their
+    current order.
+    """
+    return (sorted([r for r in results if succeeded(r)],
+                   key=lambda r: r['usage'].get('wall_time')) +
+            [r for r in results if not succeeded(r)])
+
+
+def main(entrypoint, invocation, directory=DEFAULT_DIRECTORY, jobs=None, reorder=False,
+         profile=None, config=None):
+    """
+    dkr-compare Main function.
+
+    :return: 0 if every version succeeded, otherwise 1
+    """
+    config = config or DKRConfig()
+    entrypoint_val = config.get_entrypoint(entrypoint)
+
+    if not entrypoint_val or not entrypoint_val.get('versions'):
+        errprint('dkr-compare: %s is not an entrypoint in your config.' % entrypoint)
+        return 1
+
+    versions = list(entrypoint_val['versions'])
+
+    try:
+        results = compare_versions(config, entrypoint, versions, invocation, directory=directory,
+                                   jobs=jobs, profile=profile)
+    except KeyError as e:
+        logger.error(e.args[0])
+        return 1
+
+    ranked = rank_results(results)
+
+    rows = []
+    for result in ranked:
+        usage = result['usage']
+        if result['error'] is not None:
+            status = 'error: %s' % result['error']
+        else:
+            status = result['run'].returncode
+
+        rows.append([result['version'], status, format_duration(usage.get('wall_time')),
+                     format_duration(usage.get('cpu_time')), format_size(usage.get('peak_memory')),
+                     os.path.relpath(result['directory'])])
+
+    print_tabulate(['Version', 'Exit code', 'Wall', 'CPU', 'Peak memory', 'Output'], rows,
+                   print_total_rows=False)
+
+    order = [result['version'] for result in ranked]
+    if reorder and order != versions:
+        config.reorder_entrypoint_versions(entrypoint, order)
+        config.write()
+        print('\nThe default version of %s is now %s' % (entrypoint, order[0]))
+
+    return 0 if all(succeeded(result) for result in results) else 1
+
+
+def parse_arguments(argv):
+    """
+    Parse command-line arguments
+
+    :param argv: command line arguments
+    :return: parsed command-line arguments (argparse)
+    """
+    description = ('Run the same invocation on every version of an entrypoint concurrently, and '
+                   'report the wall time, CPU time, peak memory and exit code of each. '
+                   '%s in the invocation is replaced by a directory of its own for each version.'
+                   % OUTDIR_PLACEHOLDER)
+
+    parser = argparse.ArgumentParser(description=description)
+
+    parser.add_argument('ENTRYPOINT',
+                        help='Entrypoint whose versions to compare, optionally as ENTRYPOINT::%s'
+                             % COMPARE_SELECTOR)
+
+    parser.add_argument('INVOCATION',
+                        nargs=argparse.REMAINDER,
+                        help='Arguments of the entrypoint')
+
+    parser.add_argument('-d',
+                        '--directory',
+                        default=DEFAULT_DIRECTORY,
+                        help='Directory for the output of each version, %s by default'
+                             % DEFAULT_DIRECTORY)
+
+    parser.add_argument('-j',
+                        '--jobs',
+                        type=int,
+                        help='Number of versions to run at once, all of them by default')
+
+    parser.add_argument('-r',
+                        '--reorder',
+                        action='store_true',
+                        help='Reorder the versions by wall time, making the fastest the default')
+
+    parser.add_argument('-p',
+                        '--profile',
+                        help='Name of the run profile to use')
+
+    args = parser.parse_args(argv)
+
+    return args
+
+
+def run_main(args=sys.argv[1:]):
+    args = parse_arguments(args)
+
+    entrypoint = args.ENTRYPOINT
+    selector = DKRConfig.ENTRYPOINT_DELIM + COMPARE_SELECTOR
+    if entrypoint.endswith(selector):
+        entrypoint = entrypoint[:-len(selector)]
+
+    return main(entrypoint, args.INVOCATION, directory=args.directory, jobs=args.jobs,
+                reorder=args.reorder, profile=args.profile)
+
+
+if __name__ == '__main__':
+    sys.exit(run_main())
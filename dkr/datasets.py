@@ -0,0 +1,342 @@
+"""
+Named datasets, such as reference genomes and their indexes, shared by many runs.
+
+Datasets are declared under the settings in the config, or for a single entrypoint, e.g.
+
+_settings:
+  datasets:
+    grch38:
+      path: /nfs/ref/GRCh38
+      prewarm: true
+
+Each dataset is mounted into every container as a single volume at /datasets/<name>,
+read-only unless 'read_only' is false, and arguments which are paths under a dataset are
+rewritten to point into it, rather than each being mounted on its own.
+
+Datasets with 'prewarm' are read into the page cache in the background when dkr-flow starts
+a workflow, so that its runs read them from memory rather than from a network filesystem.
+
+    dkr-dataset list
+    dkr-dataset prewarm grch38
+    dkr-dataset prewarm --lock grch38
+
+'prewarm --lock' also locks the datasets in memory until it is stopped, which needs a high
+enough RLIMIT_MEMLOCK, see 'ulimit -l'.
+"""
+import os
+import re
+import sys
+import mmap
+import errno
+import ctypes
+import ctypes.util
+import signal
+import logging
+import argparse
+import threading
+
+from multiprocessing.pool import ThreadPool
+
+from launch import DATASET_ROOT
+
+logger = logging.getLogger()
+
+DATASET_KEYS = ['path', 'read_only', 'prewarm']
+DATASET_NAME = re.compile(r'^[\w.-]+$')
+PREWARM_THREADS = 4
+READ_SIZE = 1024 * 1024
+
+PROT_READ = 1
+MAP_SHARED = 1
+MAP_FAILED = ctypes.c_void_p(-1).value
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+_libc.mmap.restype = ctypes.c_void_p
+_libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int,
+                       ctypes.c_int, ctypes.c_long]
+_libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+_libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.POINTER(ctypes.c_ubyte)]
+_libc.mlock.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+
+
+def validate_datasets(datasets):
+    """
+    Checks that each dataset has a valid name, a path and only known options.
+    """
+    if not isinstance(datasets or {}, dict):
+        raise KeyError('Datasets must map names to datasets')
+
+    for name, dataset in (datasets or {}).items():
+        if not DATASET_NAME.match(name):
+            raise KeyError('Dataset name %s may only contain letters, digits, _, . and -' % name)
+
+        if not isinstance(dataset, dict) or not dataset.get('path'):
+            raise KeyError('Dataset %s has no path' % name)
+
+        unknown = set(dataset) - set(DATASET_KEYS)
+        if unknown:
+            raise KeyError('Dataset %s has unknown options %s, expected %s' % (
+                name, ', '.join(sorted(unknown)), ', '.join(DATASET_KEYS)))
+
+
+def get_datasets(settings):
+    """
+    Gets the datasets in the settings, with their paths made absolute and options defaulted.
+
+    :param settings: Dict of settings, see DKRConfig.get_settings
+    :return: Dict mapping the name of each dataset to a dict of its 'path', 'bind', the path
+             it is mounted at, 'read_only' and 'prewarm'
+    """
+    return dict((name, {
+        'path': os.path.abspath(os.path.expanduser(dataset['path'])),
+        'bind': '/'.join([DATASET_ROOT, name]),
+        'read_only': dataset.get('read_only', True),
+        'prewarm': dataset.get('prewarm', False)
+    }) for name, dataset in ((settings or {}).get('datasets') or {}).items())
+
+
+def iter_files(path):
+    """
+    Yields the regular files at or under path.
+    """
+    if os.path.isfile(path):
+        yield path
+        return
+
+    for directory, _, names in os.walk(path):
+        for name in sorted(names):
+            file_path = os.path.join(directory, name)
+            if os.path.isfile(file_path) and not os.path.islink(file_path):
+                yield file_path
+
+
+def map_file(path):
+    """
+    Maps a file into memory, read-only.
+
+    :return: tuple of the address of the mapping and its length, or None if the file is empty
+    """
+    with open(path, 'rb') as stream:
+        size = os.fstat(stream.fileno()).st_size
+        if not size:
+            return None
+
+        address = _libc.mmap(None, size, PROT_READ, MAP_SHARED, stream.fileno(), 0)
+
+    if address in (None, MAP_FAILED):
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error), path)
+
+    return address, size
+
+
+def get_cached_size(path):
+    """
+    Measures how much of a file is in the page cache, as vmtouch does.
+
+    :return: The number of bytes cached
+    """
+    mapping = map_file(path)
+    if not mapping:
+        return 0
+
+    address, size = mapping
+    try:
+        pages = (size + mmap.PAGESIZE - 1) // mmap.PAGESIZE
+        vector = (ctypes.c_ubyte * pages)()
+        if _libc.mincore(address, size, vector):
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+
+        return min(sum(page & 1 for page in vector) * mmap.PAGESIZE, size)
+    finally:
+        _libc.munmap(address, size)
+
+
+def prewarm_file(path):
+    """
+    Reads a file into the page cache.
+
+    :return: The number of bytes read
+    """
+    read = 0
+
+    with open(path, 'rb', 0) as stream:
+        while True:
+            chunk = stream.read(READ_SIZE)
+            if not chunk:
+                return read
+            read += len(chunk)
+
+
+def lock_file(path):
+    """
+    Maps a file and locks it in memory, reading it into the page cache if it isn't already,
+    for as long as this process lives.
+
+    :return: The number of bytes locked
+    """
+    mapping = map_file(path)
+    if not mapping:
+        return 0
+
+    address, size = mapping
+    if _libc.mlock(address, size):
+        error = ctypes.get_errno()
+        _libc.munmap(address, size)
+        raise OSError(error, os.strerror(error), path)
+
+    return size
+
+
+def prewarm_datasets(datasets, lock=False, threads=PREWARM_THREADS):
+    """
+    Reads every file of the datasets into the page cache, several files at once,
+    skipping those which are cached already unless they are to be locked.
+
+    :param datasets: Dict of datasets, see get_datasets
+    :param lock: Whether to lock the files in memory, for as long as this process lives
+    :return: The number of bytes read or locked
+    """
+    def prewarm(path):
+        try:
+            if lock:
+                return lock_file(path)
+            if get_cached_size(path) >= os.path.getsize(path):
+                return 0
+            return prewarm_file(path)
+        except (IOError, OSError) as e:
+            if lock and e.errno in (errno.ENOMEM, errno.EPERM, errno.EAGAIN):
+                raise
+            logger.warning('Could not prewarm %s: %s' % (path, e))
+            return 0
+
+    paths = [path for dataset in datasets.values() for path in iter_files(dataset['path'])]
+    if not paths:
+        return 0
+
+    pool = ThreadPool(min(threads, len(paths)))
+    try:
+        return sum(pool.map(prewarm, paths))
+    finally:
+        pool.terminate()
+
+
+def start_prewarm(settings):
+    """
+    Prewarms the datasets in the settings which have 'prewarm' set, in a background thread.
+
+    :return: The thread, or None if there is nothing to prewarm
+    """
+    datasets = dict((name, dataset) for name, dataset in get_datasets(settings).items()
+                    if dataset['prewarm'])
+    if not datasets:
+        return None
+
+    thread = threading.Thread(target=prewarm_datasets, args=(datasets,))
+    thread.daemon = True
+    thread.start()
+
+    return thread
+
+
+def get_dataset_status(dataset):
+    """
+    :return: tuple of the total size of the files of a dataset and how much of it is cached
+    """
+    size, cached = 0, 0
+
+    for path in iter_files(dataset['path']):
+        try:
+            size += os.path.getsize(path)
+            cached += get_cached_size(path)
+        except (IOError, OSError):
+            pass
+
+    return size, cached
+
+
+def main(args):
+    """
+    dkr-dataset Main function.
+    """
+    # Imported here as main itself builds on this module
+    from main import DKRConfig, print_tabulate, errprint, format_size
+
+    datasets = get_datasets(DKRConfig().get_settings())
+
+    unknown = [name for name in getattr(args, 'NAME', None) or [] if name not in datasets]
+    if unknown:
+        errprint('dkr-dataset: %s not in your config.' % ', '.join(unknown))
+        return 1
+
+    if args.command == 'list':
+        rows = []
+        for name, dataset in sorted(datasets.items()):
+            size, cached = get_dataset_status(dataset) if os.path.exists(dataset['path']) \
+                else (None, None)
+            rows.append([name, dataset['path'], dataset['bind'],
+                         'ro' if dataset['read_only'] else 'rw', dataset['prewarm'],
+                         format_size(size), format_size(cached)])
+
+        print_tabulate(['Name', 'Path', 'Mounted at', 'Mode', 'Prewarm', 'Size', 'Cached'], rows)
+        return 0
+
+    elif args.command == 'prewarm':
+        selected = dict((name, datasets[name]) for name in args.NAME or datasets)
+
+        try:
+            size = prewarm_datasets(selected, lock=args.lock, threads=args.threads)
+        except (IOError, OSError) as e:
+            errprint('dkr-dataset: Could not lock %s in memory: %s, see ulimit -l'
+                     % (e.filename, e.strerror))
+            return 1
+
+        if not args.lock:
+            errprint('dkr-dataset: Read %s into the page cache' % format_size(size))
+            return 0
+
+        errprint('dkr-dataset: Locked %s in memory until stopped' % format_size(size))
+        for signum in [signal.SIGINT, signal.SIGTERM, signal.SIGHUP]:
+            signal.signal(signum, lambda signum, frame: sys.exit(0))
+        while True:
+            signal.pause()
+
+
+def parse_arguments(argv):
+    """
+    Parse command-line arguments
+
+    :param argv: command line arguments
+    :return: parsed command-line arguments (argparse)
+    """
+    description = ('List the datasets in your dkr config and how much of each is in the page '
+                   'cache, and prewarm them into it.')
+
+    parser = argparse.ArgumentParser(description=description)
+    subparsers = parser.add_subparsers(dest='command')
+
+    subparsers.add_parser('list', help='List the datasets, their size and how much is cached')
+
+    prewarm_parser = subparsers.add_parser(
+        'prewarm', help='Read datasets into the page cache, all of them by default')
+    prewarm_parser.add_argument('NAME', nargs='*', help='Names of the datasets to prewarm')
+    prewarm_parser.add_argument('-l', '--lock', action='store_true',
+                                help='Lock the datasets in memory until stopped')
+    prewarm_parser.add_argument('-j', '--threads', type=int, default=PREWARM_THREADS,
+                                help='Number of files to read at once, %d by default'
+                                     % PREWARM_THREADS)
+
+    args = parser.parse_args(argv)
+
+    return args
+
+
+def run_main(args=sys.argv[1:]):
+    args = parse_arguments(args)
+
+    return main(args)
+
+
+if __name__ == '__main__':
+    sys.exit(run_main())
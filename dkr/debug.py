@@ -7,7 +7,7 @@ import logging
 
 from main import main as dkr_main
 from main import (ACTIVE_CONTAINER, DKRConfig, DKRContainer,
-                  logger, errprint, shutdown, signal_handler)
+                  SHUTDOWN_SIGNALS, logger, errprint, shutdown, signal_handler)
 
 
 def parse_arguments(argv):
@@ -48,27 +48,28 @@ def parse_arguments(argv):
     return args
 
 
-def noinvoke(image, invocation):
+def noinvoke(image, invocation, settings=None):
     """
     Run dkr-debug in noinvoke mode. This mode prints the invocation without running it.
     """
-    command = DKRContainer(image, invocation, flags=[])
+    command = DKRContainer(image, invocation, flags=[], settings=settings)
     errprint(" ".join(command.invocation))
 
 
-def interactive(image, invocation):
+def interactive(image, invocation, settings=None):
     """
     Run dkr-debug in noinvoke mode. This mode prints the invocation and drops the user
     into an interactive shell.
     """
     global ACTIVE_CONTAINER
 
-    command = DKRContainer(image, invocation, flags=[])
+    command = DKRContainer(image, invocation, flags=[], settings=settings)
     container = command.launch_container()
     errprint(" ".join(command.invocation))
     ACTIVE_CONTAINER = container
 
-    signal.signal(signal.SIGINT, signal_handler)
+    for signum in SHUTDOWN_SIGNALS:
+        signal.signal(signum, signal_handler)
     rt = command._execute_command(container.id, ['bash'], flags=['-t', '-i'])
     shutdown(container)
 
@@ -87,12 +88,12 @@ def main(base, invocation, mode=None):
     """
     if mode:
         config = DKRConfig()
-        image = config.get_entrypoint_default_version(base)
+        entrypoint, image = config.resolve(base)
 
-        if image:
-            invocation = [base] + invocation
+        if entrypoint:
+            invocation = [entrypoint] + invocation
 
-        mode_mapping[mode](image or base, invocation)
+        mode_mapping[mode](image, invocation, settings=config.get_settings(entrypoint))
         return
 
     # By default, DKR will only log errors
@@ -0,0 +1,450 @@
+"""
+Run a workflow of dkr steps, running independent steps in parallel.
+
+A workflow is a YAML file of named steps, e.g.
+
+cores: 16
+steps:
+  index:
+    entrypoint: bwa
+    args: index ref.fa
+    inputs: [ref.fa]
+    outputs: [ref.fa.bwt]
+  align_a:
+    entrypoint: bwa
+    args: mem -t 8 ref.fa a.fastq
+    inputs: [a.fastq]
+    stdout: a.sam
+    after: [index]
+    cpus: 8
+  align_b:
+    entrypoint: bwa
+    args: mem -t 8 ref.fa b.fastq
+    inputs: [b.fastq]
+    stdout: b.sam
+    after: [index]
+    cpus: 8
+  merge:
+    entrypoint: samtools
+    args: merge merged.bam a.sam b.sam
+    inputs: [a.sam, b.sam]
+    outputs: [merged.bam]
+
+A step may set:
+    entrypoint: Entrypoint in the config, an entrypoint with a version selected, or an image
+    args: Arguments of the entrypoint, as a list or as a string split like a shell would
+    inputs: Paths the step reads
+    outputs: Paths the step writes
+    stdin: Path of a file to use as the stdin of the step, which is also an input
+    stdout: Path of a file to write the stdout of the step to, which is also an output
+    after: Names of the steps which must finish first
+    cpus: Number of CPUs the step uses, defaults to its resource limit or 1
+    profile: Name of the run profile to use
+
+Steps also wait for the steps whose outputs are among their inputs. Steps whose
+dependencies have finished run as soon as their CPUs fit in the core budget, which
+defaults to the CPUs dkr-flow may run on. Paths are relative to the directory of the
+workflow file.
+
+Steps whose outputs all exist and are newer than their inputs are skipped, and the
+outputs of a failed step are removed, so running the workflow again after a failure
+picks up where it stopped.
+
+Datasets with prewarm set in the config are read into the page cache in the background as
+the workflow starts, see datasets.py.
+"""
+import os
+import sys
+import time
+import yaml
+import shlex
+import Queue
+import shutil
+import argparse
+import threading
+
+from main import DKRConfig, DKRContainer, errprint, record_image_use
+from profiles import get_profile
+from resources import get_allowed_cpus
+from datasets import start_prewarm
+
+STEP_KEYS = ['entrypoint', 'args', 'inputs', 'outputs', 'stdin', 'stdout', 'after', 'cpus',
+             'profile']
+
+DONE = 'done'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+BLOCKED = 'blocked'
+
+# How often the scheduler wakes up while waiting for steps, so that it can be interrupted
+WAIT_INTERVAL = 0.5
+
+
+class Step:
+    """
+    A step of a workflow.
+    """
+
+    def __init__(self, name, entrypoint, args=None, inputs=None, outputs=None, stdin=None,
+                 stdout=None, after=None, cpus=None, profile=None):
+        self.name = name
+        self.entrypoint = entrypoint
+        self.args = [str(a) for a in args] if isinstance(args, list) else shlex.split(args or '')
+        self.stdin = stdin
+        self.stdout = stdout
+        self.inputs = list(inputs or []) + ([stdin] if stdin else [])
+        self.outputs = list(outputs or []) + ([stdout] if stdout else [])
+        self.after = list(after or [])
+        self.cpus = cpus
+        self.profile = profile
+        self.container = None
+
+    def is_up_to_date(self):
+        """
+        Checks whether the step has outputs which all exist and are newer than its inputs.
+        """
+        if not self.outputs or not all(os.path.exists(path) for path in self.outputs):
+            return False
+
+        inputs = [os.path.getmtime(path) for path in self.inputs if os.path.exists(path)]
+        outputs = [os.path.getmtime(path) for path in self.outputs]
+
+        return not inputs or min(outputs) >= max(inputs)
+
+    def remove_outputs(self):
+        """
+        Removes whatever the step wrote of its outputs.
+        """
+        for path in self.outputs:
+            try:
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                elif os.path.exists(path):
+                    os.remove(path)
+            except OSError as e:
+                errprint('dkr-flow: Could not remove %s: %s' % (path, e))
+
+
+def load_workflow(path):
+    """
+    Loads the steps of the workflow file at path, in an order in which
+    every step comes after the steps it depends on.
+
+    :return: tuple of the core budget given by the workflow, or None, and the list of Step
+    """
+    with open(path) as stream:
+        workflow = yaml.safe_load(stream) or {}
+
+    steps = []
+    for name, step in (workflow.get('steps') or {}).items():
+        step = step or {}
+
+        unknown = set(step) - set(STEP_KEYS)
+        if unknown:
+            raise KeyError('Step %s has unknown options %s, expected %s' % (
+                name, ', '.join(sorted(unknown)), ', '.join(STEP_KEYS)))
+
+        if not step.get('entrypoint'):
+            raise KeyError('Step %s has no entrypoint' % name)
+
+        steps.append(Step(name, **step))
+
+    producers = dict((os.path.abspath(path), step.name) for step in steps for path in step.outputs)
+
+    for step in steps:
+        unknown = set(step.after) - set(s.name for s in steps)
+        if unknown:
+            raise KeyError('Step %s runs after unknown steps %s' % (
+                step.name, ', '.join(sorted(unknown))))
+
+        for path in step.inputs:
+            producer = producers.get(os.path.abspath(path))
+            if producer and producer != step.name and producer not in step.after:
+                step.after.append(producer)
+
+    return workflow.get('cores'), sort_steps(steps)
+
+
+def sort_steps(steps):
+    """
+    Orders the steps so that each comes after the steps it depends on,
+    and otherwise by name.
+    """
+    ordered = []
+    names = set()
+    remaining = sorted(steps, key=lambda s: s.name)
+
+    while remaining:
+        ready = [step for step in remaining if set(step.after) <= names]
+        if not ready:
+            raise ValueError('Steps %s depend on each other' % ', '.join(s.name for s in remaining))
+
+        for step in ready:
+            ordered.append(step)
+            names.add(step.name)
+            remaining.remove(step)
+
+    return ordered
+
+
+def run_step(step, config, cpus):
+    """
+    Runs a step in a container, the same way dkr would, and waits for it to finish.
+
+    :param step: Step
+    :param config: DKRConfig
+    :param cpus: Number of CPUs the step has been given
+    :return: The exit code of the step
+    """
+    entrypoint, image = config.resolve(step.entrypoint)
+    invocation = ([entrypoint] if entrypoint else []) + list(step.args)
+
+    settings = config.get_settings(entrypoint)
+    if step.profile:
+        settings['profile'] = step.profile
+
+    # Hold the step to the CPUs it has been given
+    resources = settings.get('resources') or {}
+    if isinstance(resources, dict) and 'cpus' not in resources:
+        settings['resources'] = dict(resources, cpus=cpus)
+
+    stdin = open(step.stdin, 'rb') if step.stdin else open(os.devnull, 'rb')
+    stdout = open(step.stdout, 'wb') if step.stdout else None
+
+    try:
+        step.container = DKRContainer(image, invocation, flags=None, settings=settings,
+                                      stdin=stdin, stdout=stdout, entrypoint=entrypoint)
+        step.container.launch_container()
+
+        try:
+            rt = step.container.execute_command()
+        finally:
+            step.container.remove_container()
+    finally:
+        stdin.close()
+        if stdout:
+            stdout.close()
+
+    record_image_use(image)
+
+    return rt
+
+
+def get_step_cpus(step, config):
+    """
+    Gets the number of CPUs a step uses, defaulting to its resource limit or 1.
+    """
+    if step.cpus:
+        return float(step.cpus)
+
+    entrypoint, _ = config.resolve(step.entrypoint)
+    resources = config.get_settings(entrypoint).get('resources')
+
+    if isinstance(resources, dict) and resources.get('cpus') not in (None, 'auto'):
+        return float(resources['cpus'])
+
+    return 1.0
+
+
+def run_workflow(steps, cores, config=None, keep_going=False):
+    """
+    Runs the steps, each in its own thread, as soon as their dependencies have
+    finished and their CPUs fit within the core budget.
+
+    :param steps: List of Step, ordered as returned by load_workflow
+    :param cores: Core budget
+    :param keep_going: Keep starting steps which don't depend on a failed step
+    :return: Dict mapping the name of each step to its state
+    """
+    config = config or DKRConfig()
+    states = {}
+    running = {}
+    pending = list(steps)
+    finished = Queue.Queue()
+    free = float(cores)
+
+    def target(step, cpus):
+        try:
+            rt = run_step(step, config, cpus)
+        except (Exception, SystemExit) as e:
+            errprint('dkr-flow: %s could not run: %s' % (step.name, e))
+            rt = 1
+        finished.put((step, rt))
+
+    try:
+        while pending or running:
+            failed = FAILED in states.values()
+
+            for step in list(pending):
+                dependencies = [states.get(name) for name in step.after]
+
+                if FAILED in dependencies or BLOCKED in dependencies:
+                    states[step.name] = BLOCKED
+                    pending.remove(step)
+                    errprint('dkr-flow: %s blocked, a step it depends on failed' % step.name)
+                    continue
+
+                if not all(state in (DONE, SKIPPED) for state in dependencies):
+                    continue
+
+                if step.is_up_to_date():
+                    states[step.name] = SKIPPED
+                    pending.remove(step)
+                    errprint('dkr-flow: %s skipped, its outputs are up to date' % step.name)
+                    continue
+
+                cpus = min(get_step_cpus(step, config), float(cores))
+                if (failed and not keep_going) or cpus > free:
+                    continue
+
+                free -= cpus
+                pending.remove(step)
+                running[step.name] = (step, cpus, time.time())
+                errprint('dkr-flow: %s started' % step.name)
+
+                thread = threading.Thread(target=target, args=(step, cpus))
+                thread.daemon = True
+                thread.start()
+
+            if not running:
+                break
+
+            try:
+                step, rt = finished.get(timeout=WAIT_INTERVAL)
+            except Queue.Empty:
+                continue
+
+            _, cpus, started = running.pop(step.name)
+            free += cpus
+
+            if rt == 0:
+                states[step.name] = DONE
+                errprint('dkr-flow: %s done in %.1fs' % (step.name, time.time() - started))
+            else:
+                states[step.name] = FAILED
+                step.remove_outputs()
+                errprint('dkr-flow: %s failed with exit code %s' % (step.name, rt))
+
+    except KeyboardInterrupt:
+        errprint('dkr-flow: Interrupted, stopping %s' % ', '.join(sorted(running)))
+
+        for step, _, _ in running.values():
+            if step.container:
+                step.container.remove_container()
+
+        while running:
+            step, _ = finished.get()
+            running.pop(step.name)
+            states[step.name] = FAILED
+            step.remove_outputs()
+
+        raise
+
+    for step in pending:
+        states.setdefault(step.name, BLOCKED)
+
+    return states
+
+
+def plan_workflow(steps):
+    """
+    Works out which steps would run, given which of them are up to date.
+
+    :return: List of the names of the steps which would run, in order
+    """
+    would_run = []
+
+    for step in steps:
+        if set(step.after) & set(would_run) or not step.is_up_to_date():
+            would_run.append(step.name)
+
+    return would_run
+
+
+def main(path, cores=None, keep_going=False, dry_run=False):
+    """
+    dkr-flow Main function.
+
+    :param path: Path of the workflow file
+    :param cores: Core budget, overriding the workflow's, defaults to the CPUs available
+    :param keep_going: Keep starting steps which don't depend on a failed step
+    :param dry_run: Only print the steps which would run
+    :return: 0 if every step is done or up to date, otherwise 1
+    """
+    try:
+        workflow_cores, steps = load_workflow(path)
+    except (IOError, KeyError, ValueError) as e:
+        errprint('dkr-flow: %s' % e)
+        return 1
+
+    os.chdir(os.path.dirname(os.path.abspath(path)))
+
+    if dry_run:
+        for name in plan_workflow(steps):
+            print(name)
+        return 0
+
+    config = DKRConfig()
+    for step in steps:
+        settings = config.get_settings(config.resolve(step.entrypoint)[0])
+        try:
+            get_profile(step.profile or settings.get('profile'), settings.get('profiles'))
+        except KeyError as e:
+            errprint('dkr-flow: Step %s: %s' % (step.name, e.args[0]))
+            return 1
+
+    cores = cores or workflow_cores or len(get_allowed_cpus())
+    start_prewarm(config.get_settings())
+
+    try:
+        states = run_workflow(steps, cores, config=config, keep_going=keep_going)
+    except KeyboardInterrupt:
+        return 130
+
+    return 0 if all(state in (DONE, SKIPPED) for state in states.values()) else 1
+
+
+def parse_arguments(argv):
+    """
+    Parse command-line arguments
+
+    :param argv: command line arguments
+    :return: parsed command-line arguments (argparse)
+    """
+    description = ('Run a workflow of dkr steps, running steps in parallel once the steps '
+                   'they depend on have finished, and skipping steps which are up to date.')
+
+    parser = argparse.ArgumentParser(description=description)
+
+    parser.add_argument('WORKFLOW',
+                        action='store',
+                        help='Path of the workflow file')
+
+    parser.add_argument('-c',
+                        '--cores',
+                        type=float,
+                        help='Number of CPUs to share between the running steps')
+
+    parser.add_argument('-k',
+                        '--keep-going',
+                        action='store_true',
+                        help='Keep running the steps which do not depend on a failed step')
+
+    parser.add_argument('-n',
+                        '--dry-run',
+                        action='store_true',
+                        help='Only print the steps which would run')
+
+    args = parser.parse_args(argv)
+
+    return args
+
+
+def run_main(args=sys.argv[1:]):
+    args = parse_arguments(args)
+
+    return main(args.WORKFLOW, cores=args.cores, keep_going=args.keep_going, dry_run=args.dry_run)
+
+
+if __name__ == '__main__':
+    sys.exit(run_main())
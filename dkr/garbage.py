@@ -0,0 +1,174 @@
+"""
+Reclaim disk space by removing the least recently used images in your dkr config.
+"""
+import sys
+import docker
+import argparse
+
+from docker.errors import APIError
+
+from main import (DKRConfig, print_tabulate, errprint, format_size, format_time, parse_size,
+                  canonical_image_reference, get_local_image_index, load_image_metadata,
+                  update_image_metadata)
+
+
+def collect_images(config, index, metadata):
+    """
+    Groups the local image references in the config by image, since the space
+    used by an image is only reclaimed once all of its tags have been removed.
+
+    :param config: DKRConfig
+    :param index: Local image index, as returned by get_local_image_index
+    :param metadata: Cached image metadata, as returned by load_image_metadata
+    :return: List of images, least recently used first
+    """
+    defaults = set(config.get_entrypoint_default_version(e) for e in config.get_entrypoints())
+    images = {}
+
+    for reference, local in index.items():
+        image = images.setdefault(local['id'], {
+            'size': local['size'],
+            'tags': local['tags'],
+            'references': [],
+            'last_used': None,
+            'created': local['created'],
+            'default': False
+        })
+
+        last_used = (metadata.get(reference) or {}).get('last_used')
+
+        image['references'].append(reference)
+        image['last_used'] = max(image['last_used'] or 0, last_used or 0) or None
+        image['default'] = image['default'] or reference in defaults
+
+    # Images which have never been run by dkr are treated as last used when they were built
+    return sorted(images.values(), key=lambda i: i['last_used'] or i['created'])
+
+
+def select_evictions(images, budget, force=False):
+    """
+    Selects the least recently used images to remove until the total size of the
+    images falls within budget.
+
+    Images assigned as an entrypoint's default are kept unless force is True, as are
+    images which are also tagged with references that are not in the config. The reason
+    for keeping or evicting each image is set to its 'action'.
+
+    :return: List of the images to evict
+    """
+    total = sum(image['size'] for image in images)
+    evictions = []
+
+    for image in images:
+        managed = set(canonical_image_reference(r) for r in image['references'])
+
+        if total <= budget:
+            image['action'] = 'keep'
+        elif image['default'] and not force:
+            image['action'] = 'keep (default)'
+        elif set(image['tags']) - managed:
+            image['action'] = 'keep (tagged outside dkr)'
+        else:
+            image['action'] = 'evict'
+            evictions.append(image)
+            total -= image['size']
+
+    return evictions
+
+
+def main(budget, dry_run=False, force=False):
+    """
+    dkr-gc Main function.
+
+    Removes the least recently used images referenced by the dkr config until
+    the total size of the local images referenced by the config is within budget.
+
+    :param budget: Disk budget in bytes
+    :param dry_run: Only report what would be removed
+    :param force: Allow removing the default images of entrypoints
+    """
+    config = DKRConfig()
+
+    if not config.get_entrypoints():
+        errprint('dkr-gc: Nothing to do, the config is empty.')
+        return
+
+    client = docker.from_env()
+    versions = [version for entrypoint in config.get_entrypoints()
+                for version in config.get_entrypoint(entrypoint)['versions']]
+    index = get_local_image_index(client, versions)
+
+    images = collect_images(config, index, load_image_metadata())
+    evictions = select_evictions(images, budget, force=force)
+
+    rows = []
+    for image in images:
+        action = 'would evict' if dry_run and image['action'] == 'evict' else image['action']
+        rows.append(["\n".join(image['references']), format_size(image['size']),
+                     format_time(image['last_used']), action])
+
+    print_tabulate(['Images', 'Size', 'Last used', 'Action'], rows, print_total_rows=False)
+
+    total = sum(image['size'] for image in images)
+    reclaimed = sum(image['size'] for image in evictions)
+    print('\n%s %s of %s, budget %s' % (
+        'Would reclaim' if dry_run else 'Reclaiming', format_size(reclaimed),
+        format_size(total), format_size(budget)))
+
+    if total - reclaimed > budget:
+        errprint('dkr-gc: Could not get within budget, the remaining images are kept for the reasons shown.')
+
+    if dry_run:
+        return
+
+    for image in evictions:
+        for reference in image['references']:
+            try:
+                client.images.remove(reference)
+            except APIError as e:
+                errprint('dkr-gc: Could not remove %s: %s' % (reference, e))
+
+    update_image_metadata(versions, get_local_image_index(client, versions))
+
+
+def parse_arguments(argv):
+    """
+    Parse command-line arguments
+
+    :param argv: command line arguments
+    :return: parsed command-line arguments (argparse)
+    """
+    description = ('Remove the least recently used images in your dkr config until the local '
+                   'images it references fit within a disk budget. Sizes include layers shared '
+                   'between images, so the space actually reclaimed may be smaller.')
+
+    parser = argparse.ArgumentParser(description=description)
+
+    parser.add_argument('BUDGET',
+                        action='store',
+                        type=parse_size,
+                        help='Disk budget, e.g. 50G')
+
+    parser.add_argument('-n',
+                        '--dry-run',
+                        action='store_true',
+                        help='Only report which images would be removed')
+
+    parser.add_argument('-f',
+                        '--force',
+                        action='store_true',
+                        help='Allow removing the default image of an entrypoint')
+
+    args = parser.parse_args(argv)
+
+    return args
+
+
+def run_main(args=sys.argv[1:]):
+    args = parse_arguments(args)
+
+    return main(args.BUDGET, dry_run=args.dry_run, force=args.force)
+
+
+if __name__ == '__main__':
+    run_main()
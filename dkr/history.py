@@ -0,0 +1,426 @@
+"""
+Accounting of the resources each dkr run used, kept in a local history of runs.
+
+Enabled in the config, for every entrypoint or only some of them:
+
+_settings:
+  history:
+    enabled: true
+    path: ~/.dkr.d/history.db
+    interval: 1
+
+While the command runs, the CPU time, peak memory and block I/O of its container are sampled
+every interval seconds, from the container's cgroup files when the container runs on this
+host, otherwise from docker's stats. Once it finishes a record of the run, with its wall
+time and exit code, is appended to the history, which dkr-stats summarises.
+"""
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import threading
+
+from docker.errors import DockerException
+from requests.exceptions import RequestException
+
+from main import (STATE_DIR, DKRConfig, logger, print_tabulate, errprint, format_size)
+from state import makedirs
+
+DEFAULT_HISTORY_FILE = os.path.join(STATE_DIR, 'history.db')
+DEFAULT_INTERVAL = 1.0
+DEFAULT_PERCENTILES = [50, 90, 100]
+CGROUP_ROOT = '/sys/fs/cgroup'
+STATS = ['cpu_time', 'peak_memory', 'read_bytes', 'write_bytes']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    entrypoint TEXT,
+    version TEXT,
+    host TEXT,
+    cwd TEXT,
+    exit_code INTEGER,
+    started REAL,
+    wall_time REAL,
+    cpu_time REAL,
+    peak_memory INTEGER,
+    read_bytes INTEGER,
+    write_bytes INTEGER,
+    source TEXT
+)
+"""
+
+
+def read_keyed_file(path):
+    """
+    Reads a cgroup file of 'key value' lines into a dict
+    """
+    with open(path) as stream:
+        return dict(line.split(None, 1) for line in stream if line.strip())
+
+
+def read_int_file(path):
+    with open(path) as stream:
+        return int(stream.read().strip())
+
+
+def find_cgroup(container_id):
+    """
+    Finds the cgroup of a container running on this host.
+
+    :return: tuple of the cgroup version and a function giving the path of a file for a
+             controller, or None if the container has no cgroup here
+    """
+    scopes = [os.path.join('system.slice', 'docker-%s.scope' % container_id),
+              os.path.join('docker', container_id)]
+
+    for scope in scopes:
+        if os.path.isfile(os.path.join(CGROUP_ROOT, scope, 'cgroup.controllers')):
+            return 2, lambda controller, name, scope=scope: os.path.join(CGROUP_ROOT, scope, name)
+
+        if os.path.isdir(os.path.join(CGROUP_ROOT, 'memory', scope)):
+            return 1, lambda controller, name, scope=scope: os.path.join(
+                CGROUP_ROOT, controller, scope, name)
+
+    return None
+
+
+def read_cgroup_stats(cgroup):
+    """
+    Reads the resource usage of a container from its cgroup, see find_cgroup.
+
+    :return: Dict of the STATS which could be read
+    """
+    version, path = cgroup
+    stats = {}
+
+    try:
+        if version == 2:
+            stats['cpu_time'] = int(read_keyed_file(path('cpu', 'cpu.stat'))['usage_usec']) / 1e6
+
+            # memory.peak is only kept by recent kernels, otherwise the samples give the peak
+            peak = path('memory', 'memory.peak')
+            stats['peak_memory'] = read_int_file(
+                peak if os.path.exists(peak) else path('memory', 'memory.current'))
+
+            stats['read_bytes'] = stats['write_bytes'] = 0
+            with open(path('io', 'io.stat')) as stream:
+                for line in stream:
+                    for field in line.split()[1:]:
+                        key, _, value = field.partition('=')
+                        if key in ('rbytes', 'wbytes'):
+                            stats['read_bytes' if key == 'rbytes' else 'write_bytes'] += int(value)
+        else:
+            stats['cpu_time'] = read_int_file(path('cpuacct', 'cpuacct.usage')) / 1e9
+            stats['peak_memory'] = read_int_file(path('memory', 'memory.max_usage_in_bytes'))
+
+            stats['read_bytes'] = stats['write_bytes'] = 0
+            with open(path('blkio', 'blkio.throttle.io_service_bytes')) as stream:
+                for line in stream:
+                    fields = line.split()
+                    if len(fields) == 3 and fields[1] in ('Read', 'Write'):
+                        stats['read_bytes' if fields[1] == 'Read' else 'write_bytes'] += int(
+                            fields[2])
+    except (IOError, OSError, KeyError, ValueError) as e:
+        logger.debug('Could not read cgroup stats: %s' % e)
+
+    return stats
+
+
+def parse_docker_stats(sample):
+    """
+    Picks the STATS out of a sample of docker's stats of a container.
+    """
+    stats = {}
+
+    cpu = ((sample.get('cpu_stats') or {}).get('cpu_usage') or {}).get('total_usage')
+    if cpu is not None:
+        stats['cpu_time'] = cpu / 1e9
+
+    memory = sample.get('memory_stats') or {}
+    if memory.get('max_usage') or memory.get('usage'):
+        stats['peak_memory'] = memory.get('max_usage') or memory['usage']
+
+    io = (sample.get('blkio_stats') or {}).get('io_service_bytes_recursive')
+    if io is not None:
+        stats['read_bytes'] = sum(e['value'] for e in io if e.get('op', '').lower() == 'read')
+        stats['write_bytes'] = sum(e['value'] for e in io if e.get('op', '').lower() == 'write')
+
+    return stats
+
+
+def merge_stats(stats, sample):
+    """
+    Merges a sample into the stats so far. Every stat only grows, so the largest value is kept.
+    """
+    for key, value in sample.items():
+        stats[key] = max(stats.get(key) or 0, value)
+
+
+class RunAccounting:
+    """
+    Samples the resource usage of a DKRContainer's command while it runs,
+    and records the run in the history once it has finished.
+    """
+
+    def __init__(self, container):
+        self.container = container
+        self.settings = container.settings.get('history') or {}
+        self.interval = float(self.settings.get('interval', DEFAULT_INTERVAL))
+        self.cgroup = find_cgroup(container.container.id)
+        self.stats = {}
+        self.started = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        self.started = time.time()
+
+        self._thread = threading.Thread(
+            target=self._sample_cgroup if self.cgroup else self._sample_docker)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _sample_cgroup(self):
+        while not self._stopped.is_set():
+            self._merge(read_cgroup_stats(self.cgroup))
+            self._stopped.wait(self.interval)
+
+    def _sample_docker(self):
+        """
+        Follows docker's stats of the container, which it sends about once a second.
+        """
+        try:
+            for sample in self.container.client.api.stats(self.container.container.id,
+                                                          decode=True, stream=True):
+                if self._stopped.is_set():
+                    break
+                self._merge(parse_docker_stats(sample))
+        except (DockerException, RequestException, ValueError) as e:
+            logger.debug('Could not follow docker stats: %s' % e)
+
+    def _merge(self, sample):
+        with self._lock:
+            merge_stats(self.stats, sample)
+
+    def finish(self, exit_code):
+        """
+        Stops sampling and records the run. Failing to do so is never fatal.
+
+        :return: Dict of the wall time and STATS of the run, None for those which weren't sampled
+        """
+        wall_time = time.time() - self.started
+        self._stopped.set()
+
+        # Docker's stats stream ends with the container, so only wait for the cgroup sampler
+        if self.cgroup:
+            self._thread.join()
+            self._merge(read_cgroup_stats(self.cgroup))
+
+        with self._lock:
+            usage = dict((key, self.stats.get(key)) for key in STATS)
+        usage['wall_time'] = wall_time
+
+        try:
+            RunHistory(self.settings.get('path', DEFAULT_HISTORY_FILE)).record(
+                entrypoint=self.container.entrypoint,
+                version=self.container.version,
+                host=self.container.host.name if self.container.host else None,
+                cwd=os.getcwd(),
+                exit_code=exit_code,
+                started=self.started,
+                source='cgroup' if self.cgroup else 'docker',
+                **usage)
+        except (sqlite3.Error, IOError, OSError) as e:
+            logger.debug('Could not record run in history: %s' % e)
+
+        return usage
+
+
+class RunHistory:
+    """
+    Methods for storing and querying runs in the history database.
+    """
+
+    def __init__(self, path=DEFAULT_HISTORY_FILE):
+        self.path = os.path.expanduser(path)
+        makedirs(os.path.dirname(self.path))
+
+        self.connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute(SCHEMA)
+
+    def record(self, **run):
+        keys = sorted(run)
+        self.connection.execute('INSERT INTO runs (%s) VALUES (%s)' % (
+            ', '.join(keys), ', '.join('?' * len(keys))), [run[key] for key in keys])
+
+    def get_runs(self, entrypoints=None, since=None):
+        """
+        Gets the recorded runs, oldest first.
+
+        :param entrypoints: Only get the runs of these entrypoints
+        :param since: Only get the runs started after this unix timestamp
+        :return: List of sqlite3.Row
+        """
+        conditions, values = [], []
+
+        if entrypoints:
+            conditions.append('entrypoint IN (%s)' % ', '.join('?' * len(entrypoints)))
+            values.extend(entrypoints)
+
+        if since:
+            conditions.append('started >= ?')
+            values.append(since)
+
+        where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+
+        return self.connection.execute(
+            'SELECT * FROM runs%s ORDER BY started' % where, values).fetchall()
+
+
+def percentile(values, p):
+    """
+    Gets the p-th percentile of the values by the nearest-rank method, or None if there are none.
+    """
+    values = sorted(value for value in values if value is not None)
+
+    if not values:
+        return None
+
+    rank = max(int(-(-p * len(values) // 100)), 1)
+
+    return values[min(rank, len(values)) - 1]
+
+
+def format_duration(seconds):
+    """
+    Formats a duration in seconds for humans, e.g. 3m05s
+    """
+    if seconds is None:
+        return '-'
+
+    if seconds < 60:
+        return '%.1fs' % seconds
+
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    if minutes < 60:
+        return '%dm%02ds' % (minutes, seconds)
+
+    return '%dh%02dm' % divmod(minutes, 60)
+
+
+def summarise(runs, percentiles=DEFAULT_PERCENTILES):
+    """
+    Summarises a group of runs by the percentiles of the resources used by those which succeeded.
+
+    :return: List of the cells of its row in the dkr-stats table
+    """
+    succeeded = [run for run in runs if run['exit_code'] == 0]
+
+    def cell(key, formatter):
+        return ' / '.join(formatter(percentile([run[key] for run in succeeded], p))
+                          for p in percentiles)
+
+    return [len(runs), len(runs) - len(succeeded),
+            cell('wall_time', format_duration), cell('cpu_time', format_duration),
+            cell('peak_memory', format_size), cell('read_bytes', format_size),
+            cell('write_bytes', format_size)]
+
+
+def main(entrypoints=None, by_version=False, days=None, percentiles=DEFAULT_PERCENTILES):
+    """
+    dkr-stats Main function.
+
+    Prints the percentiles of the resources used by the recorded runs
+    of each entrypoint, or of each version of each entrypoint.
+    """
+    settings = DKRConfig().get_settings()
+    path = (settings.get('history') or {}).get('path', DEFAULT_HISTORY_FILE)
+
+    if not os.path.exists(os.path.expanduser(path)):
+        errprint('dkr-stats: No runs have been recorded, enable the history in your config.')
+        return 1
+
+    since = time.time() - days * 24 * 3600 if days else None
+    groups = {}
+
+    for run in RunHistory(path).get_runs(entrypoints=entrypoints, since=since):
+        key = (run['entrypoint'], run['version']) if by_version else (run['entrypoint'],)
+        groups.setdefault(key, []).append(run)
+
+    rows = [list(key) + summarise(runs, percentiles) for key, runs in sorted(groups.items())]
+
+    labels = ['max' if p == 100 else 'p%g' % p for p in percentiles]
+    headers = (['Entrypoint'] + (['Version'] if by_version else []) +
+               ['Runs', 'Failed', 'Wall', 'CPU', 'Peak memory', 'Read', 'Written'])
+
+    print_tabulate(headers, rows, print_total_rows=False)
+    print('\nResources of successful runs, as %s' % ' / '.join(labels))
+
+    return 0
+
+
+def parse_percentiles(value):
+    """
+    Parses a comma separated list of percentiles, e.g. 50,90,99
+    """
+    try:
+        percentiles = [float(p) for p in value.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('Expected comma separated percentiles, e.g. 50,90,100')
+
+    if not percentiles or any(p <= 0 or p > 100 for p in percentiles):
+        raise argparse.ArgumentTypeError('Percentiles must be greater than 0 and at most 100')
+
+    return percentiles
+
+
+def parse_arguments(argv):
+    """
+    Parse command-line arguments
+
+    :param argv: command line arguments
+    :return: parsed command-line arguments (argparse)
+    """
+    description = ('Report the CPU time, peak memory and I/O of the dkr runs recorded in the '
+                   'history, for sizing jobs. Enable the history in your config to record runs.')
+
+    parser = argparse.ArgumentParser(description=description)
+
+    parser.add_argument('ENTRYPOINT',
+                        nargs='*',
+                        help='Only report these entrypoints')
+
+    parser.add_argument('-v',
+                        '--by-version',
+                        action='store_true',
+                        help='Report each version of an entrypoint separately')
+
+    parser.add_argument('-d',
+                        '--days',
+                        type=float,
+                        help='Only report the runs of the last this many days')
+
+    parser.add_argument('-p',
+                        '--percentiles',
+                        type=parse_percentiles,
+                        default=DEFAULT_PERCENTILES,
+                        help='Comma separated percentiles to report, 50,90,100 by default')
+
+    args = parser.parse_args(argv)
+
+    return args
+
+
+def run_main(args=sys.argv[1:]):
+    args = parse_arguments(args)
+
+    return main(entrypoints=args.ENTRYPOINT, by_version=args.by_version, days=args.days,
+                percentiles=args.percentiles)
+
+
+if __name__ == '__main__':
+    sys.exit(run_main())
@@ -0,0 +1,160 @@
+"""
+Scheduling dkr containers across a pool of docker hosts.
+
+By default dkr uses the docker daemon given by the environment. Listing hosts under
+the settings in the config makes dkr pick one of them for each run instead, e.g.
+
+_settings:
+  hosts:
+    - name: local
+      url: unix:///var/run/docker.sock
+      slots: 8
+    - name: node2
+      url: ssh://dkr@node2
+      slots: 16
+      mounts:
+        - /nfs
+        - /home
+
+'slots' is the number of containers the host should run at once, and 'mounts' lists the
+shared filesystem paths which are mounted at the same location on the host. A host with
+no 'mounts' is assumed to see the same filesystem as the caller, and a host is only
+eligible for a run if every path to be mounted into the container is under its 'mounts'.
+
+Of the eligible hosts, those with free slots are preferred, then those which already
+have the image, then those with the fewest running containers per slot.
+"""
+import os
+import docker
+import logging
+
+from multiprocessing.pool import ThreadPool
+from requests.exceptions import RequestException
+
+logger = logging.getLogger()
+
+HOST_KEYS = ['name', 'url', 'slots', 'mounts']
+DEFAULT_SLOTS = 1
+
+# Docker clients are kept open and reused for each host
+CLIENTS = {}
+
+
+def get_client(url=None):
+    """
+    Gets the pooled docker client for the given url, or for the
+    environment if url is None, creating it if needed.
+    """
+    if url not in CLIENTS:
+        CLIENTS[url] = docker.DockerClient(base_url=url) if url else docker.from_env()
+
+    return CLIENTS[url]
+
+
+def validate_hosts(hosts):
+    """
+    Checks that each host has a url and only known options.
+    """
+    for host in hosts or []:
+        if not host.get('url'):
+            raise KeyError('Host %s has no url' % host)
+
+        unknown = set(host) - set(HOST_KEYS)
+        if unknown:
+            raise KeyError('Host %s has unknown options %s, expected %s' % (
+                host['url'], ', '.join(sorted(unknown)), ', '.join(HOST_KEYS)))
+
+
+class DockerHost:
+    """
+    A docker host in the pool.
+    """
+
+    def __init__(self, url, name=None, slots=DEFAULT_SLOTS, mounts=None):
+        self.url = url
+        self.name = name or url
+        self.slots = slots
+        self.mounts = mounts
+
+    def get_client(self):
+        return get_client(self.url)
+
+    def can_mount(self, paths):
+        """
+        Checks that every path is on one of the shared filesystems of the host.
+        """
+        if self.mounts is None:
+            return True
+
+        mounts = [os.path.join(os.path.abspath(mount), '') for mount in self.mounts]
+
+        return all(any(os.path.join(os.path.abspath(path), '').startswith(mount)
+                       for mount in mounts) for path in paths)
+
+    def get_status(self, image_reference):
+        """
+        Asks the host how many containers it is running and whether it has the image.
+
+        :return: Dict with 'running' and 'has_image', or None if the host is unreachable
+        """
+        try:
+            running = len(self.get_client().api.containers(quiet=True))
+            has_image = bool(self.get_client().api.images(
+                filters={'reference': [image_reference]}, quiet=True))
+        except (docker.errors.DockerException, RequestException) as e:
+            logger.warning('Could not reach docker host %s: %s' % (self.name, e))
+            return None
+
+        return {'running': running, 'has_image': has_image}
+
+
+def load_hosts(settings):
+    """
+    Creates the hosts listed in the settings.
+
+    :return: List of DockerHost, empty if no hosts are configured
+    """
+    return [DockerHost(host['url'], name=host.get('name'), slots=host.get('slots', DEFAULT_SLOTS),
+                       mounts=host.get('mounts')) for host in settings.get('hosts') or []]
+
+
+def rank_hosts(hosts, statuses):
+    """
+    Orders the hosts by preference given their statuses, leaving out unreachable hosts.
+
+    :param hosts: List of DockerHost
+    :param statuses: List of statuses, as returned by DockerHost.get_status, one per host
+    :return: List of DockerHost, best first
+    """
+    def preference(item):
+        host, status = item
+        free = status['running'] < host.slots
+        return not free, not status['has_image'], float(status['running']) / max(host.slots, 1)
+
+    reachable = [(h, s) for h, s in zip(hosts, statuses) if s is not None]
+
+    return [host for host, _ in sorted(reachable, key=preference)]
+
+
+def select_host(hosts, image_reference, paths):
+    """
+    Picks the best host for running a container from the image, with the given paths mounted.
+
+    :param hosts: List of DockerHost
+    :param image_reference: Reference of the image to run, as reported by docker
+    :param paths: Paths which will be mounted into the container
+    :return: The selected DockerHost, or None if no host is eligible
+    """
+    eligible = [host for host in hosts if host.can_mount(paths)]
+
+    if not eligible:
+        return None
+
+    pool = ThreadPool(len(eligible))
+    try:
+        statuses = pool.map(lambda host: host.get_status(image_reference), eligible)
+    finally:
+        pool.terminate()
+
+    ranked = rank_hosts(eligible, statuses)
+    return ranked[0] if ranked else None
@@ -0,0 +1,694 @@
+"""
+A local job queue for dkr, so that many users of one node can share its CPUs and memory.
+
+Jobs are submitted with dkr-submit, declaring the CPUs and memory they need, to a dispatcher,
+started with 'dkr-queue dispatch', over a unix socket in the queue's directory. The dispatcher
+takes the user of each job from the credentials of the socket's peer, which can't be forged,
+and stores it in a SQLite database which every user may read but only the dispatcher may write.
+It runs queued jobs in order of priority and then submission, for as long as the next job fits
+in the CPUs and memory left over by the jobs already running. Each job runs in a child process
+of the dispatcher, as the user who submitted it, through the same DKRContainer launch path as
+dkr itself.
+
+The queue lives in /var/tmp/dkr by default, which can be changed in the config:
+
+_settings:
+  queue:
+    path: /scratch/dkr-queue
+"""
+import os
+import pwd
+import sys
+import json
+import time
+import errno
+import fcntl
+import select
+import signal
+import socket
+import sqlite3
+import argparse
+
+from main import (DKRContainer, DKRConfig, print_tabulate, errprint, logger, format_size,
+                  format_time, parse_size)
+from agent import get_peer_credentials
+from state import makedirs
+from protocol import native_strings
+from resources import get_allowed_cpus
+
+DEFAULT_QUEUE_DIR = '/var/tmp/dkr'
+QUEUE_DB = 'queue.db'
+LOG_DIR = 'logs'
+SUBMIT_SOCKET = 'submit.sock'
+SUBMIT_LOCK = 'submit.lock'
+JOB_VARIABLE = 'DKR_QUEUE_JOB'
+POLL_INTERVAL = 1.0
+REQUEST_TIMEOUT = 5.0
+MAX_REQUEST_SIZE = 1024 * 1024
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+LOST = 'lost'
+FINISHED_STATES = [DONE, FAILED, CANCELLED, LOST]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT,
+    uid INTEGER,
+    gid INTEGER,
+    home TEXT,
+    cwd TEXT,
+    base TEXT,
+    image TEXT,
+    invocation TEXT,
+    settings TEXT,
+    cpus REAL,
+    memory INTEGER,
+    priority INTEGER,
+    state TEXT,
+    pid INTEGER,
+    exit_code INTEGER,
+    submitted REAL,
+    started REAL,
+    finished REAL
+)
+"""
+
+
+def get_queue_dir(config=None):
+    """
+    Gets the directory of the queue from the config, or the default.
+    """
+    settings = (config or DKRConfig()).get_settings()
+    return (settings.get('queue') or {}).get('path', DEFAULT_QUEUE_DIR)
+
+
+def get_total_memory():
+    """
+    Gets the total memory of the node in bytes.
+    """
+    with open('/proc/meminfo') as meminfo:
+        for line in meminfo:
+            if line.startswith('MemTotal:'):
+                return int(line.split()[1]) * 1024
+
+    return 0
+
+
+def is_alive(pid):
+    """
+    Checks whether a process with the given pid exists.
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+
+    return True
+
+
+def check_private(path):
+    """
+    Checks that only the current user may change the file or directory at path, as the
+    dispatcher trusts everything in the queue's directory.
+
+    :raises OSError: If anyone else could
+    """
+    info = os.lstat(path)
+
+    if info.st_uid != os.getuid() or info.st_mode & 0o022:
+        raise OSError(errno.EPERM, '%s must be owned by the dispatcher and writable by it alone, '
+                                   'e.g. chmod 755' % path)
+
+
+class JobQueue:
+    """
+    Methods for storing and updating jobs in the queue database.
+
+    Only the dispatcher, which creates the queue with create=True, writes to it,
+    everyone else may only read it.
+    """
+
+    def __init__(self, directory=DEFAULT_QUEUE_DIR, create=False):
+        self.directory = directory
+        self.log_directory = os.path.join(directory, LOG_DIR)
+        path = os.path.join(directory, QUEUE_DB)
+
+        if create:
+            for directory_path in [self.directory, self.log_directory]:
+                if not os.path.exists(directory_path):
+                    makedirs(directory_path)
+                    os.chmod(directory_path, 0o755)
+                check_private(directory_path)
+
+            if os.path.exists(path):
+                check_private(path)
+
+        elif not os.path.exists(path):
+            raise IOError(errno.ENOENT, 'No job queue at %s, start a dispatcher with '
+                                        'dkr-queue dispatch' % directory)
+
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.connection.row_factory = sqlite3.Row
+
+        if create:
+            self.connection.execute(SCHEMA)
+            os.chmod(path, 0o644)
+
+    def log_paths(self, job_id):
+        """
+        Returns the paths of the stdout and stderr logs of a job.
+        """
+        base = os.path.join(self.log_directory, str(job_id))
+        return base + '.out', base + '.err'
+
+    def submit(self, uid, gid, cwd, base, image, invocation, settings, cpus=1, memory=0,
+               priority=0, name=None):
+        """
+        Adds a job, to be run as the given user, whose credentials the dispatcher
+        got from the submitting process, in the given directory.
+
+        :return: id of the job
+        """
+        cursor = self.connection.execute(
+            'INSERT INTO jobs (name, uid, gid, home, cwd, base, image, invocation, settings, '
+            'cpus, memory, priority, state, submitted) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (name, uid, gid, pwd.getpwuid(uid).pw_dir, cwd, base, image, json.dumps(invocation),
+             json.dumps(settings), cpus, memory, priority, QUEUED, time.time()))
+
+        return cursor.lastrowid
+
+    def get(self, job_id):
+        return self.connection.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+
+    def jobs(self, states=None):
+        """
+        Returns the jobs in the given states, in the order they will be dispatched.
+        """
+        query = 'SELECT * FROM jobs'
+        states = states or []
+
+        if states:
+            query += ' WHERE state IN (%s)' % ', '.join('?' * len(states))
+
+        return self.connection.execute(query + ' ORDER BY priority DESC, id', states).fetchall()
+
+    def claim(self, job_id):
+        """
+        Marks a queued job as running, unless another dispatcher got to it first.
+
+        :return: True if the job was claimed
+        """
+        cursor = self.connection.execute(
+            'UPDATE jobs SET state = ?, started = ? WHERE id = ? AND state = ?',
+            (RUNNING, time.time(), job_id, QUEUED))
+
+        return cursor.rowcount == 1
+
+    def set_pid(self, job_id, pid):
+        self.connection.execute('UPDATE jobs SET pid = ? WHERE id = ?', (pid, job_id))
+
+    def set_finished(self, job_id, state, exit_code=None):
+        self.connection.execute(
+            'UPDATE jobs SET state = ?, exit_code = ?, finished = ? WHERE id = ? AND state IN (?, ?)',
+            (state, exit_code, time.time(), job_id, QUEUED, RUNNING))
+
+    def cancel(self, job_id, uid):
+        """
+        Cancels a job of the given user, or of anyone if the user is root.
+        Queued jobs won't be started and running jobs are sent SIGTERM.
+
+        :return: True if the job was cancelled
+        """
+        job = self.get(job_id)
+
+        if not job or job['state'] in FINISHED_STATES:
+            return False
+
+        if uid not in (0, job['uid']):
+            raise OSError(errno.EPERM, 'Job %d belongs to another user' % job_id)
+
+        if job['state'] == RUNNING and job['pid']:
+            try:
+                os.kill(job['pid'], signal.SIGTERM)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+        self.set_finished(job_id, CANCELLED)
+        return True
+
+
+def open_log(path, uid, gid):
+    """
+    Creates the log of a job afresh, owned by and readable only by its user.
+    """
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_NOFOLLOW', 0), 0o600)
+    if os.getuid() != uid:
+        os.fchown(fd, uid, gid)
+
+    return fd
+
+
+def run_job(queue, job):
+    """
+    Runs a job in the current process, which is expected to be a fresh child
+    of the dispatcher, and exits with the job's exit code.
+
+    The child takes on the job's user and then runs 'dkr-queue run-job' in its place, as
+    dkr's modules work out where the user's files are, e.g. ~/.dkr.d, when imported.
+    """
+    stdout_path, stderr_path = queue.log_paths(job['id'])
+
+    # The logs are opened by the dispatcher, in a directory only it may write to
+    stdin = os.open(os.devnull, os.O_RDONLY)
+    stdout = open_log(stdout_path, job['uid'], job['gid'])
+    stderr = open_log(stderr_path, job['uid'], job['gid'])
+
+    if os.getuid() != job['uid']:
+        os.initgroups(pwd.getpwuid(job['uid']).pw_name, job['gid'])
+        os.setgid(job['gid'])
+        os.setuid(job['uid'])
+
+    os.environ['HOME'] = job['home']
+    os.chdir(job['cwd'])
+
+    for fd, target in [(stdin, 0), (stdout, 1), (stderr, 2)]:
+        os.dup2(fd, target)
+        os.close(fd)
+
+    # Nothing else of the dispatcher's, e.g. its database, is left open for the job
+    os.closerange(3, os.sysconf('SC_OPEN_MAX'))
+
+    os.environ[JOB_VARIABLE] = json.dumps(dict((key, job[key]) for key in
+                                               ['image', 'invocation', 'settings', 'base']))
+    os.execv(sys.executable, [sys.executable, '-m', 'dkr.jobqueue', 'run-job'])
+
+
+def execute_job(job):
+    """
+    Runs the job handed over by run_job, and exits with its exit code.
+    """
+    command = DKRContainer(native_strings(job['image']),
+                           native_strings(json.loads(job['invocation'])),
+                           flags=None,
+                           settings=native_strings(json.loads(job['settings'])),
+                           entrypoint=native_strings(job['base']))
+
+    def terminate(signum, frame):
+        command.remove_container()
+        os._exit(128 + signum)
+
+    signal.signal(signal.SIGTERM, terminate)
+
+    command.launch_container()
+    rt = command.execute_command()
+    command.remove_container()
+
+    os._exit(rt)
+
+
+def start_job(queue, job, submissions=None):
+    """
+    Forks a child process to run the job.
+
+    :param submissions: The dispatcher's submission socket and its lock, which the child closes
+    :return: pid of the child
+    """
+    pid = os.fork()
+
+    if pid:
+        return pid
+
+    try:
+        for held in submissions or []:
+            held.close()
+        run_job(queue, job)
+    except Exception as e:
+        errprint('dkr-queue: job %d failed to start: %s' % (job['id'], e))
+    finally:
+        os._exit(127)
+
+
+def can_run_as(uid):
+    """
+    Checks whether the dispatcher can run jobs for the given user.
+    """
+    return os.getuid() in (0, uid)
+
+
+def listen_for_submissions(directory):
+    """
+    Takes over the submission socket of the queue, unless another dispatcher serves it.
+    Every user may connect to it, and is told apart by the credentials of the connection.
+
+    :return: tuple of the listening socket and the lock held on it, or None
+    """
+    lock = open(os.path.join(directory, SUBMIT_LOCK), 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        lock.close()
+        return None
+
+    path = os.path.join(directory, SUBMIT_SOCKET)
+    try:
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    fcntl.fcntl(sock.fileno(), fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+    sock.bind(path)
+    os.chmod(path, 0o666)
+    sock.listen(128)
+
+    return sock, lock
+
+
+def check_submission(request):
+    """
+    Checks that a submitted job has each of its fields, of the right type.
+
+    :raises ValueError: If it doesn't
+    """
+    for key in ['cwd', 'base', 'image']:
+        if not isinstance(request.get(key), basestring):
+            raise ValueError('%s must be a string' % key)
+
+    invocation = request.get('invocation')
+    if not isinstance(invocation, list) or not all(isinstance(arg, basestring) for arg in invocation):
+        raise ValueError('invocation must be a list of strings')
+
+    if not isinstance(request.get('settings'), dict):
+        raise ValueError('settings must be a dict')
+
+    for key in ['cpus', 'memory', 'priority']:
+        value = request.get(key)
+        if not isinstance(value, (int, long, float)) or isinstance(value, bool) or value < 0:
+            raise ValueError('%s must be a number of at least 0' % key)
+
+    if request.get('name') is not None and not isinstance(request['name'], basestring):
+        raise ValueError('name must be a string')
+
+
+def serve_request(queue, conn):
+    """
+    Serves a submission or cancellation of a job, on behalf of the user of
+    the process at the other end of the connection.
+    """
+    conn.settimeout(REQUEST_TIMEOUT)
+    stream = conn.makefile('rwb', 0)
+
+    def reply(message):
+        stream.write(json.dumps(message).encode('utf-8') + b'\n')
+
+    _, uid, gid = get_peer_credentials(conn)
+
+    try:
+        request = native_strings(json.loads(stream.readline(MAX_REQUEST_SIZE) or '{}'))
+        if not isinstance(request, dict):
+            raise ValueError('Requests must be objects')
+
+        if request.get('command') == 'submit':
+            check_submission(request)
+            job_id = queue.submit(uid, gid, request['cwd'], request['base'], request['image'],
+                                  request['invocation'], request['settings'],
+                                  cpus=request['cpus'], memory=int(request['memory']),
+                                  priority=int(request['priority']), name=request.get('name'))
+            reply({'id': job_id})
+
+        elif request.get('command') == 'cancel':
+            reply({'cancelled': queue.cancel(int(request.get('id')), uid)})
+
+        else:
+            reply({'error': 'Unknown command %s' % request.get('command')})
+
+    except (OSError, ValueError, TypeError, KeyError) as e:
+        reply({'error': getattr(e, 'strerror', None) or str(e)})
+
+
+def wait_for_requests(queue, submissions, timeout):
+    """
+    Waits up to timeout for a request on the submission socket, serving it if one comes.
+    """
+    if not submissions:
+        time.sleep(timeout)
+        return
+
+    sock = submissions[0]
+
+    try:
+        readable, _, _ = select.select([sock], [], [], timeout)
+    except select.error as e:
+        if e.args[0] != errno.EINTR:
+            raise
+        return
+
+    if not readable:
+        return
+
+    conn, _ = sock.accept()
+    try:
+        serve_request(queue, conn)
+    except (socket.error, IOError) as e:
+        logger.warning('Could not serve a request: %s' % e)
+    finally:
+        conn.close()
+
+
+def request_dispatcher(directory, request):
+    """
+    Sends a request to the dispatcher serving the queue in directory, see serve_request.
+
+    :return: The reply
+    :raises IOError: If no dispatcher is serving the queue, or it refused the request
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        try:
+            sock.connect(os.path.join(directory, SUBMIT_SOCKET))
+        except socket.error:
+            raise IOError(errno.ECONNREFUSED, 'No dispatcher is serving the job queue at %s, '
+                                              'start one with dkr-queue dispatch' % directory)
+
+        stream = sock.makefile('rwb', 0)
+        stream.write(json.dumps(request).encode('utf-8') + b'\n')
+        response = json.loads(stream.readline() or '{}')
+    finally:
+        sock.close()
+
+    if 'error' in response or not response:
+        raise IOError(errno.EPERM, response.get('error') or 'The dispatcher did not reply')
+
+    return response
+
+
+def dispatch(queue, cpus, memory, poll_interval=POLL_INTERVAL, exit_when_idle=False):
+    """
+    Runs queued jobs as resources allow, until interrupted.
+
+    Jobs are admitted strictly in order, so a large job at the head of the queue holds
+    back smaller jobs behind it rather than being starved by them. A job declaring more
+    than the node has is admitted once nothing else is running. The resources in use are
+    counted from every running job in the queue, so several dispatchers can share a node.
+    One of them at a time serves the submission socket, which the others take over
+    when it stops.
+
+    :param cpus: Number of CPUs available to jobs
+    :param memory: Bytes of memory available to jobs
+    :param exit_when_idle: Return once there are no queued or running jobs left
+    """
+    running = {}
+    submissions = None
+
+    while True:
+        if not submissions:
+            submissions = listen_for_submissions(queue.directory)
+
+        # Collect finished jobs
+        while running:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno != errno.ECHILD:
+                    raise
+                break
+
+            if not pid:
+                break
+
+            job = running.pop(pid, None)
+            if job:
+                exit_code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 128 + os.WTERMSIG(status)
+                queue.set_finished(job['id'], DONE if exit_code == 0 else FAILED, exit_code)
+
+        # Jobs whose dispatcher went away while they were running can't be tracked
+        active = []
+        for job in queue.jobs([RUNNING]):
+            if job['pid'] and job['pid'] not in running and not is_alive(job['pid']):
+                queue.set_finished(job['id'], LOST)
+            else:
+                active.append(job)
+
+        used_cpus = sum(job['cpus'] for job in active)
+        used_memory = sum(job['memory'] for job in active)
+
+        queued = [job for job in queue.jobs([QUEUED]) if can_run_as(job['uid'])]
+
+        for job in queued:
+            fits = used_cpus + job['cpus'] <= cpus and used_memory + job['memory'] <= memory
+            if not fits and (active or running):
+                break
+
+            if not queue.claim(job['id']):
+                continue
+
+            pid = start_job(queue, job, submissions)
+            queue.set_pid(job['id'], pid)
+            running[pid] = job
+            used_cpus += job['cpus']
+            used_memory += job['memory']
+
+        if exit_when_idle and not running and not queued:
+            for held in submissions or []:
+                held.close()
+            return
+
+        wait_for_requests(queue, submissions, poll_interval)
+
+
+def print_jobs(jobs):
+    rows = []
+    for job in jobs:
+        runtime = (job['finished'] or time.time()) - job['started'] if job['started'] else None
+        rows.append([
+            job['id'],
+            job['name'] or job['base'],
+            pwd.getpwuid(job['uid']).pw_name,
+            job['cpus'],
+            format_size(job['memory']),
+            job['priority'],
+            job['state'],
+            format_time(job['submitted']),
+            '%ds' % runtime if runtime is not None else '-',
+            job['exit_code'] if job['exit_code'] is not None else '-'
+        ])
+
+    print_tabulate(['Job', 'Name', 'User', 'CPUs', 'Memory', 'Priority', 'State', 'Submitted',
+                    'Runtime', 'Exit'], rows)
+
+
+def main(args):
+    """
+    dkr-queue Main function.
+    """
+    if args.command == 'run-job':
+        execute_job(json.loads(os.environ.pop(JOB_VARIABLE)))
+
+    directory = get_queue_dir()
+
+    try:
+        queue = JobQueue(directory, create=args.command == 'dispatch')
+    except (IOError, OSError) as e:
+        errprint('dkr-queue: %s' % e.strerror)
+        return 1
+
+    if args.command == 'list':
+        print_jobs(queue.jobs(None if args.all else [QUEUED, RUNNING]))
+
+    elif args.command == 'status':
+        job = queue.get(args.JOB)
+        if not job:
+            errprint('dkr-queue: No such job %d' % args.JOB)
+            return 1
+        print_jobs([job])
+
+    elif args.command == 'logs':
+        stdout_path, stderr_path = queue.log_paths(args.JOB)
+        path = stderr_path if args.stderr else stdout_path
+        if not os.path.exists(path):
+            errprint('dkr-queue: No logs for job %d yet' % args.JOB)
+            return 1
+        with open(path) as log:
+            for chunk in iter(lambda: log.read(65536), ''):
+                sys.stdout.write(chunk)
+
+    elif args.command == 'cancel':
+        for job_id in args.JOB:
+            try:
+                cancelled = request_dispatcher(directory, {'command': 'cancel', 'id': job_id})
+            except IOError as e:
+                errprint('dkr-queue: %s' % e.strerror)
+                return 1
+
+            if not cancelled['cancelled']:
+                errprint('dkr-queue: Job %d is not queued or running' % job_id)
+
+    elif args.command == 'dispatch':
+        cpus = args.cpus or len(get_allowed_cpus())
+        memory = args.memory or get_total_memory()
+        logger.info('Dispatching jobs on %s CPUs and %s memory' % (cpus, format_size(memory)))
+        dispatch(queue, cpus, memory, exit_when_idle=args.exit_when_idle)
+
+
+def parse_arguments(argv):
+    """
+    Parse command-line arguments
+
+    :param argv: command line arguments
+    :return: parsed command-line arguments (argparse)
+    """
+    description = 'Inspect and dispatch the local queue of dkr jobs.'
+
+    parser = argparse.ArgumentParser(description=description)
+    subparsers = parser.add_subparsers(dest='command')
+
+    list_parser = subparsers.add_parser('list', help='List queued and running jobs')
+    list_parser.add_argument('-a', '--all', action='store_true', help='Include finished jobs')
+
+    status_parser = subparsers.add_parser('status', help='Show the status of a job')
+    status_parser.add_argument('JOB', type=int)
+
+    logs_parser = subparsers.add_parser('logs', help='Print the output of a job')
+    logs_parser.add_argument('JOB', type=int)
+    logs_parser.add_argument('-e', '--stderr', action='store_true', help='Print stderr rather than stdout')
+
+    cancel_parser = subparsers.add_parser('cancel', help='Cancel jobs')
+    cancel_parser.add_argument('JOB', type=int, nargs='+')
+
+    dispatch_parser = subparsers.add_parser('dispatch', help='Run queued jobs as resources allow')
+    dispatch_parser.add_argument('-c', '--cpus', type=float, help='CPUs available to jobs, all by default')
+    dispatch_parser.add_argument('-m', '--memory', type=parse_size,
+                                 help='Memory available to jobs, e.g. 64G, all by default')
+    dispatch_parser.add_argument('--exit-when-idle', action='store_true',
+                                 help='Exit once there are no queued or running jobs')
+
+    # Used by the dispatcher to run each job, see run_job
+    subparsers.add_parser('run-job')
+
+    args = parser.parse_args(argv)
+
+    return args
+
+
+def run_main(args=sys.argv[1:]):
+    args = parse_arguments(args)
+
+    return main(args)
+
+
+if __name__ == '__main__':
+    sys.exit(run_main())
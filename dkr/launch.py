@@ -0,0 +1,260 @@
+"""
+The parts of launching a dkr container which only need the standard library: where dkr keeps
+its files, which paths are mounted into the container and where it sees them, and the labels
+identifying the process which owns it.
+
+These are shared by dkr itself and the launcher shims generated by dkr-shim, which have to
+start without importing docker and yaml, see shim.py, or anything else slow to import, such
+as the ctypes behind prewarming datasets.
+"""
+import os
+import stat
+import time
+import fcntl
+import socket
+import logging
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+from state import StateFile
+
+logger = logging.getLogger()
+
+HOME = os.path.expanduser('~')
+CONFIG_FILE = os.path.join(HOME, '.dkr')
+STATE_DIR = os.path.join(HOME, '.dkr.d')
+IMAGE_CACHE_FILE = os.path.join(STATE_DIR, 'images.json')
+MOUNT_ROOT = '/dkr'
+DATASET_ROOT = '/datasets'
+
+# Labels set on every dkr container, so that dkr-reap can find those whose owner has gone
+OWNER_PID_LABEL = 'dkr.owner.pid'
+OWNER_START_LABEL = 'dkr.owner.start'
+OWNER_HOST_LABEL = 'dkr.owner.host'
+OWNER_UID_LABEL = 'dkr.owner.uid'
+ENTRYPOINT_LABEL = 'dkr.entrypoint'
+STARTED_LABEL = 'dkr.started'
+
+# How the command in the container is redirected to stdin and stdout files used directly
+STDIO_REDIRECTS = {0: '<', 1: '>'}
+
+
+def get_process_start_time(pid='self'):
+    """
+    Gets the time a process started at, in clock ticks since boot, which
+    tells it apart from a later process which has been given the same pid.
+
+    :return: The start time, or None if there is no such process
+    """
+    try:
+        with open('/proc/%s/stat' % pid) as stat:
+            # The command name may contain spaces, so count the fields from after it
+            return int(stat.read().rsplit(')', 1)[1].split()[19])
+    except (IOError, IndexError, ValueError):
+        return None
+
+
+def get_owner_labels(entrypoint):
+    """
+    Returns the labels identifying this process as the owner of a container
+    """
+    return {
+        OWNER_PID_LABEL: str(os.getpid()),
+        OWNER_START_LABEL: str(get_process_start_time()),
+        OWNER_HOST_LABEL: socket.gethostname(),
+        OWNER_UID_LABEL: str(os.getuid()),
+        ENTRYPOINT_LABEL: entrypoint,
+        STARTED_LABEL: str(time.time())
+    }
+
+
+def record_image_use(image):
+    """
+    Stamps the time at which the image was last used by dkr.
+    Failing to do so is never fatal.
+    """
+    try:
+        with StateFile(IMAGE_CACHE_FILE).update() as cache:
+            cache.setdefault(image, {})['last_used'] = time.time()
+    except (IOError, OSError) as e:
+        logger.debug('Could not record use of %s: %s' % (image, e))
+
+
+def find_closest_path(path):
+    """
+    Treats the input string as a path.
+
+    Scans the input 'path' recursively until a valid path is found,
+    which is subsequently returned.
+
+    Returns None if no valid path is found.
+    """
+    if path.startswith('~'):
+        path = os.path.expanduser(path)
+
+    if path and not os.path.exists(path):
+        return find_closest_path(os.path.split(path)[0])
+    elif path:
+        return path
+    else:
+        return None
+
+
+def make_mapping(path):
+    """
+    Makes a dkr and docker aware mapping for a single path
+    """
+    return {path: {'bind': os.path.join(MOUNT_ROOT, path.lstrip('//')), 'mode': 'rw'}}
+
+
+def find_direct_stdio(files):
+    """
+    Finds which of stdin and stdout are backed by a regular file or a named FIFO,
+    so that the file can be mounted into the container and redirected to directly,
+    rather than streamed through docker exec.
+
+    TTYs, sockets and anonymous pipes have no path which could be mounted, and
+    files which have already been read from or written to are left mid-stream,
+    so these continue to be streamed. So does stdout when stderr goes to the same
+    file, e.g. with 2>&1, as stderr is streamed and the two would overwrite each other.
+
+    :param files: Dict mapping 0, 1 and 2 to the files used as stdin, stdout and stderr
+    :return: Dict mapping each direct file descriptor to its path and redirection
+    """
+    stdio = {}
+
+    for fd, redirect in STDIO_REDIRECTS.items():
+        try:
+            fd_stat = os.fstat(files[fd].fileno())
+            path = os.readlink('/proc/self/fd/%d' % files[fd].fileno())
+            path_stat = os.stat(path)
+        except OSError:
+            continue
+
+        if not (stat.S_ISREG(fd_stat.st_mode) or stat.S_ISFIFO(fd_stat.st_mode)):
+            continue
+
+        # Anonymous pipes and deleted files can't be found by their path
+        if (path_stat.st_dev, path_stat.st_ino) != (fd_stat.st_dev, fd_stat.st_ino):
+            continue
+
+        if fd == 1 and fcntl.fcntl(files[fd].fileno(), fcntl.F_GETFL) & os.O_APPEND:
+            redirect = '>>'
+        elif stat.S_ISREG(fd_stat.st_mode) and os.lseek(files[fd].fileno(), 0, os.SEEK_CUR) != 0:
+            continue
+
+        if fd == 1 and 2 in files:
+            try:
+                stderr_stat = os.fstat(files[2].fileno())
+            except OSError:
+                stderr_stat = None
+
+            if stderr_stat and (stderr_stat.st_dev, stderr_stat.st_ino) == \
+                    (fd_stat.st_dev, fd_stat.st_ino):
+                continue
+
+        stdio[fd] = (path, redirect)
+
+    return stdio
+
+
+def get_dataset_volumes(datasets):
+    """
+    Makes a volume for each dataset, see prepare_volumes
+    """
+    return dict((dataset['path'], {'bind': dataset['bind'],
+                                   'mode': 'ro' if dataset['read_only'] else 'rw'})
+                for dataset in datasets.values())
+
+
+def find_dataset_path(path, datasets):
+    """
+    Finds where the container sees a path under one of the datasets.
+
+    :return: The path in the container, or None if the path is not under any dataset
+    """
+    if not path.startswith(('/', '~')):
+        return None
+
+    path = os.path.abspath(os.path.expanduser(path))
+
+    for dataset in datasets.values():
+        if path == dataset['path'] or path.startswith(dataset['path'].rstrip('/') + '/'):
+            return dataset['bind'] + path[len(dataset['path'].rstrip('/')):]
+
+    return None
+
+
+def prepare_volumes(paths, default_paths, datasets=None):
+    """
+    Algorithm for preparing the volumes required for
+    mounting within the docker container
+
+    :param paths: Strings which may be paths, e.g. the invocation
+    :param default_paths: Paths which are always mounted
+    :param datasets: Dict of datasets, see datasets.get_datasets
+    :return: Dict mapping each path to its volume
+    """
+    datasets = datasets or {}
+    volumes = {}
+
+    for path in list(default_paths):
+        volumes.update(make_mapping(path))
+
+    for path in paths:
+        extant_path = find_closest_path(path)
+        # Paths under a dataset are seen through its volume
+        if extant_path and not find_dataset_path(os.path.abspath(extant_path), datasets):
+            # Paths under a mounted directory are left to it by collapse_volumes at launch
+            for volume_path in [extant_path, os.path.dirname(extant_path)]:
+                volumes.update(make_mapping(os.path.abspath(volume_path)))
+
+    volumes.update(get_dataset_volumes(datasets))
+
+    return volumes
+
+
+def rewrite_invocation(invocation, volumes, datasets=None):
+    """
+    Updates the invocation in place to use the mount points for any paths.
+    """
+    for index, item in enumerate(invocation):
+        if item in volumes:
+            item = volumes[item]['bind']
+        elif datasets:
+            item = find_dataset_path(item, datasets) or item
+        invocation[index] = item
+
+    return invocation
+
+
+def collapse_volumes(volumes):
+    """
+    Leaves out the volumes of paths under the path of another volume, which the container
+    sees through it already, as both are mounted at /dkr followed by their path. Paths
+    which only resolve through a symlink, and datasets, keep their own volume.
+
+    :param volumes: Dict of volumes, see prepare_volumes
+    :return: Dict of the volumes to mount
+    """
+    collapsed = {}
+
+    for path in sorted(volumes, key=len):
+        parent = os.path.dirname(path)
+        while parent not in collapsed and parent != os.path.dirname(parent):
+            parent = os.path.dirname(parent)
+
+        if parent in collapsed:
+            relative = os.path.relpath(path, parent)
+            nested = dict(collapsed[parent], bind=os.path.join(collapsed[parent]['bind'], relative))
+
+            if volumes[path] == nested and \
+                    os.path.realpath(path) == os.path.join(os.path.realpath(parent), relative):
+                continue
+
+        collapsed[path] = volumes[path]
+
+    return collapsed
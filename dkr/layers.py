@@ -0,0 +1,243 @@
+"""
+Estimating how much of an image a pull would download, from the manifest in its registry.
+
+Images share most of their layers, e.g. the base layers of biocontainers, and docker only
+downloads the layers it does not have already. The manifest of an image lists the compressed
+size of each of its layers, and its config the digest of each layer once uncompressed, which
+is how docker identifies the layers of local images, so the cost of pulling an image is the
+compressed size of the layers not found in any local image.
+
+Layers are fetched anonymously through the registry API, for linux/amd64 when a tag refers to
+images for several platforms, and cached in ~/.dkr.d/layers.json for a day, or for as long as
+the tag refers to the same manifest when its digest is known.
+"""
+import os
+import re
+import time
+import logging
+import requests
+
+from multiprocessing.pool import ThreadPool
+from requests.exceptions import RequestException
+from docker.errors import APIError
+
+from state import StateFile
+from launch import STATE_DIR
+from mirrors import normalise_reference, DOCKER_HUB
+
+logger = logging.getLogger()
+
+LAYERS_FILE = os.path.join(STATE_DIR, 'layers.json')
+LAYERS_TTL = 24 * 3600
+LAYERS_THREADS = 8
+REQUEST_TIMEOUT = 10.0
+DOCKER_HUB_REGISTRY = 'registry-1.docker.io'
+PLATFORM = {'os': 'linux', 'architecture': 'amd64'}
+
+MANIFEST_TYPES = [
+    'application/vnd.docker.distribution.manifest.v2+json',
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+    'application/vnd.oci.image.manifest.v1+json',
+    'application/vnd.oci.image.index.v1+json'
+]
+MANIFEST_LIST_TYPES = MANIFEST_TYPES[1::2]
+
+CHALLENGE_PARAMETER = re.compile(r'(\w+)="([^"]*)"')
+
+# Anonymous tokens by registry and repository, shared by the threads fetching manifests
+TOKENS = {}
+
+
+def split_reference(image):
+    """
+    Splits an image reference into the host of its registry, its repository and its tag or digest,
+    e.g. quay.io/biocontainers/bwa:0.7.17 becomes ('quay.io', 'biocontainers/bwa', '0.7.17')
+    """
+    registry, repository = normalise_reference(image).split('/', 1)
+
+    if '@' in repository:
+        repository, version = repository.split('@', 1)
+    elif ':' in repository.rsplit('/', 1)[-1]:
+        repository, version = repository.rsplit(':', 1)
+    else:
+        version = 'latest'
+
+    return DOCKER_HUB_REGISTRY if registry == DOCKER_HUB else registry, repository, version
+
+
+def get_token(challenge, repository):
+    """
+    Gets an anonymous token to pull from a repository, as asked for by a registry.
+
+    :param challenge: The WWW-Authenticate header of the registry's response
+    :return: The token, or None if the registry did not ask for a bearer token
+    """
+    if not challenge.lower().startswith('bearer '):
+        return None
+
+    parameters = dict(CHALLENGE_PARAMETER.findall(challenge))
+    realm = parameters.pop('realm', None)
+    if not realm:
+        return None
+
+    parameters.setdefault('scope', 'repository:%s:pull' % repository)
+    response = requests.get(realm, params=parameters, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+
+    body = response.json()
+    return body.get('token') or body.get('access_token')
+
+
+def request_registry(registry, repository, path, accept=None):
+    """
+    Makes a GET request to the registry API for a repository, e.g. for manifests/<tag>,
+    getting a token first if the registry asks for one.
+
+    :return: The response
+    """
+    url = 'https://%s/v2/%s/%s' % (registry, repository, path)
+    headers = {'Accept': ', '.join(accept)} if accept else {}
+
+    for attempt in range(2):
+        token = TOKENS.get((registry, repository))
+        if token:
+            headers['Authorization'] = 'Bearer %s' % token
+
+        response = requests.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+        if response.status_code != 401 or attempt:
+            break
+
+        token = get_token(response.headers.get('WWW-Authenticate', ''), repository)
+        if not token:
+            break
+        TOKENS[(registry, repository)] = token
+
+    response.raise_for_status()
+    return response
+
+
+def fetch_layers(image):
+    """
+    Fetches the layers of an image from its registry.
+
+    :return: Dict of the 'digest' of the manifest and its 'layers', a list of the uncompressed
+             digest and compressed size of each layer, or None if the registry only serves
+             a manifest without sizes
+    """
+    registry, repository, version = split_reference(image)
+
+    response = request_registry(registry, repository, 'manifests/%s' % version, MANIFEST_TYPES)
+    digest = response.headers.get('Docker-Content-Digest')
+    manifest = response.json()
+
+    if manifest.get('mediaType') in MANIFEST_LIST_TYPES or 'manifests' in manifest:
+        platforms = [entry for entry in manifest.get('manifests') or []
+                     if all((entry.get('platform') or {}).get(key) == value
+                            for key, value in PLATFORM.items())]
+        if not platforms:
+            return None
+
+        manifest = request_registry(registry, repository, 'manifests/%s' % platforms[0]['digest'],
+                                    MANIFEST_TYPES).json()
+
+    if 'config' not in manifest or 'layers' not in manifest:
+        return None
+
+    config = request_registry(registry, repository, 'blobs/%s' % manifest['config']['digest']).json()
+    diff_ids = (config.get('rootfs') or {}).get('diff_ids') or []
+
+    if len(diff_ids) != len(manifest['layers']):
+        return None
+
+    return {
+        'digest': digest,
+        'layers': [[diff_id, layer['size']] for diff_id, layer in zip(diff_ids, manifest['layers'])]
+    }
+
+
+def get_image_layers(images, digests=None, threads=LAYERS_THREADS, path=LAYERS_FILE):
+    """
+    Gets the layers of each of the images, see fetch_layers, fetching those
+    not cached concurrently.
+
+    :param images: List of image references
+    :param digests: Dict of the digest of the manifest each image is known to refer to, if any
+    :return: Dict mapping each image to its layers, or None if they could not be fetched
+    """
+    digests = digests or {}
+    state = StateFile(path)
+    cached = state.load()
+    now = time.time()
+
+    def is_fresh(image):
+        entry = cached.get(image)
+        if not entry:
+            return False
+        if digests.get(image):
+            return entry.get('digest') == digests[image]
+        return now - entry.get('fetched', 0) < LAYERS_TTL
+
+    layers = dict((image, cached[image]['layers']) for image in images if is_fresh(image))
+    missing = [image for image in images if image not in layers]
+
+    def fetch(image):
+        try:
+            return fetch_layers(image)
+        except (RequestException, ValueError, KeyError) as e:
+            logger.warning('Could not fetch the layers of %s: %s' % (image, e))
+            return None
+
+    if missing:
+        pool = ThreadPool(min(threads, len(missing)))
+        try:
+            fetched = pool.map(fetch, missing)
+        finally:
+            pool.terminate()
+
+        with state.update() as stored:
+            for image, entry in zip(missing, fetched):
+                if entry:
+                    stored[image] = dict(entry, fetched=now)
+
+        layers.update((image, entry and entry['layers']) for image, entry in zip(missing, fetched))
+
+    return layers
+
+
+def get_local_layers(client, threads=LAYERS_THREADS):
+    """
+    Finds the layers of every local image.
+
+    :return: Set of the uncompressed digests of the layers
+    """
+    def inspect(image_id):
+        try:
+            return (client.api.inspect_image(image_id).get('RootFS') or {}).get('Layers') or []
+        except APIError:
+            return []
+
+    image_ids = [image['Id'] for image in client.api.images()]
+    if not image_ids:
+        return set()
+
+    pool = ThreadPool(min(threads, len(image_ids)))
+    try:
+        return set(layer for image_layers in pool.map(inspect, image_ids) for layer in image_layers)
+    finally:
+        pool.terminate()
+
+
+def estimate_pull_cost(layers, local_layers):
+    """
+    :param layers: Layers of an image, see fetch_layers
+    :param local_layers: Layers of the local images, see get_local_layers
+    :return: tuple of the compressed size of the image and of the layers a pull would download
+    """
+    # An image may repeat a layer, which is only downloaded once
+    layers = dict(layers)
+
+    size = sum(layers.values())
+    missing = sum(layer_size for diff_id, layer_size in layers.items()
+                  if diff_id not in local_layers)
+
+    return size, missing
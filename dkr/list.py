@@ -7,10 +7,15 @@ import stat
 import docker
 import argparse
 
-from main import DKRConfig, print_tabulate, filter_local_image_tags
+from main import (DKRConfig, print_tabulate, format_size, format_time,
+                  iter_local_image_indices, load_image_metadata, update_image_metadata)
+from protocol import dump_record
 
+# Number of entrypoints whose local status is looked up per request to the docker daemon
+STATUS_BATCH_SIZE = 50
 
-def main(entrypoints, images, pipe):
+
+def main(entrypoints, images, pipe, status=True, stream=False):
     """
     dkr-List Main function.
 
@@ -20,6 +25,8 @@ def main(entrypoints, images, pipe):
     :param entrypoints: array of integers representing index values of entrypoints in the config
     :param images: array of integers representing index values of images assigned to an entrypoint
     :param pipe: boolean determining whether the tool output is being piped
+    :param status: boolean determining whether to check which images exist locally
+    :param stream: boolean determining whether to print each row as soon as it is ready
     """
     headers = ['#', 'Entrypoint', 'Images']
 
@@ -44,31 +51,80 @@ def main(entrypoints, images, pipe):
                 version for index, version in enumerate(entrypoint[2], start=1) if index in images
             ]
 
-    # If piping, output something machine readable
+    # If piping, output something machine readable, one record per entrypoint
     if pipe:
-        print(config.deserialise(output))
+        for _, entrypoint, versions in output:
+            dump_record(entrypoint, versions)
         return
 
-    # Get local tags
-    client = docker.from_env()
-    local_tags = filter_local_image_tags(client, [j for i in output for j in i[2]])
+    if status:
+        headers.append('Local')
+    headers.extend(['Size', 'Digest', 'Last used'])
+
+    rows = annotate(output, status)
 
-    # Annotate the config entries with local tags
-    headers.append('Local')
-    for entrypoint in output:
-        entrypoint.append(
-            [bool(version in local_tags) for version in entrypoint[2]]
-        )
+    # When streaming, print one line per image as soon as its entrypoint is annotated
+    if stream:
+        print('\t'.join(headers))
+        for row in rows:
+            for line in zip(*[column if isinstance(column, list) else [column] * len(row[2])
+                              for column in row]):
+                print('\t'.join(str(i) for i in line))
+            sys.stdout.flush()
+        return
 
     # Adjust the config for human readability
-    for entrypoint in output:
-        entrypoint[2] = "\n".join(i for i in entrypoint[2])
-        entrypoint[3] = "\n".join(str(i) for i in entrypoint[3])
+    output = []
+    for row in rows:
+        output.append([
+            "\n".join(str(i) for i in column) if isinstance(column, list) else column
+            for column in row])
 
     # Print it
     print_tabulate(headers, output)
 
 
+def annotate(output, status):
+    """
+    Annotates each serialised config entry with the local status of its images, if status
+    is True, and with their cached size, digest and time of last use.
+
+    Local status is looked up concurrently for batches of entrypoints, and the annotated
+    entries are yielded in order as soon as their batch is done. The cached metadata is
+    refreshed once all of the entries have been annotated.
+    """
+    metadata = load_image_metadata()
+
+    if status:
+        client = docker.from_env()
+        batches = [output[i:i + STATUS_BATCH_SIZE] for i in range(0, len(output), STATUS_BATCH_SIZE)]
+        indices = iter_local_image_indices(client, [[j for i in batch for j in i[2]] for batch in batches])
+    else:
+        batches, indices = [output], [None]
+
+    local_index = {}
+    for batch, index in zip(batches, indices):
+        for entrypoint in batch:
+            versions = entrypoint[2]
+
+            if index is not None:
+                local_index.update(index)
+                cached = [index.get(version) or {} for version in versions]
+                entrypoint.append([version in index for version in versions])
+            else:
+                cached = [metadata.get(version) or {} for version in versions]
+
+            entrypoint.append([format_size(c.get('size')) for c in cached])
+            entrypoint.append([(c.get('digest') or '-')[:19] for c in cached])
+            entrypoint.append([format_time((metadata.get(version) or {}).get('last_used'))
+                               for version in versions])
+
+            yield entrypoint
+
+    if status:
+        update_image_metadata([j for i in output for j in i[2]], local_index)
+
+
 def parse_arguments(argv):
     """
     Parse command-line arguments
@@ -94,6 +150,16 @@ def parse_arguments(argv):
                         default=[],
                         help='Filter image')
 
+    parser.add_argument('--no-status',
+                        dest='status',
+                        action='store_false',
+                        help='Do not check which images exist locally, only show cached metadata')
+
+    parser.add_argument('-s',
+                        '--stream',
+                        action='store_true',
+                        help='Print each image on its own tab separated line as soon as it is ready')
+
     args = parser.parse_args()
 
     return args
@@ -104,7 +170,7 @@ def run_main(args=sys.argv[1:]):
 
     pipe = stat.S_ISFIFO(os.fstat(1).st_mode)
 
-    return main(args.ENTRYPOINT, args.images, pipe)
+    return main(args.ENTRYPOINT, args.images, pipe, status=args.status, stream=args.stream)
 
 
 if __name__ == '__main__':
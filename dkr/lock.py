@@ -0,0 +1,104 @@
+"""
+Pin the images in your dkr config to the digests they currently refer to.
+"""
+import sys
+import argparse
+
+from main import DKRConfig, print_tabulate, errprint, resolve_image_digests
+from hosts import get_client
+
+
+def main(entrypoints, update=False, unlock=False):
+    """
+    dkr-lock Main function.
+
+    Resolves each version of the given entrypoints, or of every entrypoint, to the digest
+    of the image it refers to and stores the digest alongside it in the config. Versions
+    which are already pinned are left as they are unless update is True.
+
+    :param entrypoints: Names of the entrypoints to lock, all of them if empty
+    :param update: Re-resolve every version from its registry, following moved tags
+    :param unlock: Remove the digests instead
+    :return: 1 if any version could not be resolved, otherwise 0
+    """
+    config = DKRConfig()
+
+    unknown = [e for e in entrypoints if not config.get_entrypoint(e)]
+    if unknown:
+        errprint('dkr-lock: Unknown entrypoints %s' % ', '.join(unknown))
+        return 1
+
+    versions = [(entrypoint, version) for entrypoint in entrypoints or sorted(config.get_entrypoints())
+                for version in config.get_entrypoint(entrypoint)['versions']]
+
+    if unlock:
+        for entrypoint, version in versions:
+            config.set_version_digest(entrypoint, version, None)
+        config.write()
+        return 0
+
+    to_resolve = [(e, v) for e, v in versions if update or not config.get_version_digest(e, v)]
+    digests = resolve_image_digests(get_client(), [v for _, v in to_resolve], registry=update,
+                                    mirrors=config.get_settings().get('mirrors'))
+    resolved = dict(zip(to_resolve, digests))
+
+    rows = []
+    for entrypoint, version in versions:
+        previous = config.get_version_digest(entrypoint, version)
+        digest = resolved.get((entrypoint, version), previous)
+
+        if not digest:
+            status = 'unresolved'
+        elif digest == previous:
+            status = 'unchanged'
+        else:
+            status = 'updated' if previous else 'locked'
+            config.set_version_digest(entrypoint, version, digest)
+
+        rows.append([entrypoint, version, (digest or previous or '-')[:19], status])
+
+    config.write()
+    print_tabulate(['Entrypoint', 'Image', 'Digest', 'Status'], rows)
+
+    return 1 if any(row[-1] == 'unresolved' for row in rows) else 0
+
+
+def parse_arguments(argv):
+    """
+    Parse command-line arguments
+
+    :param argv: command line arguments
+    :return: parsed command-line arguments (argparse)
+    """
+    description = ('Pin the images in your dkr config to the digests they refer to, so that '
+                   'dkr keeps running the same images even when their tags move.')
+
+    parser = argparse.ArgumentParser(description=description)
+
+    parser.add_argument('ENTRYPOINT',
+                        action='store',
+                        nargs='*',
+                        help='Entrypoints to lock, all of them by default')
+
+    parser.add_argument('-u',
+                        '--update',
+                        action='store_true',
+                        help='Re-resolve pinned versions from their registries')
+
+    parser.add_argument('--unlock',
+                        action='store_true',
+                        help='Remove the digests, so that the versions follow their tags again')
+
+    args = parser.parse_args(argv)
+
+    return args
+
+
+def run_main(args=sys.argv[1:]):
+    args = parse_arguments(args)
+
+    return main(args.ENTRYPOINT, update=args.update, unlock=args.unlock)
+
+
+if __name__ == '__main__':
+    sys.exit(run_main())
@@ -1,19 +1,83 @@
 #!/usr/bin/env python
 import os
+import re
 import sys
+import glob
+import stat
 import yaml
+import fcntl
 import signal
 import docker
 import logging
+import tempfile
 import subprocess
 import time
 
 from tabulate import tabulate
 from docker.errors import APIError
+from requests.exceptions import RequestException
+from multiprocessing.pool import ThreadPool
+
+from state import StateFile, makedirs
+from resources import prepare_resources, validate_resources
+from profiles import get_profile, prepare_profile, validate_profiles
+from hosts import CLIENTS, get_client, load_hosts, select_host, validate_hosts
+from mirrors import (validate_mirrors, get_mirror_references, rank_mirror_references,
+                     record_mirror_failure)
+from datasets import validate_datasets, get_datasets
+from admission import validate_admission, admit, CREATING, RUNNING, LOCAL_HOST
+from launch import (HOME, CONFIG_FILE, STATE_DIR, IMAGE_CACHE_FILE, OWNER_PID_LABEL,
+                    OWNER_START_LABEL, OWNER_HOST_LABEL, OWNER_UID_LABEL, ENTRYPOINT_LABEL,
+                    STARTED_LABEL, get_process_start_time, get_owner_labels, record_image_use,
+                    make_mapping, prepare_volumes, rewrite_invocation, collapse_volumes,
+                    find_dataset_path, find_direct_stdio, quote)
 
-HOME = os.path.expanduser('~')
-CONFIG_FILE = os.path.join(HOME, '.dkr')
 DOCKER_IMAGE_VERSION_DELIM = ':'
+DOCKER_HUB_PREFIXES = ['docker.io/library/', 'docker.io/', 'library/']
+LOCAL_STATUS_THREADS = 8
+
+# Options given to dkr before the base, mapped to their names
+DKR_OPTIONS = {
+    '-p': 'profile',
+    '--profile': 'profile',
+    '-o': 'outputs',
+    '--output': 'outputs',
+    '--resolution': 'resolution'
+}
+# Options which may be given more than once
+DKR_LIST_OPTIONS = ['outputs']
+# Options which take no value
+DKR_FLAGS = {
+    '--cache': 'cache',
+    '--stdout-only': 'stdout_only',
+    '--glob': 'expand_globs'
+}
+
+# Invocations longer than this are handed to the container in an argfile, keeping well within
+# the ARG_MAX of the docker CLI on the host, which also has to fit its environment
+ARGUMENT_LIMIT = 128 * 1024
+ARGFILE_DIR = os.path.join(STATE_DIR, 'args')
+# Argfiles are named after the pid and start time of their dkr, see dkr-reap
+ARGFILE_PREFIX = 'args-%d-%d-'
+ARGFILE_STATUS = '.status'
+# Headroom left under the container's ARG_MAX for its environment when xargs runs the command
+ARGUMENT_HEADROOM = 64 * 1024
+GLOB_WILDCARDS = re.compile(r'(\*|\?|\[[^]/]+\])')
+
+# How the version of an entrypoint is chosen when none is selected, see resolve_local_version
+STRICT = 'strict'
+PREFER_LOCAL = 'prefer-local'
+PREFER_LOCAL_THEN_PULL = 'prefer-local-then-background-pull'
+RESOLUTION_POLICIES = [STRICT, PREFER_LOCAL, PREFER_LOCAL_THEN_PULL]
+PULL_LOCK_DIR = os.path.join(STATE_DIR, 'pulls')
+
+# Selects every version of an entrypoint, e.g. minimap2::*, to compare them with dkr-compare
+COMPARE_SELECTOR = '*'
+
+# Signals on which dkr stops the active container before exiting
+SHUTDOWN_SIGNALS = [signal.SIGINT, signal.SIGTERM, signal.SIGHUP]
+# Marks of the containers being stopped by shutdown(), after their dkr has exited
+STOPPING_DIR = os.path.join(STATE_DIR, 'stopping')
 
 ACTIVE_CONTAINER = None
 
@@ -48,12 +112,50 @@ def print_tabulate(headers, rows, print_total_rows=True):
 
 def signal_handler(signal, frame):
     """
-    Used to interrupt SIGINT and kill the active container, if one is set.
+    Used to interrupt SIGINT, SIGTERM and SIGHUP and kill the active container, if one is set.
     """
     if ACTIVE_CONTAINER:
         shutdown(ACTIVE_CONTAINER)
 
 
+def format_size(size):
+    """
+    Formats a size in bytes for humans, e.g. 1.5G
+    """
+    if size is None:
+        return '-'
+
+    for unit in ['B', 'K', 'M', 'G']:
+        if abs(size) < 1024:
+            return '%.1f%s' % (size, unit) if unit != 'B' else '%d%s' % (size, unit)
+        size /= 1024.0
+
+    return '%.1fT' % size
+
+
+def parse_size(size):
+    """
+    Parses a human readable size, e.g. 50G or 512M, into a number of bytes
+    """
+    units = {'B': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    size = str(size).strip().upper().rstrip('B') or '0'
+
+    if size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+
+    return int(float(size))
+
+
+def format_time(timestamp):
+    """
+    Formats a unix timestamp for humans, or '-' if there is none
+    """
+    if not timestamp:
+        return '-'
+
+    return time.strftime('%Y-%m-%d %H:%M', time.localtime(timestamp))
+
+
 def merge_two_dicts(x, y):
     """
     Given two dicts, merge them into a new dict as a shallow copy.
@@ -63,13 +165,47 @@ def merge_two_dicts(x, y):
     return z
 
 
-def shutdown(container):
+def quote_glob(pattern):
+    """
+    Quotes a glob for sh, leaving only its wildcards unquoted for sh to expand,
+    e.g. /data/my reads/*.fastq becomes '/data/my reads/'*'.fastq'
+    """
+    return ''.join(part if i % 2 else (quote(part) if part else '')
+                   for i, part in enumerate(GLOB_WILDCARDS.split(pattern)))
+
+
+def mark_stopping(container_id, directory=STOPPING_DIR):
+    """
+    Marks a container as being stopped by a process other than the one it is labelled with,
+    so that dkr-reap leaves it alone. Failing to do so is never fatal.
+    """
+    try:
+        makedirs(directory)
+        open(os.path.join(directory, container_id), 'w').close()
+    except (IOError, OSError) as e:
+        logger.debug('Could not mark %s as stopping: %s' % (container_id, e))
+
+
+def unmark_stopping(container_id, directory=STOPPING_DIR):
+    try:
+        os.remove(os.path.join(directory, container_id))
+    except OSError:
+        pass
+
+
+def shutdown(container, exit_parent=True):
     """
     Its the double-fork-pirouette method for rapidly killing the
     main process and returning control to the user once they have sent SIGINT, whilst making
     sure the grand-child of the main process cleanly disposes of the docker container.
+
+    :param exit_parent: Whether the main process exits at once, as on a signal, or returns to
+                        its caller, e.g. to exit with the return code of the command
     """
 
+    # The container outlives the process it is labelled with while the grand-child stops it
+    mark_stopping(container.id)
+
     # Piping in unix redirects channel/fd 1, if we fork, we will have double pipe communication
     # at this point no more communication is needed, so we close the pipe (clannel 1) before forking.
     os.close(1)
@@ -77,6 +213,11 @@ def shutdown(container):
     try:
         pid = os.fork()
         if pid:
+            if not exit_parent:
+                # The first child exits as soon as it has forked the grand-child
+                os.waitpid(pid, 0)
+                return
+
             # exit first parent
             sys.exit(0)
 
@@ -105,7 +246,8 @@ def shutdown(container):
         container.remove()
     except APIError:
         pass
-
+    finally:
+        unmark_stopping(container.id)
 
 
 def get_image_tagged_version(image):
@@ -149,20 +291,213 @@ def match_to_image_tag(client, image):
 
 
 def filter_local_image_tags(client, tags):
-    found_images = []
+    return list(get_local_image_index(client, tags))
+
+
+def canonical_image_reference(image):
+    """
+    Normalises an image reference the same way the docker daemon reports
+    its tags, i.e. with a version and without the docker hub prefixes.
+    """
+    if '@' not in image and not get_image_tagged_version(image):
+        image = set_image_tagged_version(image)
+
+    for prefix in DOCKER_HUB_PREFIXES:
+        if image.startswith(prefix):
+            return image[len(prefix):]
+
+    return image
+
+
+def get_image_repository(image):
+    """
+    Strips the version, i.e. the tag or digest, from an image reference
+    """
+    image = image.split('@')[0]
+
+    if get_image_tagged_version(image):
+        return image.rsplit(DOCKER_IMAGE_VERSION_DELIM, 1)[0]
+
+    return image
+
+
+def pin_image_reference(image, digest):
+    """
+    Makes the reference to the image with the given digest in the image's repository,
+    e.g. quay.io/biocontainers/bwa@sha256:...
+    """
+    return '%s@%s' % (get_image_repository(image), digest)
+
+
+def resolve_image_digest(client, image, registry=False, mirrors=None):
+    """
+    Resolves an image reference to the digest of the image it currently refers to,
+    from the local image if there is one, otherwise by asking its registry.
+
+    :param client: Docker client
+    :param image: Image reference, e.g. as found in the config
+    :param registry: Always ask the registry, e.g. to follow a tag which has moved
+    :param mirrors: Mirrors of registries from the settings, to ask before the image's registry
+    :return: The digest, e.g. sha256:..., or None if it could not be resolved
+    """
+    if '@' in image:
+        return image.split('@', 1)[1]
+
+    if not get_image_tagged_version(image):
+        image = set_image_tagged_version(image)
+
+    if not registry:
+        try:
+            repo_digests = client.api.inspect_image(image).get('RepoDigests') or []
+        except (APIError, RequestException):
+            repo_digests = []
+
+        # An image may have been pulled from several repositories, so pick the digest of this
+        # one, or of one of its mirrors, which serve the same digests
+        repositories = [image] + [reference for _, reference in get_mirror_references(image, mirrors)]
+        for repo_digest in repo_digests:
+            digest = repo_digest.split('@')[-1]
+            if canonical_image_reference(repo_digest) in [
+                    canonical_image_reference(pin_image_reference(r, digest)) for r in repositories]:
+                return digest
+
+    for reference in rank_mirror_references(image, mirrors):
+        try:
+            return client.images.get_registry_data(reference).id
+        except (APIError, RequestException) as e:
+            logger.debug('Could not resolve the digest of %s: %s' % (reference, e))
+
+    try:
+        return client.images.get_registry_data(image).id
+    except (APIError, RequestException) as e:
+        logger.warning('Could not resolve the digest of %s: %s' % (image, e))
+        return None
+
+
+def resolve_image_digests(client, images, registry=False, mirrors=None,
+                          threads=LOCAL_STATUS_THREADS):
+    """
+    Runs resolve_image_digest for each of the images concurrently.
+
+    :return: List of digests, or None for those which could not be resolved, in the same order
+    """
+    if not images:
+        return []
+
+    pool = ThreadPool(min(threads, len(images)))
+
+    try:
+        return pool.map(lambda image: resolve_image_digest(client, image, registry=registry,
+                                                           mirrors=mirrors), images)
+    finally:
+        pool.terminate()
+
+
+def get_local_image_index(client, images):
+    """
+    Finds which of the given image references exist locally with a single
+    request, filtered by the daemon, rather than listing every local image.
+
+    :param client: Docker client
+    :param images: List of image references, e.g. as found in the config
+    :return: Dict mapping each local image reference to its metadata
+    """
+    references = dict((canonical_image_reference(image), image) for image in images)
+    index = {}
+
+    if not references:
+        return index
+
+    for image in client.api.images(filters={'reference': list(references)}):
+        repo_digests = image.get('RepoDigests') or []
+
+        for tag in (image.get('RepoTags') or []) + repo_digests:
+            if tag in references:
+                index[references[tag]] = {
+                    'id': image['Id'],
+                    'size': image['Size'],
+                    'created': image['Created'],
+                    'tags': image.get('RepoTags') or [],
+                    'digest': repo_digests[0].split('@')[-1] if repo_digests else None
+                }
+
+    return index
+
 
-    for image in client.images.list():
-        for tag in tags:
-            if tag in image.tags:
-                found_images.append(tag)
+def iter_local_image_indices(client, image_batches, threads=LOCAL_STATUS_THREADS):
+    """
+    Runs get_local_image_index for each batch of image references concurrently,
+    yielding the resulting indices in the same order as the batches.
+    """
+    pool = ThreadPool(threads)
+
+    try:
+        for index in pool.imap(lambda batch: get_local_image_index(client, batch), image_batches):
+            yield index
+    finally:
+        pool.terminate()
+
+
+def load_image_metadata():
+    """
+    Loads the cached metadata, e.g. size, digest and time of last use,
+    of the images dkr has seen.
+    """
+    return StateFile(IMAGE_CACHE_FILE).load()
+
+
+def update_image_metadata(images, index):
+    """
+    Updates the cached metadata of the given images from a local image index,
+    forgetting the size and digest of any image which is no longer local.
+    """
+    with StateFile(IMAGE_CACHE_FILE).update() as cache:
+        for image in images:
+            entry = cache.setdefault(image, {})
+            entry.update(index.get(image, dict.fromkeys(['id', 'size', 'created', 'tags', 'digest'])))
+
+
+def docker_command(host_url=None):
+    """
+    Returns the docker cli command, pointed at the given docker host if there is one
+    """
+    return ['docker', '-H', host_url] if host_url else ['docker']
+
+
+def pull_docker_image(image, host_url=None, mirrors=None):
+    """
+    Pulls the image, from the fastest healthy mirror of its registry if there are mirrors,
+    and otherwise, or if every mirror fails, from its registry.
+
+    Images pulled by tag from a mirror are tagged with their own reference instead.
+    Images pulled by digest can't be tagged with their own reference, so keep their mirror's.
 
-    return list(set(found_images))
+    :param mirrors: Mirrors of registries from the settings, see mirrors.py
+    :return: The reference under which the image was pulled
+    """
+    for reference in rank_mirror_references(image, mirrors):
+        if not _pull_docker_image(reference, host_url):
+            if '@' in reference:
+                return reference
+
+            if subprocess.call(docker_command(host_url) + ['tag', reference, image]):
+                return reference
+
+            with open(os.devnull, 'w') as devnull:
+                subprocess.call(docker_command(host_url) + ['rmi', reference],
+                                stdout=devnull, stderr=devnull)
+            return image
+
+        record_mirror_failure(image, reference, mirrors)
 
+    _pull_docker_image(image, host_url)
+    return image
 
-def pull_docker_image(image):
+
+def _pull_docker_image(image, host_url=None):
     try:
-        subprocess.Popen(
-            ['docker', 'pull', image],
+        return subprocess.Popen(
+            docker_command(host_url) + ['pull', image],
             stdin=sys.stdin,
             stdout=sys.stderr,
             stderr=sys.stderr).wait()
@@ -170,6 +505,108 @@ def pull_docker_image(image):
         logger.warning('Could not pull docker image, please check the URI.')
 
 
+def validate_resolution(resolution):
+    """
+    Checks that the resolution policy is one of RESOLUTION_POLICIES.
+    """
+    if resolution is not None and resolution not in RESOLUTION_POLICIES:
+        raise KeyError('Unknown resolution policy %s, expected one of %s' % (
+            resolution, ', '.join(RESOLUTION_POLICIES)))
+
+
+def find_local_version(client, versions, digests=None):
+    """
+    Finds the first of the versions which exists locally, by the digest it is pinned to
+    if it is pinned, as that is the image dkr would run.
+
+    :param digests: Dict of the digest each version is pinned to, from the settings
+    :return: The version, or None if none of them is local
+    """
+    digests = digests or {}
+    index = get_local_image_index(client, [v for v in versions if not digests.get(v)])
+
+    for version in versions:
+        if not digests.get(version):
+            if version in index:
+                return version
+            continue
+
+        try:
+            client.api.inspect_image(pin_image_reference(version, digests[version]))
+            return version
+        except docker.errors.ImageNotFound:
+            pass
+
+    return None
+
+
+def start_background_pull(image, settings):
+    """
+    Pulls the image in a detached process, as dkr would before running it, unless
+    another dkr is pulling it already. Progress is not reported.
+    """
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return
+
+    try:
+        # The grandchild is left to init, so that nobody has to wait for it
+        os.setsid()
+        if os.fork():
+            os._exit(0)
+
+        with open(os.devnull, 'r+') as devnull:
+            for fd in [0, 1, 2]:
+                os.dup2(devnull.fileno(), fd)
+
+        makedirs(PULL_LOCK_DIR)
+        lock_path = os.path.join(PULL_LOCK_DIR, re.sub(r'[^\w.-]+', '_', image) + '.lock')
+        with open(lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+            # The parent's docker connections can't be shared
+            CLIENTS.clear()
+            DKRContainer(image, [], None, auto_prepare=False, settings=settings)._prepare_image(image)
+    except BaseException as e:
+        logger.debug('Background pull of %s stopped: %s' % (image, e))
+    finally:
+        os._exit(0)
+
+
+def resolve_local_version(config, base, entrypoint, image, settings):
+    """
+    Applies the resolution policy of the settings to the image the base was resolved to,
+    see DKRConfig.resolve, when the base is an entrypoint without a version selected:
+
+        strict:       run the default version, pulling it if it is missing
+        prefer-local: run the first version which is local, if the default isn't
+        prefer-local-then-background-pull: as prefer-local, and start pulling the default
+                      in the background for the next run
+
+    Runs on a pool of hosts always use the default, which is preferred where it is local.
+
+    :return: The image to run
+    """
+    resolution = settings.get('resolution') or STRICT
+
+    if resolution == STRICT or not entrypoint or config.ENTRYPOINT_DELIM in base or \
+            load_hosts(settings):
+        return image
+
+    local = find_local_version(get_client(), config.get_entrypoint(entrypoint)['versions'],
+                               settings.get('digests'))
+
+    if not local or local == image:
+        return image
+
+    logger.info('%s is not local, running %s instead' % (image, local))
+    if resolution == PREFER_LOCAL_THEN_PULL:
+        start_background_pull(image, settings)
+
+    return local
+
+
 class DKRConfig:
     """
     Contains a set of methods for working with the DKR config.
@@ -188,9 +625,24 @@ class DKRConfig:
         'dkr bwa::quay.io/biocontainers/bwa:latest mem etc...'
 
     DKR's autocomplete functionality can assist the user in selecting an alternative version.
+
+    'dkr-add' and 'dkr-lock' pin each version to the digest of the image it refers to, so that
+    moving tags like 'latest' keep running the same image until the entrypoint is locked again:
+
+    bwa:
+      versions:
+        - quay.io/biocontainers/bwa:latest
+      digests:
+        quay.io/biocontainers/bwa:latest: sha256:...
+
+    Settings which apply to every entrypoint are kept under the reserved '_settings' key, e.g.
+
+    _settings:
+      direct_io: false
     """
     ENTRYPOINT_DELIM = '::'
     DEFAULT_ENTRYPOINT_VERSION = 'latest'
+    SETTINGS_KEY = '_settings'
 
     def __init__(self, path=CONFIG_FILE, auto_load=True):
         """
@@ -232,6 +684,16 @@ class DKRConfig:
         all_entrypoints = []
 
         for key, value in config.items():
+            if key == self.SETTINGS_KEY:
+                validate_resources((value or {}).get('resources'))
+                validate_profiles((value or {}).get('profiles'))
+                validate_hosts((value or {}).get('hosts'))
+                validate_mirrors((value or {}).get('mirrors'))
+                validate_datasets((value or {}).get('datasets'))
+                validate_resolution((value or {}).get('resolution'))
+                validate_admission((value or {}).get('admission'))
+                continue
+
             # Check that each image has 'versions'
             versions = value.get('versions', [])
             if not versions:
@@ -241,6 +703,11 @@ class DKRConfig:
             if key in all_entrypoints:
                 raise ValueError('Duplicate entrypoint found, %s' % key)
 
+            validate_resources(value.get('resources'))
+            validate_datasets(value.get('datasets'))
+            validate_resolution(value.get('resolution'))
+            validate_admission(value.get('admission'))
+
             all_entrypoints.append(key)
 
         return config
@@ -312,6 +779,30 @@ class DKRConfig:
         """
         return delimeter.join([name, version])
 
+    def get_entrypoints(self):
+        """
+        Gets the names of all of the entrypoints in self.config
+
+        :return: List of entrypoint names
+        """
+        return [key for key in (self.config or {}) if key != self.SETTINGS_KEY]
+
+    def get_settings(self, entrypoint=None):
+        """
+        Gets the settings in self.config, overridden by any settings of the same
+        name given for the specified entrypoint.
+
+        :param entrypoint: Optionally, the name of the entrypoint being used
+        :return: Dict of settings
+        """
+        settings = dict((self.config or {}).get(self.SETTINGS_KEY) or {})
+
+        for key, value in (self.get_entrypoint(entrypoint) or {}).items():
+            if key != 'versions':
+                settings[key] = value
+
+        return settings
+
     def get_entrypoint(self, entrypoint):
         """
         Gets the specified entrypoint from self.config
@@ -323,6 +814,9 @@ class DKRConfig:
             logger.debug('Cannot get an entrypoint from an empty config')
             return
 
+        if entrypoint == self.SETTINGS_KEY:
+            return None
+
         try:
             return self.config.get(entrypoint, None)
         except AttributeError:
@@ -404,10 +898,80 @@ class DKRConfig:
 
         versions = [v for v in versions if v != version]
         new_config[entrypoint]['versions'] = versions
+        self.set_version_digest(entrypoint, version, None)
 
         if self.validate(config=new_config):
             self.config = new_config
 
+    def reorder_entrypoint_versions(self, entrypoint, versions):
+        """
+        Reorders the versions of an entrypoint, making the first of them the default.
+
+        :param entrypoint: The entrypoint whose versions should be reordered
+        :param versions: The same versions as the entrypoint has, in the new order
+        """
+        entrypoint_val = self.get_entrypoint(entrypoint)
+
+        if not entrypoint_val:
+            logger.error('Cannot reorder versions of non-existent entrypoint')
+            return
+
+        if sorted(versions) != sorted(entrypoint_val.get('versions', [])):
+            logger.error('Cannot reorder versions to a different set of versions')
+            return
+
+        entrypoint_val['versions'] = list(versions)
+
+    def get_version_digest(self, entrypoint, version):
+        """
+        Gets the digest which a version of an entrypoint is pinned to
+
+        :return: The digest, or None if the version is not pinned
+        """
+        return ((self.get_entrypoint(entrypoint) or {}).get('digests') or {}).get(version)
+
+    def set_version_digest(self, entrypoint, version, digest):
+        """
+        Pins a version of an entrypoint to the given digest, or unpins it if digest is None
+        """
+        entrypoint_val = self.get_entrypoint(entrypoint)
+
+        if not entrypoint_val:
+            logger.error('Cannot pin version of non-existent entrypoint')
+            return
+
+        digests = entrypoint_val.get('digests') or {}
+
+        if digest:
+            digests[version] = digest
+        else:
+            digests.pop(version, None)
+
+        if digests:
+            entrypoint_val['digests'] = digests
+        else:
+            entrypoint_val.pop('digests', None)
+
+    def resolve(self, base):
+        """
+        Resolves the base given to dkr, which may be an entrypoint, an entrypoint with
+        a specific version selected, e.g. 'bwa::quay.io/biocontainers/bwa:latest', or
+        a docker image reference which is not in the config.
+
+        :param base: The base given to dkr
+        :return: tuple of the entrypoint, or None if base is not in the config, and the image
+        """
+        if self.ENTRYPOINT_DELIM in base:
+            entrypoint, version = base.split(self.ENTRYPOINT_DELIM, 1)
+            if self.get_entrypoint(entrypoint):
+                return entrypoint, version
+
+        image = self.get_entrypoint_default_version(base)
+        if image:
+            return base, image
+
+        return None, base
+
     def get_entrypoint_default_version(self, entrypoint):
         """
         Gets the default, i.e. the first list item, in the list
@@ -434,7 +998,9 @@ class DKRConfig:
 
         self.validate(config)
 
-        for index, item in enumerate(config.items(), start=1):
+        entrypoints = [item for item in config.items() if item[0] != self.SETTINGS_KEY]
+
+        for index, item in enumerate(entrypoints, start=1):
             serialised_config.append([index, item[0], item[1]['versions']])
 
         return serialised_config
@@ -461,29 +1027,67 @@ class DKRContainer:
     Methods for preparing, initialising and executing instructions in a docker container
     for use by DKR
     """
-    DEFAULT_MAPPINGS = [os.getcwd(), HOME]
-
-    def __init__(self, image, invocation, flags, auto_prepare=True):
+    def __init__(self, image, invocation, flags, auto_prepare=True, settings=None,
+                 stdin=None, stdout=None, stderr=None, entrypoint=None):
         """
         Initialises a Command instance.
+
+        :param settings: Optional dict of settings from the config, see DKRConfig.get_settings
+        :param stdin: Optional file to use as the stdin of the command, instead of sys.stdin
+        :param stdout: Optional file to use as the stdout of the command, instead of sys.stdout
+        :param stderr: Optional file to use as the stderr of the command, instead of sys.stderr
+        :param entrypoint: Optional name of the entrypoint being run, to label the container with
         """
-        self.client = docker.from_env()
+        self.client = get_client()
         self.container = None
+        self.settings = settings or {}
+        self.datasets = get_datasets(self.settings)
+        self.entrypoint = entrypoint or image
+        self.version = image
+        self.usage = None
+        self.host = None
+        self.argfile = None
+        self.running_slot = None
+        self.creating_slot = None
+        self.stdin = stdin or sys.stdin
+        self.stdout = stdout or sys.stdout
+        self.stderr = stderr or sys.stderr
 
         if auto_prepare:
+            self.stdio = self._prepare_stdio() if self.settings.get('direct_io', True) else {}
+            self.host = self._prepare_host(image, invocation)
+
+            if self.host:
+                self.client = self.host.get_client()
+
+                # Stream any stdio files which the host can't see
+                if not self.host.can_mount([path for path, _ in self.stdio.values()]):
+                    self.stdio = {}
+
             self.image = self._prepare_image(image)
-            self.volumes = self._prepare_volumes(invocation, *self.DEFAULT_MAPPINGS)
-            self.invocation = self._prepare_invocation(invocation, self.volumes)
-            self.flags = flags
-            self.environment = self._prepare_environment()
+            self.volumes = self._prepare_volumes(
+                invocation + [path for path, _ in self.stdio.values()], *self._default_mappings())
+            self.globs = self._prepare_globs(invocation)
+            self.invocation = self._prepare_invocation(invocation, self.volumes, self.stdio,
+                                                       self.globs)
+            self.flags = self._prepare_flags(flags, self.stdio)
+            self.resources, resource_environment = prepare_resources(self.settings.get('resources'))
+            self.profile = prepare_profile(
+                get_profile(self.settings.get('profile'), self.settings.get('profiles')))
+            self.environment = merge_two_dicts(self._prepare_environment(), resource_environment)
             self.working_directory = self._prepare_working_directory()
             self.user = self._prepare_user()
+            self.labels = self._prepare_labels(self.entrypoint)
 
             logger.debug('DKR-DEBUG')
+            logger.debug(self.host and self.host.name)
             logger.debug(self.image)
+            logger.debug(self.stdio)
             logger.debug(self.volumes)
             logger.debug(self.invocation)
             logger.debug(self.environment)
+            logger.debug(self.resources)
+            logger.debug(self.profile)
             logger.debug(self.working_directory)
             logger.debug(self.user)
 
@@ -492,22 +1096,66 @@ class DKRContainer:
         Calls all of the methods to prepare and launch a docker container based
         on the specified image and subsequently executes the invocation on it.
 
+        Waits for admission first, unless wait_for_admission has been called already.
+        The running slot is held until the container is removed, or this process and any
+        it forked have exited, and is released straight away if the launch fails.
+
         :param image: The image to base the container on
         :param invocation: The command to be executed on the docker container
         """
-        self.container = self._launch_container(
-            self.client,
-            self.image,
-            self.volumes,
-            self.environment,
-            self.working_directory,
-            self.user
-        )
+        self.wait_for_admission()
+
+        try:
+            self.container = self._launch_container(
+                self.client,
+                self.image,
+                collapse_volumes(self.volumes),
+                self.environment,
+                self.working_directory,
+                self.user,
+                resources=self.resources,
+                profile=self.profile,
+                labels=self.labels
+            )
+        except BaseException:
+            self.release_admission()
+            raise
+        finally:
+            if self.creating_slot:
+                self.creating_slot.release()
+                self.creating_slot = None
 
         return self.container
 
+    def wait_for_admission(self, cancelled=None):
+        """
+        Waits for a running and then a creating slot, if the settings limit how many
+        containers may be running and being created at once, see admission.py.
+
+        :param cancelled: Optional function telling whether to give up waiting
+        """
+        admission = self.settings.get('admission')
+        host = self.host.name if self.host else LOCAL_HOST
+
+        if not self.running_slot:
+            self.running_slot = admit(admission, RUNNING, host, cancelled=cancelled)
+
+        if not self.creating_slot and not (cancelled and cancelled()):
+            self.creating_slot = admit(admission, CREATING, host, cancelled=cancelled)
+
+    def release_admission(self):
+        """
+        Releases any slots held, see wait_for_admission.
+        """
+        for slot in [self.creating_slot, self.running_slot]:
+            if slot:
+                slot.release()
+
+        self.creating_slot = self.running_slot = None
+
     @staticmethod
-    def _launch_container(client, image, volumes, environment, working_directory, user):
+    def _launch_container(client, image, volumes, environment, working_directory, user,
+                          resources=None, profile=None, labels=None):
         """
         Utilises dockerpy to create an active container which will sit
         idle until used or terminated.
@@ -517,6 +1165,9 @@ class DKRContainer:
         :param environment: Sets the environment variables in the container
         :param working_directory: Sets the working directory in the container
         :param user: Sets the user mapping in the container
+        :param resources: Sets the resource limits of the container, see prepare_resources
+        :param profile: Sets the run profile options of the container, see prepare_profile
+        :param labels: Sets the labels of the container
         :return: Dockerpy container object
         """
         try:
@@ -528,7 +1179,9 @@ class DKRContainer:
                 volumes=volumes,
                 working_dir=working_directory,
                 environment=environment,
-                user=user
+                user=user,
+                labels=labels or {},
+                **merge_two_dicts(resources or {}, profile or {})
             )
         except docker.errors.ImageNotFound:
             logger.error('Could not pull docker image, it might not exist.')
@@ -536,51 +1189,132 @@ class DKRContainer:
 
         return container
 
+    def remove_container(self):
+        """
+        Stops and removes the container in the current process, for callers which carry
+        on after the command has finished rather than handing over to shutdown().
+        """
+        if self.container:
+            try:
+                self.container.stop()
+                self.container.remove()
+            except APIError:
+                pass
+
+            self.container = None
+
+        self.release_admission()
+
     def execute_command(self):
-        rt = self._execute_command(self.container.id, self.invocation, flags=self.flags)
+        accounting = None
+        if (self.settings.get('history') or {}).get('enabled'):
+            from history import RunAccounting
+            accounting = RunAccounting(self)
+            accounting.start()
+
+        try:
+            rt = self._execute_command(self.container.id, self.invocation, flags=self.flags,
+                                       host_url=self.host and self.host.url,
+                                       stdin=self.stdin, stdout=self.stdout, stderr=self.stderr)
+        finally:
+            if self.argfile:
+                for path in [self.argfile, self.argfile + ARGFILE_STATUS]:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                self.argfile = None
+
+        if accounting:
+            self.usage = accounting.finish(rt)
+
+        # The container wrote straight to the file behind stdout, so catch up with it
+        if 1 in self.stdio and stat.S_ISREG(os.fstat(self.stdout.fileno()).st_mode):
+            os.lseek(self.stdout.fileno(), 0, os.SEEK_END)
 
         return rt
 
     @staticmethod
-    def _execute_command(container_id, invocation, flags=None):
+    def _execute_command(container_id, invocation, flags=None, host_url=None,
+                         stdin=None, stdout=None, stderr=None):
         """
         Invokes a docker exec command via subprocess on the docker container with an id
         matching container_id.
 
         :param container_id: id of the container on which to execute the docker exec command
         :param invocation: array of arguments constituting the command to execute
+        :param host_url: url of the docker host running the container, if not the default
+        :param stdin, stdout, stderr: files to connect the command to, sys.stdin etc. by default
         :return: subprocess command exit status
         """
-        flags = flags or ['-i']
+        flags = ['-i'] if flags is None else flags
+        stdin, stdout, stderr = stdin or sys.stdin, stdout or sys.stdout, stderr or sys.stderr
 
-        command = ['docker', 'exec'] + flags + [container_id] + invocation
-        rt = subprocess.Popen(command, stdin=sys.stdin, stdout=sys.stdout, stderr=sys.stderr).wait()
-        sys.stdout.flush()
-        sys.stderr.flush()
+        command = docker_command(host_url) + ['exec'] + flags + [container_id] + invocation
+        rt = subprocess.Popen(command, stdin=stdin, stdout=stdout, stderr=stderr).wait()
+        stdout.flush()
+        stderr.flush()
 
         return rt
 
     # Launch preparation methods
+    @staticmethod
+    def _default_mappings():
+        """
+        Returns the paths which are always mounted, i.e. the present working
+        directory and the home directory, as they are at the time of the call
+        """
+        return [os.getcwd(), os.path.expanduser('~')]
+
+    def _prepare_host(self, image, invocation):
+        """
+        Selects the docker host to run the container on, if a pool of hosts is configured.
+
+        :return: The selected DockerHost, or None to use the default docker host
+        """
+        hosts = load_hosts(self.settings)
+
+        if not hosts:
+            return None
+
+        paths = list(self._prepare_volumes(invocation, *self._default_mappings()))
+        host = select_host(hosts, canonical_image_reference(image), paths)
+
+        if not host:
+            logger.error('No reachable docker host can mount all of %s' % ', '.join(sorted(paths)))
+            sys.exit(1)
+
+        return host
+
     def _prepare_volumes(self, paths, *default_mappings):
         """
         Algorithm for preparing the volumes required for
-        mounting within the docker container
+        mounting within the docker container, see launch.prepare_volumes
         """
-        to_map = list(default_mappings) or []
+        return prepare_volumes(paths, default_mappings, self.datasets)
 
-        for path in paths:
-            extant_path = self.__find_closest_path_to_string(path)
-            if extant_path:
-                # TODO: Make this much smarter, yield the enclosing dir only when needed, if possible
-                to_map.extend([os.path.abspath(extant_path), os.path.abspath(os.path.dirname(extant_path))])
+    def _prepare_stdio(self):
+        """
+        Finds which of stdin and stdout can be used directly, see launch.find_direct_stdio
+        """
+        return find_direct_stdio({0: self.stdin, 1: self.stdout, 2: self.stderr})
 
-        return self._make_mappings(to_map)
+    def _prepare_flags(self, flags, stdio):
+        """
+        Returns the docker exec flags, which only need to keep stdin
+        open when it is being streamed.
+        """
+        if flags is not None:
+            return flags
+
+        return [] if 0 in stdio else ['-i']
 
     def _prepare_environment(self):
         """
         Returns a mapping for the HOME environment variable
         """
-        env = {'HOME': self._make_mapping(HOME)}
+        home = os.path.expanduser('~')
+        env = {'HOME': self._make_mapping(home)[home]['bind']}
 
         return env
 
@@ -590,6 +1324,12 @@ class DKRContainer:
         """
         return "{}:{}".format(os.getuid(), os.getgid())
 
+    def _prepare_labels(self, entrypoint):
+        """
+        Returns the labels identifying the process which owns the container
+        """
+        return get_owner_labels(entrypoint)
+
     def _prepare_working_directory(self):
         """
         Returns a mapping for the present working directory
@@ -598,99 +1338,303 @@ class DKRContainer:
 
         return pwd
 
-    def _prepare_invocation(self, invocation, volumes):
+    def _prepare_globs(self, invocation):
+        """
+        Finds the arguments left for the container to expand as globs, if enabled with --glob
+        or the expand_globs setting, i.e. those with wildcards which are not paths themselves.
+        The directories they are under are mounted like any other path, once per glob however
+        many files it matches.
+
+        :return: Dict mapping the index of each glob in the invocation to the glob
+        """
+        if not self.settings.get('expand_globs'):
+            return {}
+
+        return dict((index, os.path.expanduser(item)) for index, item in enumerate(invocation)
+                    if index and GLOB_WILDCARDS.search(item) and not os.path.exists(item))
+
+    def _get_bind(self, path):
+        """
+        Returns the path at which the container sees a path, which is unchanged if relative
+        as the container works in the mount point of the present working directory.
+        """
+        if not os.path.isabs(path):
+            return path
+
+        return find_dataset_path(path, self.datasets) or self._make_mapping(path)[path]['bind']
+
+    def _prepare_invocation(self, invocation, volumes, stdio=None, globs=None):
         """
         Updates the invocation to use the mount points for any paths.
 
+        If any of the stdio file descriptors are to be used directly, or any globs are left for
+        the container to expand, wraps the invocation in a shell which redirects them to the
+        mount points of their files and expands the globs.
+
+        Invocations too long for a command line are handed over in an argfile instead,
+        see _prepare_argfile.
+
         Returns a  for the specified container to
         be consumed by subprocess.Popen
         """
-        for index, item in enumerate(invocation):
-            if item in volumes:
-                item = volumes[item]['bind']
-            invocation[index] = item
+        globs = globs or {}
+        rewrite_invocation(invocation, volumes, self.datasets)
+
+        if sum(len(item) + 1 for item in invocation) > ARGUMENT_LIMIT:
+            return self._prepare_argfile(invocation, volumes, stdio or {}, globs)
+
+        if stdio or globs:
+            redirects = ''.join(' %s %s' % (redirect, quote(self._get_bind(path)))
+                                for _, (path, redirect) in sorted((stdio or {}).items()))
+            words = ' '.join(quote_glob(self._get_bind(globs[index])) if index in globs
+                             else '"${%d}"' % (index + 1) for index in range(len(invocation)))
+            invocation = ['sh', '-c', 'exec %s%s' % (words if globs else '"$@"', redirects),
+                          'dkr'] + invocation
 
         return invocation
 
+    def _prepare_argfile(self, invocation, volumes, stdio, globs):
+        """
+        Writes the arguments of an invocation too long for a command line to an argfile,
+        NUL separated, in a directory mounted into the container, where xargs reads them
+        back and runs the command on them. Any globs are expanded here rather than in the
+        container.
+
+        xargs fails rather than run the command on only some of the arguments, unless the
+        entrypoint's chunk_arguments setting allows the command to be run several times, on
+        as many arguments as fit at once. The arguments before the first path are then
+        repeated in each run, e.g. gzip -9 in gzip -9 *.fastq.
+
+        xargs reports any exit status of the command from 1 to 125 as 123, so a failing run
+        also writes its status next to the argfile, which is exited with instead.
+
+        :return: The invocation which runs the command on the arguments in the argfile
+        """
+        split = 0
+        if self.settings.get('chunk_arguments'):
+            binds = set(volume['bind'] for volume in volumes.values())
+            split = next((index for index, item in enumerate(invocation) if index and (
+                index in globs or item in binds or os.path.exists(item))), len(invocation))
+
+        arguments = []
+        for index, item in enumerate(invocation[split:], split):
+            if index in globs:
+                arguments.extend(self._get_bind(path)
+                                 for path in sorted(glob.glob(globs[index])) or [globs[index]])
+            else:
+                arguments.append(item)
+
+        makedirs(ARGFILE_DIR)
+        descriptor, self.argfile = tempfile.mkstemp(
+            dir=ARGFILE_DIR, prefix=ARGFILE_PREFIX % (os.getpid(), get_process_start_time() or 0))
+        with os.fdopen(descriptor, 'wb') as argfile:
+            for argument in arguments:
+                if isinstance(argument, type(u'')):
+                    argument = argument.encode('utf-8')
+                argfile.write(argument + b'\0')
+
+        volumes.update(self._make_mapping(ARGFILE_DIR))
+
+        # xargs reads the argfile on stdin, so the command gets stdin back from fd 3
+        stdin = ('3< %s' % quote(self._get_bind(stdio[0][0]))) if 0 in stdio else '3<&0'
+        stdout = (' %s %s' % (stdio[1][1], quote(self._get_bind(stdio[1][0])))
+                  if 1 in stdio else '')
+        options = ['-0'] + (['-x', '-n', str(len(arguments))] if not split else [])
+
+        script = ('exec %s; command=$1; argfile=$2; shift 2; export DKR_STATUS="$argfile%s"; '
+                  'xargs %s -s $(( $(getconf ARG_MAX 2>/dev/null || echo %d) - %d )) '
+                  'sh -c "$command" dkr "$@" < "$argfile"%s; status=$?; '
+                  '[ -s "$DKR_STATUS" ] && status=$(cat "$DKR_STATUS"); exit $status' % (
+                      stdin, ARGFILE_STATUS, ' '.join(options), ARGUMENT_LIMIT + ARGUMENT_HEADROOM,
+                      ARGUMENT_HEADROOM, stdout))
+        command = ('"$@" <&3 3<&-; status=$?; '
+                   '[ $status -eq 0 ] || echo $status > "$DKR_STATUS"; exit $status')
+
+        return (['sh', '-c', script, 'dkr', command, self._get_bind(self.argfile)] +
+                invocation[:split])
+
     def _prepare_image(self, image):
         """
         Pulls the image if it does not exist locally
         """
+        digest = (self.settings.get('digests') or {}).get(image)
+        if digest:
+            return self._prepare_pinned_image(image, digest)
+
         if not get_image_tagged_version(image):
             image = set_image_tagged_version(image)
 
         found_image = match_to_image_tag(self.client, image)
 
         if not found_image:
-            pull_docker_image(image)
-            return image
+            return pull_docker_image(image, host_url=self.host and self.host.url,
+                                     mirrors=self.settings.get('mirrors'))
 
         return found_image
 
-    def _make_mapping(self, path):
+    def _prepare_pinned_image(self, image, digest):
         """
-        Makes a dkr and docker aware mapping for a single path
+        Looks up the image by its digest, which needs no listing of the local images
+        nor any request to the registry, and pulls it by digest only if it is missing.
         """
-        mapping = {path: {'bind': os.path.join('/dkr', path.lstrip('//')), 'mode': 'rw'}}
-        return mapping
+        pinned = pin_image_reference(image, digest)
+        mirrors = self.settings.get('mirrors')
+
+        # Images pulled from a mirror by digest are known by the mirror's repository
+        for reference in [pinned] + [r for _, r in get_mirror_references(pinned, mirrors)]:
+            try:
+                self.client.api.inspect_image(reference)
+                return reference
+            except docker.errors.ImageNotFound:
+                pass
+
+        pinned = pull_docker_image(pinned, host_url=self.host and self.host.url, mirrors=mirrors)
+
+        # Images pulled by digest are untagged, so tag them unless the tag is already in use
+        tagged = canonical_image_reference(image)
+        try:
+            self.client.api.inspect_image(tagged)
+        except docker.errors.ImageNotFound:
+            try:
+                self.client.api.tag(pinned, *tagged.rsplit(DOCKER_IMAGE_VERSION_DELIM, 1))
+            except APIError as e:
+                logger.debug('Could not tag %s as %s: %s' % (pinned, tagged, e))
 
-    def _make_mappings(self, paths):
+        return pinned
+
+    def _make_mapping(self, path):
         """
-        For each item in the input paths, makes a mapping for it
-        and returns the set of all mappings.
+        Makes a dkr and docker aware mapping for a single path
         """
-        mappings = {}
+        return make_mapping(path)
 
-        for path in paths:
-            mapping = self._make_mapping(path)
-            mappings = merge_two_dicts(mappings, mapping)
+def run_container(image, invocation, flags=None, settings=None, entrypoint=None):
+    """
+    Launches a container from the image and executes the invocation on it,
+    leaving the container to be shut down by the caller.
 
-        return mappings
+    :return: tuple of the container and the return code of the command
+    """
+    global ACTIVE_CONTAINER
 
-    def __find_closest_path_to_string(self, path):
-        """
-        Treats the input string as a path.
+    command = DKRContainer(image, invocation, flags=flags, settings=settings,
+                           entrypoint=entrypoint)
+
+    container = command.launch_container()
+    ACTIVE_CONTAINER = container
 
-        Scans the input 'path' recursively until a valid path is found,
-        which is subsequently returned.
+    for signum in SHUTDOWN_SIGNALS:
+        signal.signal(signum, signal_handler)
+    rt = command.execute_command()
+    record_image_use(image)
 
-        Returns None if no valid path is found.
-        """
-        if path.startswith('~'):
-            path = os.path.expanduser(path)
+    return container, rt
 
-        if path and not os.path.exists(path):
-            return self.__find_closest_path_to_string(os.path.split(path)[0])
-        elif path:
-            return path
-        else:
-            return None
 
+def execute(base, invocation, flags=None, profile=None, cache=False, outputs=None, config=None,
+            expand_globs=False, resolution=None, stdout_only=False):
+    """
+    Resolves the base and runs the invocation as dkr would, leaving
+    the container to be shut down by the caller.
+
+    :param config: DKRConfig to resolve the base with, loaded from file if None
+    :param stdout_only: Whether stdout is the only product of the command, so that it may be
+                        cached without declaring any outputs
+    :return: tuple of the container, or None if the result was restored from the
+    cache, and the return code of the command
+    """
+    config = config or DKRConfig()
+    if base.endswith(DKRConfig.ENTRYPOINT_DELIM + COMPARE_SELECTOR):
+        from compare import main as compare_main
+
+        return None, compare_main(base[:-len(DKRConfig.ENTRYPOINT_DELIM + COMPARE_SELECTOR)],
+                                  invocation, profile=profile, config=config)
+
+    entrypoint, image = config.resolve(base)
+
+    if entrypoint:
+        invocation = [entrypoint] + invocation
+
+    settings = config.get_settings(entrypoint)
+    if profile:
+        settings['profile'] = profile
+    if expand_globs:
+        settings['expand_globs'] = True
+    if resolution:
+        settings['resolution'] = resolution
+
+    try:
+        get_profile(settings.get('profile'), settings.get('profiles'))
+        validate_resolution(settings.get('resolution'))
+    except KeyError as e:
+        logger.error(e.args[0])
+        sys.exit(1)
+
+    image = resolve_local_version(config, base, entrypoint, image, settings)
+
+    outputs = outputs or []
+    key = None
+
+    # A cached run which writes files it didn't declare would leave them unwritten on a hit
+    cached = cache or outputs or stdout_only or (settings.get('cache') or {}).get('enabled')
+    if cached and not (outputs or stdout_only):
+        if cache:
+            logger.error('Declare the files the command writes with -o to cache it, '
+                         'or use --stdout-only if it only writes to stdout')
+            sys.exit(1)
+
+        logger.warning('Not caching, the command declares no outputs')
+        cached = False
+
+    if cached:
+        # Imported here as the cache module itself builds on this one
+        from cache import ResultCache, get_image_digest
 
-def main(base, invocation, flags=None):
+        try:
+            result_cache = ResultCache.from_settings(settings)
+        except KeyError as e:
+            logger.error(e.args[0])
+            sys.exit(1)
+
+        digest = get_image_digest(get_client(), image, settings)
+        key = digest and result_cache.make_key(digest, invocation, outputs)
+
+        if key and result_cache.restore(key, outputs):
+            return None, 0
+
+    if key:
+        with result_cache.record(key, outputs) as result:
+            container, rt = run_container(image, invocation, flags=flags, settings=settings,
+                                          entrypoint=entrypoint)
+            result['exit_code'] = rt
+    else:
+        container, rt = run_container(image, invocation, flags=flags, settings=settings,
+                                      entrypoint=entrypoint)
+
+    return container, rt
+
+
+def main(base, invocation, flags=None, profile=None, cache=False, outputs=None,
+         expand_globs=False, resolution=None, stdout_only=False):
     """
     DKR Main function.
 
     :param base: Entrypoint in config or otherwise docker image reference
     :param invocation: Array constituting command to be run on the docker container
+    :param profile: Name of a run profile to use instead of the entrypoint's profile
+    :param cache: Whether to cache the result of the command, see cache.py
+    :param outputs: Paths of the files the command writes, which are cached along with its stdout
+    :param stdout_only: Whether stdout is the only product of the command, which is cached
+    :param expand_globs: Whether to leave arguments with wildcards for the container to expand
+    :param resolution: Resolution policy to use instead of the configured one, e.g. prefer-local
     :return: return code of command run in docker container
     """
-    global ACTIVE_CONTAINER
-
-    config = DKRConfig()
-    image = config.get_entrypoint_default_version(base)
-
-    if image:
-        invocation = [base] + invocation
+    container, rt = execute(base, invocation, flags=flags, profile=profile, cache=cache,
+                            outputs=outputs, expand_globs=expand_globs, resolution=resolution,
+                            stdout_only=stdout_only)
 
-    command = DKRContainer(image or base, invocation, flags=flags)
-
-    container = command.launch_container()
-    ACTIVE_CONTAINER = container
-
-    signal.signal(signal.SIGINT, signal_handler)
-    rt = command.execute_command()
-    shutdown(container)
+    if container:
+        shutdown(container, exit_parent=False)
 
     return rt
 
@@ -700,14 +1644,39 @@ def parse_arguments(argv):
     DKR
     A convenient interface for using dockerised command line tools
 
-    Usage: 'dkr base [invocation]'
+    Usage: 'dkr [options] base [invocation]'
 
     Positional Arguments
     --------------------
-    > base: Can reference an image (e.g. alpine:latest) or an entrypoint in your config, e.g. ls
+    > base: Can reference an image (e.g. alpine:latest) or an entrypoint in your config, e.g. ls,
+            or every version of an entrypoint to compare them, e.g. ls::*, see dkr-compare
     > invocation: Your normal tool invocation, (e.g. ls -la or -la if base is ls)
+
+    Options, which must come before base
+    ------------------------------------
+    > -p --profile: Name of the run profile to use, e.g. fast or io-heavy
+    > --cache: Restore the result of an identical earlier run, or cache the result of this one,
+               needs -o or --stdout-only
+    > -o --output: A file or directory the command writes, to cache along with its stdout,
+                   may be given more than once and implies --cache
+    > --stdout-only: The command only writes to stdout, so cache it without any -o
+    > --glob: Expand quoted arguments with wildcards, e.g. 'reads/*.fastq', in the container
+    > --resolution: How to choose the version of an entrypoint, strict (the default),
+                    prefer-local or prefer-local-then-background-pull
     """
-    args = {}
+    args = dict((dest, None) for dest in DKR_OPTIONS.values())
+    args.update((dest, []) for dest in DKR_LIST_OPTIONS)
+    args.update((dest, False) for dest in DKR_FLAGS.values())
+
+    while argv and (argv[0] in DKR_OPTIONS or argv[0] in DKR_FLAGS):
+        option = argv.pop(0)
+
+        if option in DKR_FLAGS:
+            args[DKR_FLAGS[option]] = True
+        elif DKR_OPTIONS[option] in DKR_LIST_OPTIONS:
+            args[DKR_OPTIONS[option]].append(argv.pop(0) if argv else None)
+        else:
+            args[DKR_OPTIONS[option]] = argv.pop(0) if argv else None
 
     if not argv:
         errprint(parse_arguments.__doc__)
@@ -727,8 +1696,11 @@ def run_main(args=sys.argv[1:]):
     logger.setLevel(logging.ERROR)
 
     args = parse_arguments(args)
-    main(args['base'], args['invocation'])
+    return main(args['base'], args['invocation'], profile=args['profile'], cache=args['cache'],
+                outputs=[output for output in args['outputs'] if output],
+                expand_globs=args['expand_globs'], resolution=args['resolution'],
+                stdout_only=args['stdout_only'])
 
 
 if __name__ == '__main__':
-    run_main()
+    sys.exit(run_main())
@@ -0,0 +1,163 @@
+"""
+Pulling images through registry mirrors, e.g. a site's pull-through cache.
+
+Mirrors are listed in the config for the prefixes of the image references they serve:
+
+_settings:
+  mirrors:
+    quay.io:
+      - mirror.local:5000/quay
+      - mirror2.local/quay
+    docker.io:
+      - mirror.local:5000/hub
+
+An image under a prefix, e.g. quay.io/biocontainers/bwa:0.7.17, is pulled from its mirrors as
+mirror.local:5000/quay/biocontainers/bwa:0.7.17 and tagged with its own reference, so that the
+config and the local tags keep the reference to the upstream registry. Docker hub images match
+the docker.io prefix, with 'library/' for official images.
+
+Mirrors are tried fastest first, by the latency of their registry API, which is measured again
+once it is older than an hour. A mirror which fails is skipped for a few minutes, and the
+upstream registry is tried once every mirror has been.
+"""
+import os
+import time
+import logging
+import requests
+
+from multiprocessing.pool import ThreadPool
+from requests.exceptions import RequestException
+
+from state import StateFile
+from launch import STATE_DIR
+
+logger = logging.getLogger()
+
+MIRRORS_FILE = os.path.join(STATE_DIR, 'mirrors.json')
+DOCKER_HUB = 'docker.io'
+PROBE_TIMEOUT = 2.0
+LATENCY_TTL = 3600
+FAILURE_BACKOFF = 300
+
+
+def validate_mirrors(mirrors):
+    """
+    Checks that mirrors maps each prefix to a list of mirrors.
+    """
+    if not isinstance(mirrors or {}, dict):
+        raise KeyError('Mirrors must map prefixes of image references to lists of mirrors')
+
+    for prefix, prefix_mirrors in (mirrors or {}).items():
+        if not isinstance(prefix_mirrors, list) or not all(prefix_mirrors):
+            raise KeyError('Mirrors of %s must be a list of registries' % prefix)
+
+
+def normalise_reference(image):
+    """
+    Adds the registry to an image reference which relies on docker hub being the default,
+    e.g. ubuntu:18.04 becomes docker.io/library/ubuntu:18.04
+    """
+    first = image.split('/', 1)[0]
+
+    if '/' in image and ('.' in first or ':' in first or first == 'localhost'):
+        return image
+
+    return '/'.join([DOCKER_HUB] + (['library'] if '/' not in image else []) + [image])
+
+
+def get_mirror_references(image, mirrors):
+    """
+    Rewrites an image reference for each of the mirrors of the longest prefix it is under.
+
+    :param image: Image reference
+    :param mirrors: Dict of the mirrors of each prefix, see the module docstring
+    :return: List of tuples of a mirror and the reference of the image on it, in configured order
+    """
+    reference = normalise_reference(image)
+    matches = [prefix for prefix in mirrors or {}
+               if reference.startswith(prefix.rstrip('/') + '/')]
+
+    if not matches:
+        return []
+
+    prefix = max(matches, key=len).rstrip('/')
+
+    return [(mirror, mirror.rstrip('/') + reference[len(prefix):]) for mirror in mirrors[prefix]]
+
+
+def probe_mirror(mirror):
+    """
+    Measures how long the registry API of a mirror takes to answer.
+
+    :return: The latency in seconds, or None if the mirror could not be reached
+    """
+    host = mirror.split('/', 1)[0]
+
+    for scheme in ['https', 'http']:
+        started = time.time()
+        try:
+            requests.get('%s://%s/v2/' % (scheme, host), timeout=PROBE_TIMEOUT)
+        except RequestException:
+            continue
+        return time.time() - started
+
+    return None
+
+
+def rank_mirror_references(image, mirrors, path=MIRRORS_FILE):
+    """
+    Orders the mirror references of an image by the latency of their mirrors,
+    leaving out those which failed recently, and probing those not measured lately.
+
+    :return: List of the references of the image on its mirrors, fastest first
+    """
+    references = get_mirror_references(image, mirrors)
+    if not references:
+        return []
+
+    state = StateFile(path)
+    health = state.load()
+    now = time.time()
+
+    def is_stale(mirror):
+        entry = health.get(mirror) or {}
+        age = now - entry.get('measured', 0)
+        return age > LATENCY_TTL or (entry.get('latency') is None and age > FAILURE_BACKOFF)
+
+    stale = [mirror for mirror, _ in references if is_stale(mirror)]
+
+    if stale:
+        pool = ThreadPool(len(stale))
+        try:
+            latencies = pool.map(probe_mirror, stale)
+        finally:
+            pool.terminate()
+
+        with state.update() as stored:
+            for mirror, latency in zip(stale, latencies):
+                entry = stored.setdefault(mirror, {})
+                entry['measured'] = now
+                entry['latency'] = latency
+                if latency is None:
+                    entry['failed'] = now
+            health = dict(stored)
+
+    def is_healthy(mirror):
+        entry = health.get(mirror) or {}
+        return entry.get('latency') is not None and now - entry.get('failed', 0) > FAILURE_BACKOFF
+
+    healthy = [(mirror, reference) for mirror, reference in references if is_healthy(mirror)]
+
+    return [reference for _, reference in
+            sorted(healthy, key=lambda item: health[item[0]]['latency'])]
+
+
+def record_mirror_failure(image, reference, mirrors, path=MIRRORS_FILE):
+    """
+    Marks the mirror which failed to serve reference as unhealthy, so that it is skipped for a while.
+    """
+    for mirror, mirror_reference in get_mirror_references(image, mirrors):
+        if mirror_reference == reference:
+            with StateFile(path).update() as stored:
+                stored.setdefault(mirror, {})['failed'] = time.time()
+            logger.warning('Could not pull %s from mirror %s, trying the next' % (image, mirror))
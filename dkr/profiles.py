@@ -0,0 +1,115 @@
+"""
+Named run profiles, which tune how dkr containers are created.
+
+Profiles are selected per entrypoint with 'profile: <name>', or per call with
+'dkr --profile <name> ...'. The built-in profiles can be overridden, and new ones
+added, under the settings in the config, e.g.
+
+_settings:
+  profiles:
+    fast:
+      network: none
+      init: true
+      tmpfs:
+        - /tmp
+    io-heavy:
+      tmpfs:
+        /tmp: size=8g
+        /scratch: size=32g
+      shm_size: 2g
+      ulimits:
+        nofile: 65536
+        memlock: -1
+
+A profile may set:
+    network: Network mode of the container, 'none' skips setting up networking entirely
+    tmpfs: Paths to mount as tmpfs in the container, optionally mapped to mount options
+    shm_size: Size of /dev/shm
+    ulimits: Limits mapped to a single value, or to a dict with 'soft' and 'hard' values
+    init: Whether to run an init process in the container to reap zombies and forward signals
+"""
+from docker.types import Ulimit
+
+PROFILE_KEYS = ['network', 'tmpfs', 'shm_size', 'ulimits', 'init']
+BUILTIN_PROFILES = {
+    'fast': {
+        'network': 'none',
+        'init': True,
+        'tmpfs': ['/tmp']
+    },
+    'io-heavy': {
+        'init': True,
+        'tmpfs': ['/tmp', '/scratch'],
+        'shm_size': '1g',
+        'ulimits': {'nofile': 65536}
+    }
+}
+
+
+def validate_profiles(profiles):
+    """
+    Checks that the profiles only set known options.
+    """
+    for name, profile in (profiles or {}).items():
+        unknown = set(profile or {}) - set(PROFILE_KEYS)
+        if unknown:
+            raise KeyError('Profile %s has unknown options %s, expected %s' % (
+                name, ', '.join(sorted(unknown)), ', '.join(PROFILE_KEYS)))
+
+
+def get_profile(name, profiles=None):
+    """
+    Gets a profile by name from the given profiles, falling back to the built-in profiles.
+
+    :param name: Name of the profile
+    :param profiles: Dict of profiles from the config
+    :return: The profile, or an empty profile if name is None
+    """
+    if not name:
+        return {}
+
+    profiles = profiles or {}
+    if name in profiles:
+        return profiles[name] or {}
+
+    if name in BUILTIN_PROFILES:
+        return BUILTIN_PROFILES[name]
+
+    raise KeyError('Unknown profile %s, expected one of %s' % (
+        name, ', '.join(sorted(set(profiles) | set(BUILTIN_PROFILES)))))
+
+
+def prepare_profile(profile):
+    """
+    Translates a profile into keyword arguments for creating a container with dockerpy.
+
+    :param profile: Dict of profile options as described above
+    :return: Dict of dockerpy keyword arguments
+    """
+    kwargs = {}
+
+    if profile.get('network'):
+        kwargs['network_mode'] = profile['network']
+
+    tmpfs = profile.get('tmpfs')
+    if tmpfs:
+        if isinstance(tmpfs, list):
+            tmpfs = dict((path, '') for path in tmpfs)
+        kwargs['tmpfs'] = dict((path, options or '') for path, options in tmpfs.items())
+
+    if profile.get('shm_size'):
+        kwargs['shm_size'] = profile['shm_size']
+
+    ulimits = []
+    for name, limit in (profile.get('ulimits') or {}).items():
+        if isinstance(limit, dict):
+            ulimits.append(Ulimit(name=name, soft=limit.get('soft'), hard=limit.get('hard')))
+        else:
+            ulimits.append(Ulimit(name=name, soft=limit, hard=limit))
+    if ulimits:
+        kwargs['ulimits'] = ulimits
+
+    if 'init' in profile:
+        kwargs['init'] = bool(profile['init'])
+
+    return kwargs
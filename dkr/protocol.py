@@ -0,0 +1,97 @@
+"""
+Line-delimited JSON protocol used to pipe records between the dkr tools.
+
+Each line written to a pipe is a single JSON object describing an entrypoint
+and the docker images assigned to it, e.g.
+
+    {"entrypoint": "minimap2", "versions": ["quay.io/biocontainers/minimap2:2.9--1"]}
+
+Records are written and flushed one at a time, so that the next tool in the pipe
+can start working on the first record while the previous tool is still producing
+the rest. The dict-repr format written by older versions of dkr is still accepted.
+"""
+import ast
+import sys
+import json
+
+ENTRYPOINT_KEY = 'entrypoint'
+VERSIONS_KEY = 'versions'
+
+
+def dump_record(entrypoint, versions, stream=None, **extra):
+    """
+    Writes a single record to stream (stdout by default) and flushes it.
+
+    :param entrypoint: Name of the entrypoint
+    :param versions: List of docker image references assigned to the entrypoint
+    :param extra: Any additional fields to include in the record
+    """
+    stream = stream or sys.stdout
+
+    record = dict(extra)
+    record[ENTRYPOINT_KEY] = entrypoint
+    record[VERSIONS_KEY] = list(versions)
+
+    stream.write(json.dumps(record) + '\n')
+    stream.flush()
+
+
+def load_records(stream=None):
+    """
+    Reads records from stream (stdin by default), yielding each one as soon as
+    its line has been read.
+
+    Falls back to reading the whole stream as a python dict-repr if the input
+    is in the legacy format.
+    """
+    stream = stream or sys.stdin
+
+    # Iterating over a file object in python 2 reads ahead in large blocks,
+    # which would stall until the upstream tool has written enough output.
+    lines = iter(stream.readline, '')
+
+    for line in lines:
+        if not line.strip():
+            continue
+
+        try:
+            record = native_strings(json.loads(line))
+        except ValueError:
+            record = None
+
+        if not isinstance(record, dict) or ENTRYPOINT_KEY not in record:
+            raw = line + ''.join(lines)
+            for legacy_record in _load_legacy_records(raw):
+                yield legacy_record
+            return
+
+        record.setdefault(VERSIONS_KEY, [])
+        yield record
+
+
+def _load_legacy_records(raw):
+    """
+    Parses the dict-repr output of older versions of dkr into records.
+    """
+    config = ast.literal_eval(raw) if raw.strip() else {}
+
+    for entrypoint, value in config.items():
+        yield {ENTRYPOINT_KEY: entrypoint, VERSIONS_KEY: value.get(VERSIONS_KEY, [])}
+
+
+def native_strings(value):
+    """
+    json decodes strings as unicode, which yaml would then tag when the config is
+    written, so convert them back to native strings.
+    """
+    if isinstance(value, dict):
+        return dict((native_strings(k), native_strings(v)) for k, v in value.items())
+
+    if isinstance(value, list):
+        return [native_strings(v) for v in value]
+
+    if isinstance(value, type(u'')) and not isinstance(value, str):
+        return value.encode('utf-8')
+
+    return value
+
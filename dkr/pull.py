@@ -2,21 +2,23 @@
 Pull images from your dkr config.
 """
 import os
-import ast
 import sys
 import stat
 
-from main import pull_docker_image
+from main import DKRConfig, pull_docker_image
+from protocol import load_records, VERSIONS_KEY
 
 
-def main(config):
+def main(records):
     """
-    Pull the docker images specified in the config
-    option parsed to this function.
+    Pull the docker images specified in the records parsed to this function,
+    starting on each record as soon as it arrives.
     """
-    for key, value in config.items():
-        for version in value['versions']:
-            pull_docker_image(version)
+    mirrors = DKRConfig().get_settings().get('mirrors')
+
+    for record in records:
+        for version in record[VERSIONS_KEY]:
+            pull_docker_image(version, mirrors=mirrors)
 
 
 def run_main():
@@ -25,9 +27,7 @@ def run_main():
         print "dkr-pull: To use this tool, pipe in the contents of dkr-list"
         sys.exit(1)
 
-    raw = sys.stdin.read()
-    config = ast.literal_eval(raw)
-    return main(config)
+    return main(load_records())
 
 
 if __name__ == '__main__':
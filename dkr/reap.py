@@ -0,0 +1,283 @@
+"""
+Remove dkr containers which have been orphaned, i.e. whose dkr process is gone.
+
+Every dkr container is labelled with the pid, start time, host and uid of the process which
+started it. A container is orphaned once no process with that pid and start time is running
+on the host which started it, e.g. because dkr was killed before it could remove it.
+
+dkr hands its container over to a process of its own to be stopped once the command has
+finished or been interrupted, and exits before it is removed. These containers are marked
+as being stopped in ~/.dkr.d/stopping of their user, and left alone while they are.
+
+The argfiles of long invocations, which dkr removes when the command finishes, are left
+behind in ~/.dkr.d/args when dkr is interrupted, and are removed along with the containers.
+"""
+import os
+import pwd
+import sys
+import time
+import socket
+import argparse
+
+from multiprocessing.pool import ThreadPool
+from docker.errors import DockerException
+from requests.exceptions import RequestException
+
+from main import (DKRConfig, OWNER_PID_LABEL, OWNER_START_LABEL, OWNER_HOST_LABEL,
+                  OWNER_UID_LABEL, ENTRYPOINT_LABEL, STARTED_LABEL, print_tabulate, errprint,
+                  format_time, get_process_start_time, HOME, STOPPING_DIR, ARGFILE_DIR)
+from hosts import get_client, load_hosts
+
+DEFAULT_MIN_AGE = 60
+REMOVE_THREADS = 8
+# Containers marked as stopping for longer than this were left behind by a failed shutdown
+STOPPING_TIMEOUT = 300
+
+
+def is_orphaned(labels, host, uid=None):
+    """
+    Checks whether the process which started a container has gone.
+
+    Containers started on other hosts are never orphaned here, since their
+    processes can't be checked, and nor are those of other users unless uid is None.
+
+    :param labels: The labels of the container
+    :param host: Name of this host
+    :param uid: Only containers of this user may be orphaned, any user's if None
+    """
+    if labels.get(OWNER_HOST_LABEL) != host:
+        return False
+
+    if uid is not None and labels.get(OWNER_UID_LABEL) != str(uid):
+        return False
+
+    try:
+        pid = int(labels[OWNER_PID_LABEL])
+    except (KeyError, ValueError):
+        return False
+
+    start = get_process_start_time(pid)
+    if start is None:
+        return True
+
+    # Without a recorded start time, a running process with the pid is taken to be the owner
+    recorded = labels.get(OWNER_START_LABEL, '')
+    return recorded.isdigit() and recorded != str(start)
+
+
+def is_stopping(container_id, labels):
+    """
+    Checks whether a container is being stopped by the process dkr handed it over to,
+    see main.shutdown, from the mark left in the state directory of its user.
+    """
+    directory = STOPPING_DIR
+
+    # Root finds the marks of other users under their home directory
+    if labels.get(OWNER_UID_LABEL) != str(os.getuid()):
+        try:
+            home = pwd.getpwuid(int(labels[OWNER_UID_LABEL])).pw_dir
+        except (KeyError, ValueError):
+            return False
+        directory = os.path.join(home, os.path.relpath(STOPPING_DIR, HOME))
+
+    path = os.path.join(directory, container_id)
+
+    try:
+        return time.time() - os.path.getmtime(path) < STOPPING_TIMEOUT
+    except OSError:
+        return False
+
+
+def find_orphans(client, min_age=DEFAULT_MIN_AGE, uid=None):
+    """
+    Finds the orphaned dkr containers of a docker daemon which are at least min_age seconds old,
+    so that containers which are still being set up by their process are left alone.
+
+    :return: List of the containers, as listed by the docker api
+    """
+    host = socket.gethostname()
+    now = time.time()
+
+    containers = client.api.containers(all=True, filters={'label': OWNER_PID_LABEL})
+
+    return [container for container in containers
+            if now - container['Created'] >= min_age
+            and is_orphaned(container.get('Labels') or {}, host, uid=uid)
+            and not is_stopping(container['Id'], container.get('Labels') or {})]
+
+
+def remove_orphans(client, orphans):
+    """
+    Removes the containers concurrently.
+
+    :return: List of the error for each container, or None if it was removed
+    """
+    def remove(container):
+        try:
+            client.api.remove_container(container['Id'], force=True)
+        except (DockerException, RequestException) as e:
+            return str(e)
+
+    pool = ThreadPool(min(REMOVE_THREADS, len(orphans)))
+    try:
+        return pool.map(remove, orphans)
+    finally:
+        pool.terminate()
+
+
+def find_stale_argfiles(directory=ARGFILE_DIR):
+    """
+    Finds the argfiles, and their status files, whose dkr process has gone,
+    from the pid and start time in their names, see DKRContainer._prepare_argfile.
+
+    :return: List of paths
+    """
+    stale = []
+
+    for name in os.listdir(directory) if os.path.isdir(directory) else []:
+        try:
+            _, pid, start = name.split('-')[:3]
+            pid, start = int(pid), int(start)
+        except ValueError:
+            continue
+
+        if get_process_start_time(pid) != start:
+            stale.append(os.path.join(directory, name))
+
+    return stale
+
+
+def get_clients(config):
+    """
+    Gets the docker clients of the daemon given by the environment and each configured host.
+    """
+    urls = [None] + [host.url for host in load_hosts(config.get_settings())]
+    unique = []
+
+    for url in urls:
+        if url not in unique:
+            unique.append(url)
+
+    return [get_client(url) for url in unique]
+
+
+def reap(config, min_age=DEFAULT_MIN_AGE, dry_run=False):
+    """
+    Finds and removes the orphaned containers of every docker daemon dkr uses.
+
+    :return: Number of containers which could not be removed
+    """
+    # Root may clean up after every user of the host
+    uid = None if os.getuid() == 0 else os.getuid()
+    rows = []
+    failures = 0
+
+    for client in get_clients(config):
+        try:
+            orphans = find_orphans(client, min_age=min_age, uid=uid)
+        except (DockerException, RequestException) as e:
+            errprint('dkr-reap: Could not list containers of %s: %s' % (client.api.base_url, e))
+            continue
+
+        if not orphans:
+            continue
+
+        errors = [None] * len(orphans) if dry_run else remove_orphans(client, orphans)
+
+        for container, error in zip(orphans, errors):
+            labels = container.get('Labels') or {}
+
+            if dry_run:
+                action = 'would remove'
+            elif error:
+                action = 'failed: %s' % error
+                failures += 1
+            else:
+                action = 'removed'
+
+            try:
+                started = float(labels.get(STARTED_LABEL))
+            except (TypeError, ValueError):
+                started = container['Created']
+
+            rows.append([container['Id'][:12], labels.get(ENTRYPOINT_LABEL, container['Image']),
+                         labels.get(OWNER_PID_LABEL), format_time(started), action])
+
+    if rows:
+        print_tabulate(['Container', 'Entrypoint', 'Owner', 'Started', 'Action'], rows,
+                       print_total_rows=False)
+        sys.stdout.flush()
+
+    if not dry_run:
+        for path in find_stale_argfiles():
+            try:
+                os.remove(path)
+            except OSError as e:
+                errprint('dkr-reap: Could not remove %s: %s' % (path, e.strerror))
+
+    return failures
+
+
+def main(min_age=DEFAULT_MIN_AGE, dry_run=False, interval=None):
+    """
+    dkr-reap Main function.
+
+    Removes the orphaned dkr containers once, or every interval seconds until interrupted.
+    """
+    config = DKRConfig()
+
+    if not interval:
+        return 1 if reap(config, min_age=min_age, dry_run=dry_run) else 0
+
+    try:
+        while True:
+            reap(config, min_age=min_age, dry_run=dry_run)
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+
+    return 0
+
+
+def parse_arguments(argv):
+    """
+    Parse command-line arguments
+
+    :param argv: command line arguments
+    :return: parsed command-line arguments (argparse)
+    """
+    description = ('Remove the dkr containers of this host whose dkr process has gone, '
+                   'on the docker daemon of the environment and on the configured hosts.')
+
+    parser = argparse.ArgumentParser(description=description)
+
+    parser.add_argument('-a',
+                        '--min-age',
+                        type=int,
+                        default=DEFAULT_MIN_AGE,
+                        help='Leave containers younger than this many seconds, %d by default'
+                             % DEFAULT_MIN_AGE)
+
+    parser.add_argument('-n',
+                        '--dry-run',
+                        action='store_true',
+                        help='Only report which containers would be removed')
+
+    parser.add_argument('-i',
+                        '--interval',
+                        type=int,
+                        help='Keep running, reaping every this many seconds')
+
+    args = parser.parse_args(argv)
+
+    return args
+
+
+def run_main(args=sys.argv[1:]):
+    args = parse_arguments(args)
+
+    return main(min_age=args.min_age, dry_run=args.dry_run, interval=args.interval)
+
+
+if __name__ == '__main__':
+    sys.exit(run_main())
@@ -28,18 +28,13 @@ class QuayBiocontainersRegistry(ImageRegistry):
             QuayBiocontainersRegistry.QUAY_IO_LIST_TAGS_URL.format(name))
 
     def search_repository(self, name):
-        rep_list = []
-
         response = self.send_request(
             QuayBiocontainersRegistry.QUAY_IO_FIND_REPOSITORY_URL.format(name))
         for entry in response['results']:
             if entry['kind'] == 'repository' and 'biocontainers' in entry['href']:
-                rep_list.append(self.get_tags(entry['href']))
-
-        return rep_list
+                yield self.get_tags(entry['href'])
 
     def get_images(self, name):
-        docker_images = []
         for repo in self.search_repository(name):
             repo_name = repo['name']
             repo_namespace = repo['namespace']
@@ -51,13 +46,12 @@ class QuayBiocontainersRegistry(ImageRegistry):
                     'name': repo_name,
                     'provider': 'quay.io/biocontainers',
                     'tag': tag['name'],
+                    'digest': tag.get('manifest_digest'),
                     'repository': "quay.io/{}/{}:{}".format(repo_namespace,
                                                             repo_name,
                                                             tag['name'])
                 }
-                docker_images.append(docker_image)
-
-        return docker_images
+                yield docker_image
 
     def name(self):
         return "quay.io/biocontainers"
\ No newline at end of file
@@ -2,25 +2,26 @@
 Remove items from your dkr config.
 """
 import os
-import ast
 import sys
 import stat
 import argparse
 
 from main import DKRConfig
+from protocol import load_records, ENTRYPOINT_KEY, VERSIONS_KEY
 
 
-def main(config, remove_entrypoints=False):
+def main(records, remove_entrypoints=False):
     """
-    Pull the docker images specified in the config
-    option parsed to this function.
+    Remove the entrypoints or versions specified in the records
+    parsed to this function.
     """
     current_config = DKRConfig()
 
-    for key, value in config.items():
+    for record in records:
+        key = record[ENTRYPOINT_KEY]
 
         if not remove_entrypoints:
-            versions = value.get('versions', [])
+            versions = record[VERSIONS_KEY]
 
             if len(versions) == 1:
                 print "Can't remove %s from %s, its the only assigned image." % (versions[0], key)
@@ -66,10 +67,7 @@ def run_main(args=sys.argv[1:]):
         print "dkr-remove: To use this tool, pipe in the contents of dkr-list"
         sys.exit(1)
 
-    raw = sys.stdin.read()
-    config = ast.literal_eval(raw)
-
-    return main(config, args.remove_entrypoints)
+    return main(load_records(), args.remove_entrypoints)
 
 
 if __name__ == '__main__':
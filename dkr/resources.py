@@ -0,0 +1,195 @@
+"""
+Resource limits for dkr containers, and discovery of the CPUs available to the caller.
+
+An entrypoint in the config may limit the resources of its containers, e.g.
+
+bwa:
+  versions:
+    - quay.io/biocontainers/bwa:latest
+  resources:
+    cpus: 4
+    cpuset: auto
+    memory: 8g
+    pids_limit: 512
+    blkio_weight: 500
+    blkio_weight_device:
+      /dev/sda: 200
+
+'cpuset: auto' restricts the container to the CPUs the caller itself may run on, and
+'resources: auto' additionally limits the CPU time of the container to the caller's
+cgroup quota. Whenever the number of CPUs is known, the common thread count environment
+variables are set in the container so that threaded tools don't oversubscribe them.
+"""
+import os
+import math
+import multiprocessing
+
+AUTO = 'auto'
+RESOURCE_KEYS = ['cpus', 'cpuset', 'memory', 'pids_limit', 'blkio_weight', 'blkio_weight_device']
+THREAD_ENVIRONMENT_VARIABLES = [
+    'OMP_NUM_THREADS',
+    'MKL_NUM_THREADS',
+    'OPENBLAS_NUM_THREADS',
+    'NUMEXPR_NUM_THREADS',
+    'VECLIB_MAXIMUM_THREADS',
+    'BLIS_NUM_THREADS'
+]
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+
+def parse_cpu_list(cpu_list):
+    """
+    Parses a list of CPUs in the kernel's list format, e.g. '0-3,8', into a list of ints
+    """
+    cpus = []
+
+    for part in cpu_list.strip().split(','):
+        if not part:
+            continue
+
+        bounds = part.split('-')
+        cpus.extend(range(int(bounds[0]), int(bounds[-1]) + 1))
+
+    return cpus
+
+
+def format_cpu_list(cpus):
+    """
+    Formats a list of CPUs in the kernel's list format, e.g. [0, 1, 2, 3, 8] as '0-3,8'
+    """
+    ranges = []
+
+    for cpu in sorted(set(cpus)):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+
+    return ','.join(str(a) if a == b else '%d-%d' % (a, b) for a, b in ranges)
+
+
+def get_allowed_cpus():
+    """
+    Gets the CPUs which the current process is allowed to run on.
+
+    :return: List of CPU numbers
+    """
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('Cpus_allowed_list:'):
+                    return parse_cpu_list(line.split(':', 1)[1])
+    except IOError:
+        pass
+
+    return list(range(multiprocessing.cpu_count()))
+
+
+def _read_first_line(path):
+    try:
+        with open(path) as f:
+            return f.readline().strip()
+    except IOError:
+        return None
+
+
+def get_cgroup_cpu_quota():
+    """
+    Gets the number of CPUs worth of time the cgroup of the current process
+    is allowed to use, for both cgroup v1 and v2.
+
+    :return: Number of CPUs as a float, or None if there is no quota
+    """
+    try:
+        with open('/proc/self/cgroup') as cgroups:
+            lines = [line.strip().split(':', 2) for line in cgroups]
+    except IOError:
+        return None
+
+    for _, controllers, path in lines:
+        path = path.lstrip('/')
+
+        # cgroup v2
+        if not controllers:
+            cpu_max = _read_first_line(os.path.join(CGROUP_ROOT, path, 'cpu.max'))
+            if cpu_max and not cpu_max.startswith('max'):
+                quota, period = cpu_max.split()
+                return float(quota) / float(period)
+
+        # cgroup v1
+        elif 'cpu' in controllers.split(','):
+            directory = os.path.join(CGROUP_ROOT, controllers, path)
+            quota = _read_first_line(os.path.join(directory, 'cpu.cfs_quota_us'))
+            period = _read_first_line(os.path.join(directory, 'cpu.cfs_period_us'))
+            if quota and period and int(quota) > 0:
+                return float(quota) / float(period)
+
+    return None
+
+
+def validate_resources(resources):
+    """
+    Checks that only known resource limits have been given.
+    """
+    if resources in (None, AUTO):
+        return
+
+    unknown = set(resources) - set(RESOURCE_KEYS)
+    if unknown:
+        raise KeyError('Unknown resources %s, expected %s' % (
+            ', '.join(sorted(unknown)), ', '.join(RESOURCE_KEYS)))
+
+
+def prepare_resources(resources):
+    """
+    Translates the resources given in the config into keyword arguments
+    for creating a container with dockerpy, and environment variables
+    which tell threaded tools how many CPUs they have.
+
+    :param resources: Dict of resources as described above, 'auto', or None
+    :return: tuple of (dockerpy keyword arguments, environment variables)
+    """
+    if not resources:
+        return {}, {}
+
+    if resources == AUTO:
+        resources = {'cpus': AUTO, 'cpuset': AUTO}
+
+    validate_resources(resources)
+
+    kwargs = {}
+    threads = []
+
+    cpuset = resources.get('cpuset')
+    if cpuset == AUTO:
+        cpuset = format_cpu_list(get_allowed_cpus())
+    if cpuset:
+        kwargs['cpuset_cpus'] = str(cpuset)
+        threads.append(len(parse_cpu_list(str(cpuset))))
+
+    cpus = resources.get('cpus')
+    if cpus == AUTO:
+        cpus = get_cgroup_cpu_quota()
+    if cpus:
+        kwargs['nano_cpus'] = int(float(cpus) * 1e9)
+        threads.append(int(math.ceil(float(cpus))))
+
+    if resources.get('memory'):
+        kwargs['mem_limit'] = resources['memory']
+
+    if resources.get('pids_limit'):
+        kwargs['pids_limit'] = int(resources['pids_limit'])
+
+    if resources.get('blkio_weight'):
+        kwargs['blkio_weight'] = int(resources['blkio_weight'])
+
+    if resources.get('blkio_weight_device'):
+        kwargs['blkio_weight_device'] = [
+            {'Path': path, 'Weight': int(weight)}
+            for path, weight in resources['blkio_weight_device'].items()]
+
+    environment = {}
+    if threads:
+        environment = dict((name, str(min(threads))) for name in THREAD_ENVIRONMENT_VARIABLES)
+
+    return kwargs, environment
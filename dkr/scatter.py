@@ -0,0 +1,451 @@
+"""
+Scatter/gather: split one large input into shards, run an invocation on each shard in a
+container of its own, all at once, and gather their outputs into one.
+
+    dkr-scatter -i reads.fastq -n 8 -g sam bwa mem -t 2 ref.fa {shard} > aln.sam
+
+The input is split into contiguous ranges of records, without being copied: each shard is a
+named pipe which the range is streamed into as the command reads it, so commands have to read
+{shard} once from start to end, as most tools reading FASTQ, FASTA or SAM do. As the pipes are
+fed from this process, shards run on the local docker daemon even when hosts are configured.
+The format of the input, which decides where records start, is taken from its extension
+unless given:
+
+    fastq: records of four lines
+    fasta: records starting with a '>' line
+    sam:   lines, with the header lines starting with '@' repeated at the start of every shard
+    lines: lines
+
+The stdout of each shard's command is kept in the scatter directory until the gatherer
+merges them, in the order of the shards:
+
+    cat:  concatenates them
+    sam:  concatenates them, keeping only the header of the first
+    sort: merges them by --key, as sort -m would, keeping only the header of the first,
+          for commands whose output is sorted, e.g. --key 3,4n for coordinate sorted SAM
+          whose references sort by name
+"""
+import os
+import sys
+import errno
+import heapq
+import itertools
+import shutil
+import argparse
+import tempfile
+import threading
+
+from main import DKRConfig, errprint, logger
+from api import Session
+
+SHARD_PLACEHOLDER = '{shard}'
+FORMATS = ['fastq', 'fasta', 'sam', 'lines']
+EXTENSIONS = {
+    '.fastq': 'fastq', '.fq': 'fastq',
+    '.fasta': 'fasta', '.fa': 'fasta', '.fna': 'fasta', '.faa': 'fasta',
+    '.sam': 'sam'
+}
+GATHERERS = ['cat', 'sam', 'sort']
+HEADER_PREFIX = '@'
+READ_SIZE = 1024 * 1024
+
+
+def detect_format(path):
+    """
+    Gets the format of a file from its extension, see the module docstring.
+    """
+    return EXTENSIONS.get(os.path.splitext(path)[1].lower(), 'lines')
+
+
+def get_header_end(stream, fmt):
+    """
+    Finds where the records of a file start, i.e. after the header of a SAM file.
+    """
+    stream.seek(0)
+
+    if fmt != 'sam':
+        return 0
+
+    offset = 0
+    for line in iter(stream.readline, ''):
+        if not line.startswith(HEADER_PREFIX):
+            break
+        offset += len(line)
+
+    return offset
+
+
+def find_record_start(stream, offset, fmt):
+    """
+    Finds where the first record starting at or after offset starts.
+
+    A FASTQ header is told apart from a quality line starting with '@' by the
+    line after next, which only starts with '+' after a header.
+
+    :return: The offset of the record, or the size of the file if there is none
+    """
+    stream.seek(offset)
+
+    if offset:
+        # Skip the rest of the line offset is in, unless it starts one
+        stream.seek(offset - 1)
+        stream.readline()
+
+    while True:
+        start = stream.tell()
+        line = stream.readline()
+
+        if not line:
+            return start
+        elif fmt == 'fasta' and not line.startswith('>'):
+            continue
+        elif fmt == 'fastq':
+            stream.readline()
+            if not line.startswith('@') or not stream.readline().startswith('+'):
+                stream.seek(start + len(line))
+                continue
+
+        return start
+
+
+def split_ranges(path, shards, fmt):
+    """
+    Splits the records of a file into contiguous ranges of about the same size.
+
+    :return: tuple of the header, which starts every shard, and a list of
+             (start, end) offsets of each non-empty shard
+    """
+    with open(path, 'rb') as stream:
+        header_end = get_header_end(stream, fmt)
+        stream.seek(0)
+        header = stream.read(header_end)
+
+        size = os.fstat(stream.fileno()).st_size
+        step = (size - header_end) / float(shards)
+
+        offsets = [header_end]
+        for i in range(1, shards):
+            offsets.append(max(offsets[-1], find_record_start(
+                stream, header_end + int(i * step), fmt)))
+        offsets.append(size)
+
+    return header, [(start, end) for start, end in zip(offsets, offsets[1:]) if end > start]
+
+
+def feed_shard(path, fifo, header, start, end, abandoned):
+    """
+    Streams the header and the range of the input into the named pipe of a shard,
+    until the command reading it has read it all or gone away.
+    """
+    try:
+        with open(path, 'rb') as source, open(fifo, 'wb') as shard:
+            if abandoned.is_set():
+                return
+            shard.write(header)
+            source.seek(start)
+
+            remaining = end - start
+            while remaining > 0:
+                chunk = source.read(min(READ_SIZE, remaining))
+                if not chunk:
+                    break
+                shard.write(chunk)
+                remaining -= len(chunk)
+    except IOError as e:
+        if e.errno != errno.EPIPE:
+            logger.error('dkr-scatter: Could not feed %s: %s' % (fifo, e))
+
+
+def release_feeder(fifo, feeder):
+    """
+    Unblocks a feeder waiting for its command to open a named pipe it never will,
+    e.g. because it failed to start.
+    """
+    while feeder.is_alive():
+        try:
+            os.close(os.open(fifo, os.O_RDONLY | os.O_NONBLOCK))
+        except OSError:
+            pass
+        feeder.join(0.1)
+
+
+def parse_key(spec):
+    """
+    Parses a key to merge lines by, as comma separated tab delimited columns counted from 1,
+    each numeric if followed by n, e.g. 3,4n.
+
+    :return: A function getting the key of a line
+    """
+    columns = []
+    for part in spec.split(','):
+        part = part.strip()
+        columns.append((int(part.rstrip('n')) - 1, part.endswith('n')))
+
+    def get_key(line):
+        fields = line.rstrip('\n').split('\t')
+        key = []
+        for index, numeric in columns:
+            value = fields[index] if index < len(fields) else ''
+            if numeric:
+                try:
+                    value = float(value)
+                except ValueError:
+                    value = 0.0
+            key.append(value)
+        return tuple(key)
+
+    return get_key
+
+
+def split_header(stream):
+    """
+    Reads the header lines starting an output, if it has any.
+
+    :return: tuple of the lines of the header and an iterator over the rest of the lines
+    """
+    header = []
+
+    for line in stream:
+        if not line.startswith(HEADER_PREFIX):
+            return header, itertools.chain([line], stream)
+        header.append(line)
+
+    return header, iter([])
+
+
+def gather(paths, out, gatherer='cat', key=None):
+    """
+    Merges the outputs of the shards into out, see the module docstring.
+    """
+    if gatherer == 'cat':
+        for path in paths:
+            with open(path, 'rb') as stream:
+                shutil.copyfileobj(stream, out, READ_SIZE)
+        return
+
+    streams = [open(path, 'rb') for path in paths]
+    try:
+        outputs = [split_header(stream) for stream in streams]
+        if outputs:
+            out.writelines(outputs[0][0])
+
+        bodies = [body for _, body in outputs]
+
+        if gatherer == 'sam':
+            for body in bodies:
+                out.writelines(body)
+        else:
+            get_key = parse_key(key) if key else (lambda line: line)
+
+            # The index of the shard keeps lines with equal keys in the order of the shards
+            def decorate(index, body):
+                for line in body:
+                    yield get_key(line), index, line
+
+            merged = heapq.merge(*[decorate(i, body) for i, body in enumerate(bodies)])
+            out.writelines(line for _, _, line in merged)
+    finally:
+        for stream in streams:
+            stream.close()
+
+
+def scatter(config, base, invocation, path, shards, fmt=None, directory=None, jobs=None,
+            profile=None):
+    """
+    Runs the invocation on each shard of the input, at most jobs at once.
+
+    :return: tuple of the scatter directory, the paths of the outputs of the shards in order,
+             and the exit code of each shard's command, or None if it could not be run
+    """
+    fmt = fmt or detect_format(path)
+    header, ranges = split_ranges(path, shards, fmt)
+    extension = os.path.splitext(path)[1]
+
+    directory = tempfile.mkdtemp(prefix='dkr-scatter-', dir=directory or os.getcwd())
+    slots = threading.Semaphore(jobs or len(ranges))
+    abandoned = threading.Event()
+    outputs, runs, feeders, streams = [], [], [], []
+
+    try:
+        with Session(config) as session:
+            for i, (start, end) in enumerate(ranges):
+                fifo = os.path.join(directory, 'shard-%d%s' % (i, extension))
+                os.mkfifo(fifo)
+
+                feeder = threading.Thread(target=feed_shard,
+                                          args=(path, fifo, header, start, end, abandoned))
+                feeder.daemon = True
+                feeder.start()
+                feeders.append((fifo, feeder))
+
+                output = os.path.join(directory, 'shard-%d.out' % i)
+                stdout = open(output, 'wb')
+                streams.append(stdout)
+                outputs.append(output)
+
+                slots.acquire()
+                # The shard is fed by a thread of this process, so it has to run on this machine
+                args = [arg.replace(SHARD_PLACEHOLDER, fifo) for arg in invocation]
+                run = session.start(base, args, stdout=stdout, profile=profile,
+                                    settings={'hosts': None})
+                run.add_done_callback(lambda run: slots.release())
+                runs.append(run)
+
+            codes = []
+            for run in runs:
+                try:
+                    codes.append(run.wait())
+                except (Exception, SystemExit) as e:
+                    logger.error('dkr-scatter: A shard could not be run: %s' % e)
+                    codes.append(None)
+    finally:
+        abandoned.set()
+        for fifo, feeder in feeders:
+            release_feeder(fifo, feeder)
+        for stream in streams:
+            stream.close()
+
+    return directory, outputs, codes
+
+
+def main(base, invocation, path, shards, fmt=None, gatherer='cat', key=None, output=None,
+         directory=None, jobs=None, profile=None, keep=False):
+    """
+    dkr-scatter Main function.
+
+    :return: 0 if every shard succeeded and the outputs were gathered, otherwise 1
+    """
+    if not any(SHARD_PLACEHOLDER in arg for arg in invocation):
+        errprint('dkr-scatter: The invocation must read the shard as %s' % SHARD_PLACEHOLDER)
+        return 1
+
+    if not os.path.isfile(path):
+        errprint('dkr-scatter: %s is not a file, which shards can be split from' % path)
+        return 1
+
+    try:
+        parse_key(key or '1')
+    except ValueError:
+        errprint('dkr-scatter: Invalid key %s' % key)
+        return 1
+
+    config = DKRConfig()
+    scatter_directory = None
+
+    try:
+        scatter_directory, outputs, codes = scatter(config, base, invocation, path, shards,
+                                                    fmt=fmt, directory=directory, jobs=jobs,
+                                                    profile=profile)
+
+        failed = [i for i, code in enumerate(codes) if code != 0]
+        if failed:
+            errprint('dkr-scatter: Shards %s failed, nothing was gathered'
+                     % ', '.join(str(i) for i in failed))
+            return 1
+
+        out = open(output, 'wb') if output else sys.stdout
+        try:
+            gather(outputs, out, gatherer=gatherer, key=key)
+        finally:
+            if output:
+                out.close()
+    except (IOError, OSError) as e:
+        errprint('dkr-scatter: %s' % e)
+        return 1
+    except KeyError as e:
+        logger.error(e.args[0])
+        return 1
+    finally:
+        if scatter_directory and not keep:
+            shutil.rmtree(scatter_directory, ignore_errors=True)
+
+    return 0
+
+
+def parse_arguments(argv):
+    """
+    Parse command-line arguments
+
+    :param argv: command line arguments
+    :return: parsed command-line arguments (argparse)
+    """
+    description = ('Split an input into shards, run the invocation on each shard in parallel '
+                   'containers, reading its shard as %s, and gather their outputs.'
+                   % SHARD_PLACEHOLDER)
+
+    parser = argparse.ArgumentParser(description=description)
+
+    parser.add_argument('BASE', help='Entrypoint in your config or image')
+
+    parser.add_argument('INVOCATION',
+                        nargs=argparse.REMAINDER,
+                        help='Arguments of the entrypoint, with %s for the shard'
+                             % SHARD_PLACEHOLDER)
+
+    parser.add_argument('-i',
+                        '--input',
+                        required=True,
+                        help='File to split into shards')
+
+    parser.add_argument('-n',
+                        '--shards',
+                        type=int,
+                        default=4,
+                        help='Number of shards, 4 by default')
+
+    parser.add_argument('-f',
+                        '--format',
+                        choices=FORMATS,
+                        help='Format of the input, from its extension by default')
+
+    parser.add_argument('-g',
+                        '--gather',
+                        choices=GATHERERS,
+                        default='cat',
+                        help='How to merge the outputs of the shards, cat by default')
+
+    parser.add_argument('-k',
+                        '--key',
+                        help='Columns to merge by with --gather sort, e.g. 3,4n')
+
+    parser.add_argument('-o',
+                        '--output',
+                        help='File to write the gathered output to, stdout by default')
+
+    parser.add_argument('-j',
+                        '--jobs',
+                        type=int,
+                        help='Number of shards to run at once, all of them by default')
+
+    parser.add_argument('-d',
+                        '--directory',
+                        help='Directory to make the scatter directory in, '
+                             'the working directory by default')
+
+    parser.add_argument('-p',
+                        '--profile',
+                        help='Name of the run profile to use')
+
+    parser.add_argument('--keep',
+                        action='store_true',
+                        help='Keep the outputs of the shards')
+
+    args = parser.parse_args(argv)
+
+    if args.shards < 1:
+        parser.error('--shards must be at least 1')
+
+    return args
+
+
+def run_main(args=sys.argv[1:]):
+    args = parse_arguments(args)
+
+    return main(args.BASE, args.INVOCATION, args.input, args.shards, fmt=args.format,
+                gatherer=args.gather, key=args.key, output=args.output,
+                directory=args.directory, jobs=args.jobs, profile=args.profile,
+                keep=args.keep)
+
+
+if __name__ == '__main__':
+    sys.exit(run_main())
@@ -1,5 +1,8 @@
 """
 Script for searching for docker containers to add to your config.
+
+With --sizes, the compressed size of each image is shown along with how much of it a pull
+would download, leaving out the layers already present locally, see layers.py.
 """
 from __future__ import print_function
 
@@ -7,10 +10,14 @@ import os
 import sys
 import stat
 import argparse
-import itertools
 
-from main import print_tabulate
+from main import print_tabulate, format_size
+from hosts import get_client
+from layers import get_image_layers, get_local_layers, estimate_pull_cost
+from protocol import dump_record
 from requests import ConnectionError
+from requests.exceptions import RequestException
+from docker.errors import DockerException
 from registries.quay_biocontainers import QuayBiocontainersRegistry
 
 REGISTRIES = [QuayBiocontainersRegistry()]
@@ -18,56 +25,99 @@ REGISTRIES = [QuayBiocontainersRegistry()]
 
 def query(registries, query_str):
     """
+    Queries each registry in turn, yielding the search results as they arrive.
 
-    :param registries:
-    :param query_str:
-    :return:
+    :param registries: List of registries to query
+    :param query_str: Search query
+    :return: generator of search results, each with a sequential 'id'
     """
-    search_results = []
-
     # Get the search results
     index = 1
     for registry in registries:
         try:
-            results = registry.query(query_str)
-            for result in results:
+            for result in registry.query(query_str):
                 result['id'] = index
-                search_results.append(result)
+                yield result
                 index += 1
         except ConnectionError:
             print("Warning: Could not connect to {}. Skipping.".format(
                 registry.name()), file=sys.stderr)
 
-    return search_results
 
+def add_pull_costs(results):
+    """
+    Adds the compressed 'size' of each search result's image and the bytes a pull of it
+    would download, 'pull', or None for each if its layers could not be fetched.
+    """
+    layers = get_image_layers([result['repository'] for result in results],
+                              digests=dict((result['repository'], result.get('digest'))
+                                           for result in results))
+
+    try:
+        local_layers = get_local_layers(get_client())
+    except (DockerException, RequestException):
+        print("Warning: Could not list the local images, showing the full size of each.",
+              file=sys.stderr)
+        local_layers = set()
+
+    for result in results:
+        image_layers = layers.get(result['repository'])
+        result['size'], result['pull'] = estimate_pull_cost(image_layers, local_layers) \
+            if image_layers else (None, None)
 
-def main(query_str, rows, registries, pipe):
+    return results
+
+
+def main(query_str, rows, registries, pipe, sizes=False, sort=False):
     """
 
     :param query_str:
     :param rows:
     :param registries:
     :param pipe:
+    :param sizes: Whether to show the size of each image and how much a pull would download
+    :param sort: Whether to order the results by how much a pull would download, implies sizes
     :return:
     """
     # Get and filter the search results
-    results = query(registries, query_str)
-    results = filter(lambda x: x['id'] in rows or not rows, results)
+    results = select_rows(query(registries, query_str), rows)
+
+    if sizes or sort:
+        results = add_pull_costs(list(results))
+
+        if sort:
+            results.sort(key=lambda sr: (sr['pull'] is None, sr['pull']))
 
     # If not pipe, format and print the results
+    if not pipe and (sizes or sort):
+        print_tabulate(
+            ['', 'Name', 'Tag', 'URL', 'Registry', 'Size', 'To pull'],
+            [[sr['id'], sr['name'], sr['tag'], sr['repository'], sr['provider'],
+              format_size(sr['size']), format_size(sr['pull'])] for sr in results])
+        return
+
     if not pipe:
         print_tabulate(
             ['', 'Name', 'Tag', 'URL', 'Registry'],
             [[sr['id'], sr['name'], sr['tag'], sr['repository'], sr['provider']] for sr in results])
         return
 
-    # If pipe, print the results in config form
-    config = {}
-    for key, group in itertools.groupby(results, lambda x: x['name']):
-        images = [item['repository'] for item in group]
-        config[key] = {'versions': images}
+    # If pipe, print each result as a record as soon as it arrives
+    for result in results:
+        dump_record(result['name'], [result['repository']])
+
+
+def select_rows(results, rows):
+    """
+    Filters the search results down to the selected rows, stopping
+    as soon as the last selected row has been seen.
+    """
+    for result in results:
+        if rows and result['id'] > max(rows):
+            return
 
-    print(config)
+        if not rows or result['id'] in rows:
+            yield result
 
 
 def parse_args(argv):
@@ -103,6 +153,18 @@ def parse_args(argv):
                         default=[],
                         help="Search only in <REGISTRIES>")
 
+    parser.add_argument("-s", "--sizes",
+                        dest='SIZES',
+                        action='store_true',
+                        help="Show the size of each image and how much of it a pull "
+                             "would download, fetching their manifests")
+
+    parser.add_argument("-c", "--sort-by-cost",
+                        dest='SORT',
+                        action='store_true',
+                        help="Order the results by how much a pull would download, "
+                             "implies --sizes")
+
     parser.add_argument('QUERY',
                         action='store',
                         type=str,
@@ -127,7 +189,7 @@ def run_main(argv=sys.argv[1:]):
 
     if not args.LIST:
         registries = [reg for reg in REGISTRIES if reg not in args.REG]
-        main(args.QUERY[0], args.INDEX, registries, pipe)
+        main(args.QUERY[0], args.INDEX, registries, pipe, sizes=args.SIZES, sort=args.SORT)
         return
 
 
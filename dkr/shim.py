@@ -0,0 +1,468 @@
+"""
+Launcher shims, which run an entrypoint without the cost of starting dkr for each call.
+
+    dkr-shim install
+    export PATH=~/.dkr.d/bin:$PATH
+    bwa mem ref.fa reads.fastq > aln.sam
+
+'install' generates an executable named after each entrypoint in the config, or just those
+given, holding the digest of the entrypoint's default image and the request which creates its
+containers, as dkr would make it. A shim only works out the parts which change from call to
+call, i.e. the volumes for the working directory, path arguments and any stdin and stdout
+files used directly, and the labels of the container, creates and starts the container
+through the docker API directly, and runs the invocation with docker exec as dkr does. Only
+the standard library is imported, see launch.py.
+
+A shim regenerates itself when ~/.dkr has changed since it was generated, or the digest it
+was generated for is no longer a local image, which docker reports when creating the
+container, so that no call pays for inspecting the image first. Shims are regenerated by
+'install' to follow a tag to another digest, e.g. after a pull. A shim hands the call over
+to dkr when it can't serve it, e.g. when the invocation is too long for a command line, or
+the docker host isn't a local socket. Entrypoints which need dkr
+for every call, e.g. because they use a pool of hosts, the result cache or the run history,
+get no shim.
+"""
+import os
+import sys
+import json
+import stat
+import signal
+import socket
+import httplib
+import logging
+import argparse
+import subprocess
+
+from launch import (STATE_DIR, CONFIG_FILE, get_owner_labels, record_image_use, prepare_volumes,
+                    rewrite_invocation, collapse_volumes, find_direct_stdio, find_dataset_path,
+                    make_mapping, quote)
+from admission import admitted, CREATING, RUNNING
+
+logger = logging.getLogger()
+
+DEFAULT_DIRECTORY = os.path.join(STATE_DIR, 'bin')
+DEFAULT_DOCKER_SOCKET = '/var/run/docker.sock'
+SHIM_MARKER = '# Generated by dkr-shim'
+REGENERATED_VARIABLE = 'DKR_SHIM_REGENERATED'
+
+SHIM_TEMPLATE = '''#!%(python)s
+%(marker)s from %(config)s, which regenerates it when that changes
+import sys
+from dkr.shim import run_shim
+sys.exit(run_shim(%(plan)r, sys.argv))
+'''
+
+
+class ShimFallback(Exception):
+    """
+    Raised when a shim can't serve a call, which dkr then runs instead
+    """
+
+    def __init__(self, message, status=None):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class ShimStale(ShimFallback):
+    """
+    Raised when a shim no longer runs what dkr would, and has to be regenerated
+    """
+
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    """
+    An HTTP connection over a unix socket, such as the docker daemon's
+    """
+
+    def __init__(self, path):
+        httplib.HTTPConnection.__init__(self, 'localhost')
+        self.socket_path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+def get_docker_socket():
+    """
+    Gets the path of the socket of the docker daemon given by the environment.
+
+    :raises ShimFallback: If the docker daemon isn't reached through a local socket
+    """
+    host = os.environ.get('DOCKER_HOST')
+
+    if not host:
+        return DEFAULT_DOCKER_SOCKET
+
+    if not host.startswith('unix://'):
+        raise ShimFallback('%s is not a local socket' % host)
+
+    return host[len('unix://'):]
+
+
+def request_docker(plan, method, url, body=None):
+    """
+    Sends a request to the docker API.
+
+    :return: The decoded response, if any
+    :raises ShimFallback: If the request fails
+    """
+    connection = UnixHTTPConnection(get_docker_socket())
+
+    try:
+        connection.request(method, '/v%s%s' % (plan['api_version'], url),
+                           json.dumps(body) if body is not None else None,
+                           {'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        data = response.read()
+    except (socket.error, httplib.HTTPException) as e:
+        raise ShimFallback('Could not reach docker: %s' % e)
+    finally:
+        connection.close()
+
+    if response.status >= 400:
+        raise ShimFallback('docker answered %s %s with %d: %s' % (
+            method, url, response.status, data.strip()), status=response.status)
+
+    return json.loads(data) if data else None
+
+
+def remove_container(plan, container_id):
+    try:
+        request_docker(plan, 'DELETE', '/containers/%s?force=1' % container_id)
+    except ShimFallback as e:
+        logger.debug('Could not remove container %s: %s' % (container_id, e))
+
+
+def launch(plan, args):
+    """
+    Runs the entrypoint of the plan on the arguments, as dkr would.
+
+    :return: The return code of the command
+    :raises ShimFallback: If the call has to be left to dkr
+    """
+    invocation = [plan['entrypoint']] + args
+    if sum(len(item) + 1 for item in invocation) > plan['argument_limit']:
+        raise ShimFallback('The invocation is too long for a command line')
+
+    if 'reference' not in plan:
+        raise ShimStale('The shim predates pinning images to their digest')
+
+    cwd = os.getcwd()
+    stdio = {}
+    if plan['direct_io']:
+        stdio = find_direct_stdio({0: sys.stdin, 1: sys.stdout, 2: sys.stderr})
+    volumes = prepare_volumes(invocation + [path for path, _ in stdio.values()],
+                              [cwd, plan['home']], plan['datasets'])
+    rewrite_invocation(invocation, volumes, plan['datasets'])
+
+    if stdio:
+        redirects = ''.join(' %s %s' % (redirect, quote(
+            find_dataset_path(path, plan['datasets']) or make_mapping(path)[path]['bind']))
+            for _, (path, redirect) in sorted(stdio.items()))
+        invocation = ['sh', '-c', 'exec "$@"' + redirects, 'dkr'] + invocation
+
+    body = dict(plan['container'], WorkingDir=volumes[cwd]['bind'],
+                User='%d:%d' % (os.getuid(), os.getgid()),
+                Labels=get_owner_labels(plan['entrypoint']))
+    body['HostConfig'] = dict(body.get('HostConfig') or {}, Binds=[
+        '%s:%s:%s' % (path, volume['bind'], volume['mode'])
+        for path, volume in sorted(collapse_volumes(volumes).items())])
+
+    with admitted(plan.get('admission'), RUNNING):
+        with admitted(plan.get('admission'), CREATING):
+            try:
+                container_id = request_docker(plan, 'POST', '/containers/create', body)['Id']
+            except ShimFallback as e:
+                # The image is created from its digest, which is gone once the image is
+                if e.status == 404:
+                    raise ShimStale('%s is no longer a local image' % plan['reference'])
+                raise
+            request_docker(plan, 'POST', '/containers/%s/start' % container_id)
+
+        def shutdown(signum, frame):
+            remove_container(plan, container_id)
+            os._exit(128 + signum)
+
+        for signum in [signal.SIGINT, signal.SIGTERM, signal.SIGHUP]:
+            signal.signal(signum, shutdown)
+
+        # Stdin is only streamed when it isn't a file the container reads directly
+        flags = [] if 0 in stdio else ['-i']
+
+        try:
+            rt = subprocess.call(['docker', 'exec'] + flags + [container_id] + invocation)
+        finally:
+            remove_container(plan, container_id)
+
+    # The container wrote straight to the file behind stdout, so catch up with it
+    if 1 in stdio and stat.S_ISREG(os.fstat(sys.stdout.fileno()).st_mode):
+        os.lseek(sys.stdout.fileno(), 0, os.SEEK_END)
+
+    record_image_use(plan['image'])
+
+    return rt
+
+
+def run_dkr(entrypoint, args):
+    """
+    Hands the call over to dkr, never returning.
+    """
+    os.execv(sys.executable, [sys.executable, '-m', 'dkr.client', entrypoint] + args)
+
+
+def run_shim(plan, argv):
+    """
+    Main function of a generated shim.
+
+    :param plan: JSON of the shim's plan, see build_plan
+    :param argv: The shim's sys.argv
+    """
+    plan = json.loads(plan)
+    regenerated = os.environ.pop(REGENERATED_VARIABLE, None)
+
+    def regenerate():
+        if not regenerated:
+            os.environ[REGENERATED_VARIABLE] = '1'
+            directory = os.path.dirname(os.path.abspath(argv[0]))
+            subprocess.call([sys.executable, '-m', 'dkr.shim', 'install', '--quiet',
+                             '--directory', directory, plan['entrypoint']])
+            if os.path.exists(argv[0]):
+                os.execv(argv[0], argv)
+
+        return run_dkr(plan['entrypoint'], argv[1:])
+
+    try:
+        stale = os.stat(CONFIG_FILE).st_mtime != plan['config_mtime']
+    except OSError:
+        stale = True
+
+    if stale:
+        return regenerate()
+
+    try:
+        return launch(plan, argv[1:])
+    except ShimStale as e:
+        logger.debug('Regenerating: %s' % e)
+        return regenerate()
+    except ShimFallback as e:
+        logger.debug('Handing over to dkr: %s' % e)
+        return run_dkr(plan['entrypoint'], argv[1:])
+
+
+def get_unsupported_reason(settings):
+    """
+    Finds why an entrypoint can't be run by a shim, if it can't.
+
+    :return: The reason, or None if it can
+    """
+    # Imported here as only generating shims needs docker and the config
+    from hosts import load_hosts
+    from resources import AUTO
+
+    resources = settings.get('resources')
+
+    if load_hosts(settings):
+        return 'runs on a pool of docker hosts'
+    elif (settings.get('cache') or {}).get('enabled'):
+        return 'caches its results'
+    elif (settings.get('history') or {}).get('enabled'):
+        return 'records its run history'
+    elif settings.get('expand_globs'):
+        return 'expands globs in the container'
+    elif resources == AUTO or (isinstance(resources, dict) and resources.get('cpuset') == AUTO):
+        return 'sets its resources from those of the caller'
+
+    return None
+
+
+def build_plan(config, entrypoint):
+    """
+    Works out everything about running the entrypoint which is the same for every call,
+    pulling its default image if it is missing.
+
+    :return: Dict of the plan
+    """
+    from main import (DKRContainer, merge_two_dicts, resolve_image_digest, pin_image_reference,
+                      ARGUMENT_LIMIT)
+    from resources import prepare_resources
+    from profiles import get_profile, prepare_profile
+
+    settings = config.get_settings(entrypoint)
+    _, image = config.resolve(entrypoint)
+
+    container = DKRContainer(image, [], None, auto_prepare=False, settings=settings,
+                             entrypoint=entrypoint)
+    client = container.client
+    local_image = container._prepare_image(image)
+
+    # Run the image by its digest, or by its id if it was never pushed to a registry
+    inspected = client.api.inspect_image(local_image)
+    digest = inspected.get('RepoDigests') and resolve_image_digest(client, local_image)
+    reference = pin_image_reference(image, digest) if digest else inspected['Id']
+
+    resources, resource_environment = prepare_resources(settings.get('resources'))
+    profile = prepare_profile(get_profile(settings.get('profile'), settings.get('profiles')))
+
+    # Resources and profiles are all options of the host config
+    host_config = client.api.create_host_config(**merge_two_dicts(resources, profile))
+    container_config = client.api.create_container_config(
+        image=reference, command=None, detach=True, stdin_open=True, host_config=host_config,
+        environment=merge_two_dicts(container._prepare_environment(), resource_environment))
+
+    return {
+        'entrypoint': entrypoint,
+        'image': image,
+        'reference': reference,
+        'home': os.path.expanduser('~'),
+        'datasets': container.datasets,
+        'direct_io': settings.get('direct_io', True),
+        'container': container_config,
+        'api_version': client.api.api_version,
+        'argument_limit': ARGUMENT_LIMIT,
+        'admission': settings.get('admission'),
+        'config_mtime': os.stat(config.path).st_mtime
+    }
+
+
+def is_shim(path):
+    try:
+        with open(path) as stream:
+            return SHIM_MARKER in stream.read(4096)
+    except IOError:
+        return False
+
+
+def write_shim(directory, plan):
+    """
+    Writes an executable shim for the plan to directory, replacing any it had.
+    """
+    path = os.path.join(directory, plan['entrypoint'])
+    temporary = os.path.join(directory, '.%s.%d' % (plan['entrypoint'], os.getpid()))
+
+    with open(temporary, 'w') as stream:
+        stream.write(SHIM_TEMPLATE % {'python': sys.executable, 'marker': SHIM_MARKER,
+                                      'config': CONFIG_FILE, 'plan': json.dumps(plan)})
+
+    os.chmod(temporary, stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH)
+    os.rename(temporary, path)
+
+    return path
+
+
+def install(directory, entrypoints=None, quiet=False):
+    """
+    Generates shims for the entrypoints, or for every entrypoint in the config, removing
+    those of entrypoints which can no longer have one.
+
+    :return: 0 if every entrypoint got a shim, otherwise 1
+    """
+    from main import DKRConfig, errprint
+    from state import makedirs
+
+    config = DKRConfig()
+    configured = config.get_entrypoints()
+    rt = 0
+
+    makedirs(directory)
+
+    for entrypoint in entrypoints or configured:
+        path = os.path.join(directory, entrypoint)
+        reason = None
+
+        if entrypoint not in configured:
+            reason = 'is not in your config'
+        elif os.sep in entrypoint or entrypoint.startswith('.'):
+            reason = 'is not a valid file name'
+        else:
+            reason = get_unsupported_reason(config.get_settings(entrypoint))
+
+        if not reason:
+            try:
+                write_shim(directory, build_plan(config, entrypoint))
+                continue
+            except Exception as e:
+                reason = 'could not be prepared: %s' % e
+
+        if is_shim(path):
+            os.remove(path)
+
+        rt = 1
+        if not quiet:
+            errprint('dkr-shim: No shim for %s, which %s' % (entrypoint, reason))
+
+    if not quiet:
+        errprint('dkr-shim: Installed shims in %s' % directory)
+        if directory not in os.environ.get('PATH', '').split(os.pathsep):
+            errprint('dkr-shim: Add it to the start of your PATH to use them')
+
+    return rt
+
+
+def remove(directory, entrypoints=None):
+    """
+    Removes the shims of the entrypoints, or all of them.
+    """
+    if not os.path.isdir(directory):
+        return 0
+
+    for name in entrypoints or os.listdir(directory):
+        path = os.path.join(directory, name)
+        if is_shim(path):
+            os.remove(path)
+
+    return 0
+
+
+def main(args):
+    """
+    dkr-shim Main function.
+    """
+    directory = os.path.abspath(os.path.expanduser(args.directory))
+
+    if args.command == 'install':
+        return install(directory, args.ENTRYPOINT, quiet=args.quiet)
+    elif args.command == 'remove':
+        return remove(directory, args.ENTRYPOINT)
+
+
+def parse_arguments(argv):
+    """
+    Parse command-line arguments
+
+    :param argv: command line arguments
+    :return: parsed command-line arguments (argparse)
+    """
+    description = ('Generate a launcher for each entrypoint in your dkr config, which runs it '
+                   'without starting dkr for every call.')
+
+    parser = argparse.ArgumentParser(description=description)
+    subparsers = parser.add_subparsers(dest='command')
+
+    install_parser = subparsers.add_parser(
+        'install', help='Generate shims for the entrypoints, all of them by default')
+    remove_parser = subparsers.add_parser(
+        'remove', help='Remove the shims of the entrypoints, all of them by default')
+
+    for subparser in [install_parser, remove_parser]:
+        subparser.add_argument('ENTRYPOINT', nargs='*', help='Entrypoints in your config')
+        subparser.add_argument('-d', '--directory', default=DEFAULT_DIRECTORY,
+                               help='Directory of the shims, %s by default' % DEFAULT_DIRECTORY)
+
+    install_parser.add_argument('-q', '--quiet', action='store_true',
+                                help='Only report errors through the exit code')
+
+    args = parser.parse_args(argv)
+
+    return args
+
+
+def run_main(args=sys.argv[1:]):
+    args = parse_arguments(args)
+
+    return main(args)
+
+
+if __name__ == '__main__':
+    sys.exit(run_main())
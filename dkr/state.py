@@ -0,0 +1,65 @@
+"""
+Small JSON files holding the state dkr keeps between invocations.
+"""
+import os
+import json
+import errno
+import fcntl
+import tempfile
+
+from contextlib import contextmanager
+
+
+def makedirs(path):
+    """
+    Creates the directory at path, and its parents, if it does not already exist.
+    """
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+class StateFile:
+    """
+    A JSON object stored in a file, which can safely be updated by
+    several dkr processes at once.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        """
+        Loads the contents of the file at self.path.
+
+        :return: The stored object, or an empty dict if nothing has been stored yet
+        """
+        try:
+            with open(self.path, 'r') as stream:
+                return json.load(stream)
+        except (IOError, ValueError):
+            return {}
+
+    @contextmanager
+    def update(self):
+        """
+        Context manager yielding the stored object for modification.
+
+        The file is locked for the duration of the block and the modified
+        object is written back atomically when the block exits.
+        """
+        directory = os.path.dirname(self.path)
+        makedirs(directory)
+
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            state = self.load()
+            yield state
+
+            fd, tmp_path = tempfile.mkstemp(dir=directory)
+            with os.fdopen(fd, 'w') as stream:
+                json.dump(state, stream)
+            os.rename(tmp_path, self.path)
@@ -0,0 +1,132 @@
+"""
+Submit a dkr invocation to the local job queue, see jobqueue.
+"""
+import os
+import sys
+import time
+import argparse
+
+from main import DKRConfig, errprint, parse_size
+from profiles import get_profile
+from jobqueue import JobQueue, get_queue_dir, request_dispatcher, FINISHED_STATES, POLL_INTERVAL
+
+
+def main(base, invocation, cpus=None, memory=None, priority=0, name=None, profile=None, wait=False):
+    """
+    dkr-submit Main function.
+
+    Resolves the base against the config of the submitting user, so the job runs the
+    same image with the same settings as dkr would, and adds it to the queue.
+
+    :param base: Entrypoint in config or otherwise docker image reference
+    :param invocation: Array constituting command to be run on the docker container
+    :param cpus: Number of CPUs the job needs, defaults to its resource limit or 1
+    :param memory: Bytes of memory the job needs, defaults to its resource limit or 0
+    :param wait: Wait for the job to finish, then print its output and exit with its exit code
+    """
+    config = DKRConfig()
+    entrypoint, image = config.resolve(base)
+
+    if entrypoint:
+        invocation = [entrypoint] + invocation
+
+    settings = config.get_settings(entrypoint)
+    if profile:
+        settings['profile'] = profile
+
+    try:
+        get_profile(settings.get('profile'), settings.get('profiles'))
+    except KeyError as e:
+        errprint('dkr-submit: %s' % e.args[0])
+        return 1
+
+    resources = settings.get('resources') or {}
+
+    if isinstance(resources, dict):
+        # Default the declared needs of the job to its resource limits
+        if not cpus and resources.get('cpus') not in (None, 'auto'):
+            cpus = float(resources['cpus'])
+        if not memory and resources.get('memory'):
+            memory = parse_size(resources['memory'])
+
+        # And hold the job to what it declared
+        resources = dict(resources)
+        if cpus:
+            resources.setdefault('cpus', cpus)
+        if memory:
+            resources.setdefault('memory', memory)
+        settings['resources'] = resources
+
+    cpus = cpus or 1
+    memory = memory or 0
+
+    directory = get_queue_dir(config)
+
+    try:
+        job_id = request_dispatcher(directory, {
+            'command': 'submit', 'cwd': os.getcwd(), 'base': base, 'image': image,
+            'invocation': invocation, 'settings': settings, 'cpus': cpus, 'memory': memory,
+            'priority': priority, 'name': name})['id']
+    except IOError as e:
+        errprint('dkr-submit: %s' % e.strerror)
+        return 1
+
+    print(job_id)
+
+    if not wait:
+        return 0
+
+    queue = JobQueue(directory)
+
+    while queue.get(job_id)['state'] not in FINISHED_STATES:
+        time.sleep(POLL_INTERVAL)
+
+    stdout_path, stderr_path = queue.log_paths(job_id)
+    for path, stream in [(stdout_path, sys.stdout), (stderr_path, sys.stderr)]:
+        try:
+            with open(path) as log:
+                for chunk in iter(lambda: log.read(65536), ''):
+                    stream.write(chunk)
+        except IOError:
+            pass
+
+    exit_code = queue.get(job_id)['exit_code']
+    return 1 if exit_code is None else exit_code
+
+
+def parse_arguments(argv):
+    """
+    Parse command-line arguments
+
+    :param argv: command line arguments
+    :return: parsed command-line arguments (argparse)
+    """
+    description = 'Submit a dkr invocation to the local job queue, prints the job id.'
+
+    parser = argparse.ArgumentParser(description=description)
+
+    parser.add_argument('-c', '--cpus', type=float, help='Number of CPUs the job needs')
+    parser.add_argument('-m', '--memory', type=parse_size, help='Memory the job needs, e.g. 8G')
+    parser.add_argument('-P', '--priority', type=int, default=0,
+                        help='Jobs with a higher priority are run first')
+    parser.add_argument('-n', '--name', help='Name of the job')
+    parser.add_argument('-p', '--profile', help='Name of the run profile to use')
+    parser.add_argument('-w', '--wait', action='store_true',
+                        help='Wait for the job, print its output and exit with its exit code')
+    parser.add_argument('BASE', help='Entrypoint in your config or a docker image reference')
+    parser.add_argument('INVOCATION', nargs=argparse.REMAINDER, help='Your normal tool invocation')
+
+    args = parser.parse_args(argv)
+
+    return args
+
+
+def run_main(args=sys.argv[1:]):
+    args = parse_arguments(args)
+
+    return main(args.BASE, args.INVOCATION, cpus=args.cpus, memory=args.memory,
+                priority=args.priority, name=args.name, profile=args.profile, wait=args.wait)
+
+
+if __name__ == '__main__':
+    sys.exit(run_main())
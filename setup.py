@@ -17,12 +17,26 @@ setup(
     ],
     packages=[MODULE_NAME, MODULE_NAME + '/registries'],
     entry_points={"console_scripts": [
-        'dkr = dkr.main:run_main',
+        'dkr = dkr.client:run_main',
         'dkr-search = dkr.search:run_main',
         'dkr-list = dkr.list:run_main',
         'dkr-add = dkr.add:run_main',
         'dkr-remove = dkr.remove:run_main',
         'dkr-pull = dkr.pull:run_main',
+        'dkr-gc = dkr.garbage:run_main',
+        'dkr-reap = dkr.reap:run_main',
+        'dkr-stats = dkr.history:run_main',
+        'dkr-compare = dkr.compare:run_main',
+        'dkr-scatter = dkr.scatter:run_main',
+        'dkr-bundle = dkr.bundle:run_main',
+        'dkr-dataset = dkr.datasets:run_main',
+        'dkr-shim = dkr.shim:run_main',
+        'dkr-admission = dkr.admission:run_main',
+        'dkr-submit = dkr.submit:run_main',
+        'dkr-queue = dkr.jobqueue:run_main',
+        'dkr-lock = dkr.lock:run_main',
+        'dkr-flow = dkr.flow:run_main',
+        'dkr-agent = dkr.agent:run_main',
         'dkr_comp = dkr.dkr_comp:run_main',
         'dkr-debug = dkr.debug:run_main']}
 )
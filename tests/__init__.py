@@ -0,0 +1,5 @@
+import os
+import sys
+
+# dkr's modules import each other by their bare names, as when run from the package directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'dkr'))
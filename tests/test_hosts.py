@@ -0,0 +1,127 @@
+import unittest
+
+from docker.errors import DockerException
+
+import hosts
+
+from hosts import DockerHost, CLIENTS, rank_hosts, select_host, load_hosts
+
+
+class FakeAPI:
+    """
+    Stands in for the docker API of a host, running the given number of containers
+    and holding the given image references.
+    """
+
+    def __init__(self, running=0, images=None, reachable=True):
+        self.running = running
+        self.images_held = images or []
+        self.reachable = reachable
+
+    def containers(self, quiet=False):
+        if not self.reachable:
+            raise DockerException('Host is down')
+        return [{'Id': str(index)} for index in range(self.running)]
+
+    def images(self, filters=None, quiet=False):
+        if not self.reachable:
+            raise DockerException('Host is down')
+        return [image for image in self.images_held if image in filters['reference']]
+
+
+class FakeClient:
+    def __init__(self, api):
+        self.api = api
+
+
+class HostsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clients = dict(CLIENTS)
+        CLIENTS.clear()
+
+    def tearDown(self):
+        CLIENTS.clear()
+        CLIENTS.update(self.clients)
+
+    def add_host(self, name, slots=1, mounts=None, **status):
+        url = 'tcp://%s:2375' % name
+        CLIENTS[url] = FakeClient(FakeAPI(**status))
+        return DockerHost(url, name=name, slots=slots, mounts=mounts)
+
+    def test_load_hosts(self):
+        loaded = load_hosts({'hosts': [{'url': 'tcp://a:2375', 'name': 'a', 'slots': 4},
+                                       {'url': 'tcp://b:2375', 'mounts': ['/nfs']}]})
+
+        self.assertEqual([(h.name, h.slots, h.mounts) for h in loaded],
+                         [('a', 4, None), ('tcp://b:2375', hosts.DEFAULT_SLOTS, ['/nfs'])])
+        self.assertEqual(load_hosts({}), [])
+
+    def test_rank_prefers_free_slots(self):
+        busy = DockerHost('tcp://busy', slots=2)
+        free = DockerHost('tcp://free', slots=2)
+
+        ranked = rank_hosts([busy, free], [{'running': 2, 'has_image': True},
+                                           {'running': 1, 'has_image': False}])
+
+        self.assertEqual(ranked, [free, busy])
+
+    def test_rank_prefers_image_then_load(self):
+        empty = DockerHost('tcp://empty', slots=4)
+        loaded = DockerHost('tcp://loaded', slots=4)
+        idle = DockerHost('tcp://idle', slots=4)
+
+        ranked = rank_hosts([empty, loaded, idle], [{'running': 0, 'has_image': False},
+                                                    {'running': 3, 'has_image': True},
+                                                    {'running': 1, 'has_image': True}])
+
+        self.assertEqual(ranked, [idle, loaded, empty])
+
+    def test_rank_weighs_load_by_slots(self):
+        small = DockerHost('tcp://small', slots=2)
+        large = DockerHost('tcp://large', slots=16)
+
+        ranked = rank_hosts([small, large], [{'running': 1, 'has_image': True},
+                                             {'running': 4, 'has_image': True}])
+
+        self.assertEqual(ranked, [large, small])
+
+    def test_rank_leaves_out_unreachable(self):
+        down = DockerHost('tcp://down')
+        up = DockerHost('tcp://up')
+
+        self.assertEqual(rank_hosts([down, up], [None, {'running': 5, 'has_image': False}]), [up])
+        self.assertEqual(rank_hosts([down], [None]), [])
+
+    def test_get_status(self):
+        host = self.add_host('node', running=3, images=['bwa:0.7.17'])
+
+        self.assertEqual(host.get_status('bwa:0.7.17'), {'running': 3, 'has_image': True})
+        self.assertEqual(host.get_status('samtools:1.9'), {'running': 3, 'has_image': False})
+        self.assertIsNone(self.add_host('down', reachable=False).get_status('bwa:0.7.17'))
+
+    def test_select_host(self):
+        full = self.add_host('full', slots=1, running=1, images=['bwa:0.7.17'])
+        cold = self.add_host('cold', slots=4, running=0)
+        warm = self.add_host('warm', slots=4, running=2, images=['bwa:0.7.17'])
+        down = self.add_host('down', reachable=False)
+
+        self.assertIs(select_host([full, cold, warm, down], 'bwa:0.7.17', ['/data/reads.fq']), warm)
+        self.assertIs(select_host([full, cold, down], 'bwa:0.7.17', ['/data/reads.fq']), cold)
+
+    def test_select_host_by_mounts(self):
+        shared = self.add_host('shared', mounts=['/nfs'], running=1, slots=8)
+        local = self.add_host('local', mounts=['/home'])
+
+        self.assertIs(select_host([local, shared], 'bwa:0.7.17', ['/nfs/reads.fq']), shared)
+        self.assertIs(select_host([local, shared], 'bwa:0.7.17', ['/home/me/reads.fq']), local)
+        self.assertIsNone(select_host([local, shared], 'bwa:0.7.17', ['/scratch/reads.fq']))
+
+    def test_select_host_all_down(self):
+        down = self.add_host('down', reachable=False)
+
+        self.assertIsNone(select_host([down], 'bwa:0.7.17', []))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,200 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from functools import partial
+
+import main
+import mirrors
+
+from state import StateFile
+from mirrors import (get_mirror_references, normalise_reference, rank_mirror_references,
+                     record_mirror_failure, FAILURE_BACKOFF, LATENCY_TTL)
+
+MIRRORS = {
+    'quay.io': ['fast.local/quay', 'slow.local/quay', 'down.local/quay'],
+    'quay.io/biocontainers': ['bio.local/quay'],
+    'docker.io': ['hub.local/hub']
+}
+
+
+class FakeRegistries:
+    """
+    Stands in for registry mirrors, answering probes with their latency, or failing if it is None,
+    and serving pulls of the references they hold.
+    """
+
+    def __init__(self, latencies, references=None):
+        self.latencies = latencies
+        self.references = references or []
+        self.probed = []
+        self.pulled = []
+        self.commands = []
+
+    def probe(self, mirror):
+        self.probed.append(mirror)
+        return self.latencies.get(mirror.split('/', 1)[0])
+
+    def pull(self, reference, host_url=None):
+        self.pulled.append(reference)
+        return 0 if reference in self.references else 1
+
+    def call(self, command, **kwargs):
+        self.commands.append(command[1:])
+        return 0
+
+
+class MirrorsTestCase(unittest.TestCase):
+    """
+    Runs each test against fake mirrors, keeping their health in a file of its own.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'mirrors.json')
+        self.registries = FakeRegistries({'fast.local': 0.01, 'slow.local': 0.5, 'down.local': None,
+                                          'bio.local': 0.1, 'hub.local': 0.2})
+        self.probe_mirror = mirrors.probe_mirror
+        mirrors.probe_mirror = self.registries.probe
+
+    def tearDown(self):
+        mirrors.probe_mirror = self.probe_mirror
+        shutil.rmtree(self.directory)
+
+    def rank(self, image):
+        return rank_mirror_references(image, {'quay.io': MIRRORS['quay.io']}, path=self.path)
+
+    def age(self, mirror, seconds, *keys):
+        with StateFile(self.path).update() as stored:
+            for key in keys:
+                stored[mirror][key] -= seconds
+
+
+class MirrorsTest(MirrorsTestCase):
+
+    def test_normalise_reference(self):
+        self.assertEqual(normalise_reference('ubuntu:18.04'), 'docker.io/library/ubuntu:18.04')
+        self.assertEqual(normalise_reference('biocontainers/bwa'), 'docker.io/biocontainers/bwa')
+        self.assertEqual(normalise_reference('localhost/bwa'), 'localhost/bwa')
+        self.assertEqual(normalise_reference('quay.io/biocontainers/bwa:0.7.17'),
+                         'quay.io/biocontainers/bwa:0.7.17')
+
+    def test_get_mirror_references(self):
+        self.assertEqual(get_mirror_references('quay.io/biocontainers/bwa:0.7.17', MIRRORS),
+                         [('bio.local/quay', 'bio.local/quay/bwa:0.7.17')])
+        self.assertEqual(get_mirror_references('quay.io/other/bwa', MIRRORS)[0],
+                         ('fast.local/quay', 'fast.local/quay/other/bwa'))
+        self.assertEqual(get_mirror_references('ubuntu:18.04', MIRRORS),
+                         [('hub.local/hub', 'hub.local/hub/library/ubuntu:18.04')])
+        self.assertEqual(get_mirror_references('gcr.io/bwa', MIRRORS), [])
+        self.assertEqual(get_mirror_references('quay.io.evil/bwa', MIRRORS), [])
+
+    def test_rank_fastest_first_without_unreachable(self):
+        self.assertEqual(self.rank('quay.io/other/bwa:1'),
+                         ['fast.local/quay/other/bwa:1', 'slow.local/quay/other/bwa:1'])
+
+    def test_rank_measures_once_per_ttl(self):
+        self.rank('quay.io/other/bwa:1')
+        self.registries.probed = []
+
+        self.rank('quay.io/other/samtools:1')
+        self.assertEqual(self.registries.probed, [])
+
+        self.age('slow.local/quay', LATENCY_TTL + 1, 'measured')
+        self.registries.latencies['slow.local'] = 0.001
+
+        self.assertEqual(self.rank('quay.io/other/bwa:1')[0], 'slow.local/quay/other/bwa:1')
+        self.assertEqual(self.registries.probed, ['slow.local/quay'])
+
+    def test_rank_retries_unreachable_after_backoff(self):
+        self.rank('quay.io/other/bwa:1')
+        self.registries.latencies['down.local'] = 0.001
+
+        self.assertEqual(len(self.rank('quay.io/other/bwa:1')), 2)
+
+        self.age('down.local/quay', FAILURE_BACKOFF + 1, 'measured', 'failed')
+
+        self.assertEqual(self.rank('quay.io/other/bwa:1')[0], 'down.local/quay/other/bwa:1')
+
+    def test_record_mirror_failure(self):
+        self.rank('quay.io/other/bwa:1')
+
+        record_mirror_failure('quay.io/other/bwa:1', 'fast.local/quay/other/bwa:1',
+                              {'quay.io': MIRRORS['quay.io']}, path=self.path)
+
+        self.assertEqual(self.rank('quay.io/other/bwa:1'), ['slow.local/quay/other/bwa:1'])
+
+        self.age('fast.local/quay', FAILURE_BACKOFF + 1, 'failed')
+
+        self.assertEqual(self.rank('quay.io/other/bwa:1')[0], 'fast.local/quay/other/bwa:1')
+
+    def test_rank_without_mirrors(self):
+        self.assertEqual(rank_mirror_references('gcr.io/bwa', MIRRORS, path=self.path), [])
+        self.assertEqual(rank_mirror_references('quay.io/bwa', None, path=self.path), [])
+        self.assertFalse(os.path.exists(self.path))
+
+
+class PullFailoverTest(MirrorsTestCase):
+
+    def setUp(self):
+        super(PullFailoverTest, self).setUp()
+        self.patched = {
+            'rank_mirror_references': partial(rank_mirror_references, path=self.path),
+            'record_mirror_failure': partial(record_mirror_failure, path=self.path),
+            '_pull_docker_image': self.registries.pull,
+            'subprocess': self.registries
+        }
+        self.originals = dict((name, getattr(main, name)) for name in self.patched)
+        for name, value in self.patched.items():
+            setattr(main, name, value)
+
+    def tearDown(self):
+        for name, value in self.originals.items():
+            setattr(main, name, value)
+        super(PullFailoverTest, self).tearDown()
+
+    def pull(self, image):
+        return main.pull_docker_image(image, mirrors={'quay.io': MIRRORS['quay.io']})
+
+    def test_pull_from_fastest_mirror(self):
+        self.registries.references = ['fast.local/quay/other/bwa:1', 'slow.local/quay/other/bwa:1']
+
+        self.assertEqual(self.pull('quay.io/other/bwa:1'), 'quay.io/other/bwa:1')
+        self.assertEqual(self.registries.pulled, ['fast.local/quay/other/bwa:1'])
+        self.assertEqual(self.registries.commands,
+                         [['tag', 'fast.local/quay/other/bwa:1', 'quay.io/other/bwa:1'],
+                          ['rmi', 'fast.local/quay/other/bwa:1']])
+
+    def test_pull_fails_over_to_next_mirror(self):
+        self.registries.references = ['slow.local/quay/other/bwa:1']
+
+        self.assertEqual(self.pull('quay.io/other/bwa:1'), 'quay.io/other/bwa:1')
+        self.assertEqual(self.registries.pulled,
+                         ['fast.local/quay/other/bwa:1', 'slow.local/quay/other/bwa:1'])
+
+        # The failed mirror is skipped by the next pull
+        self.registries.pulled = []
+        self.pull('quay.io/other/bwa:1')
+        self.assertEqual(self.registries.pulled, ['slow.local/quay/other/bwa:1'])
+
+    def test_pull_fails_over_to_upstream(self):
+        self.registries.references = ['quay.io/other/bwa:1']
+
+        self.assertEqual(self.pull('quay.io/other/bwa:1'), 'quay.io/other/bwa:1')
+        self.assertEqual(self.registries.pulled, ['fast.local/quay/other/bwa:1',
+                                                  'slow.local/quay/other/bwa:1',
+                                                  'quay.io/other/bwa:1'])
+        self.assertEqual(self.registries.commands, [])
+
+    def test_pull_by_digest_keeps_mirror_reference(self):
+        digest = 'sha256:' + 'a' * 64
+        self.registries.references = ['fast.local/quay/other/bwa@' + digest]
+
+        self.assertEqual(self.pull('quay.io/other/bwa@' + digest),
+                         'fast.local/quay/other/bwa@' + digest)
+        self.assertEqual(self.registries.commands, [])
+
+
+if __name__ == '__main__':
+    unittest.main()